@@ -0,0 +1,138 @@
+import time
+
+import game.config_variables as conf
+import game.metrics as metrics
+from game.tasks import task_pools
+from game.modules import is_show_room
+
+
+# Registers a batch of players' answers to one round if the players are in the game and the answers were received
+# before the round deadline, and counts the answers for every option (see AnswerBuffer.flush). Only the first answer of
+# a player counts:
+#   KEYS[1] - room name, KEYS[2] - round answers key, KEYS[3] - round deadline key, KEYS[4] - round option counts key;
+#   ARGV - (username, answer, epoch time in ms when the answer was received) for every answer.
+# Returns the list of 1 (registered), 2 (the player has already answered), 0 (the player is not in the game) or -1
+# (the round is closed) for every answer.
+REPORT_ANSWERS_SCRIPT = """
+local deadline = redis.call('GET', KEYS[3])
+local statuses = {}
+for i = 1, #ARGV, 3 do
+    if not deadline or tonumber(ARGV[i + 2]) > tonumber(deadline) then
+        statuses[#statuses + 1] = -1
+    elseif redis.call('SISMEMBER', KEYS[1], ARGV[i]) == 0 then
+        statuses[#statuses + 1] = 0
+    elseif redis.call('HSETNX', KEYS[2], ARGV[i], ARGV[i + 1]) == 0 then
+        statuses[#statuses + 1] = 2
+    else
+        redis.call('HINCRBY', KEYS[4], ARGV[i + 1], 1)
+        statuses[#statuses + 1] = 1
+    end
+end
+if deadline then
+    -- The answers expire on their own if the game does not collect them
+    redis.call('PEXPIREAT', KEYS[2], tonumber(deadline) + 60000)
+    redis.call('PEXPIREAT', KEYS[4], tonumber(deadline) + 60000)
+end
+return statuses
+"""
+
+
+class AnswerBuffer:
+    """
+    Ingests players' answers. An answer to a game run by this server instance is handed to the game directly (and
+    scored from memory), an answer to a show is handed to the show shard of this server instance, other answers are
+    buffered per round and flushed to redis in pipelined micro-batches. *This is a singleton.
+    """
+    _singleton = None
+
+    def __new__(cls, *args, **kwargs):
+        """
+        Assures that class follows the singleton patter.
+        """
+        assert cls._singleton is None, "This class instance reinitialization is not expected"
+        if not cls._singleton:
+            cls._singleton = super(AnswerBuffer, cls).__new__(cls)
+        return cls._singleton
+
+    def __init__(self, redis_client, game_factory, logger, flush_interval=None, show_registry=None):
+        """
+        Arguments:
+             redis_client - (obj) redis client for registering the answers to the games on other server instances.
+             game_factory - (GameFactory) knows the games run by this server instance.
+             logger - (obj) app logger.
+             flush_interval - (float) time in seconds for collecting answers before flushing them to redis.
+             show_registry - (ShowRegistry) scores the answers to the shows in the shards on this server instance.
+        """
+        self.redis_client = redis_client
+        self.game_factory = game_factory
+        self.show_registry = show_registry
+        self.logger = logger
+        self.flush_interval = conf.ANSWER_FLUSH_INTERVAL if flush_interval is None else flush_interval
+        self._report_answers_script = self.redis_client.register_script(REPORT_ANSWERS_SCRIPT)
+        # Answers waiting to be flushed, (room name, round answers key) to the list of answers
+        self._buffer = {}
+        self._is_flush_scheduled = False
+
+    def add(self, room_name, round_answer_key, username, answer):
+        """
+        Registers a player's answer.
+
+        Arguments:
+            room_name - (str) player's game room name.
+            round_answer_key - (str) redis hash map key of the round, where the answer is to be registered.
+            username - (str) player's name.
+            answer - (str) player's answer.
+
+        Returns:
+            None
+        """
+        if is_show_room(room_name):
+            # The answers to a show never leave the server instance of the player (see game/shows.py)
+            status = self.show_registry.submit_answer(room_name, round_answer_key, username, answer) \
+                if self.show_registry is not None else 0
+            self._log_status(status, room_name, username, answer)
+            return
+        game = self.game_factory.games.get(room_name)
+        if game is not None:
+            self._log_status(game.submit_answer(round_answer_key, username, answer), room_name, username, answer)
+            return
+        self._buffer.setdefault((room_name, round_answer_key), []).extend(
+            (username, answer, int(time.time() * 1000)))
+        if not self._is_flush_scheduled:
+            self._is_flush_scheduled = True
+            task_pools.spawn_after(self.flush_interval, self.flush)
+
+    def flush(self):
+        """
+        Registers all the buffered answers in redis in one pipelined round trip.
+
+        Returns:
+            None
+        """
+        buffer, self._buffer = self._buffer, {}
+        self._is_flush_scheduled = False
+        if not buffer:
+            return
+        pipe = self.redis_client.pipeline(transaction=False)
+        for (room_name, round_answer_key), answers in buffer.items():
+            self._report_answers_script(keys=[room_name, round_answer_key, f"{round_answer_key}-DEADLINE",
+                                              f"{round_answer_key}-STATS"], args=answers, client=pipe)
+        with metrics.REDIS_LATENCY.time(site="answer_flush"):
+            statuses_list = pipe.execute()
+        for ((room_name, _), answers), statuses in zip(buffer.items(), statuses_list):
+            for i, status in enumerate(statuses):
+                self._log_status(status, room_name, answers[3 * i], answers[3 * i + 1])
+
+    def _log_status(self, status, room_name, username, answer):
+        """
+        Reports an answer which has not been registered.
+        """
+        if status == 0:
+            self.logger.error(f"Unauthorized player attempted to submit an answer, room: {room_name}, username: "
+                              f"{username}, answer: {answer}")
+        elif status < 0:
+            self.logger.info(f"Player's answer arrived after the round was closed, room: {room_name}, username: "
+                             f"{username}, answer: {answer}")
+        elif status == 2:
+            self.logger.info(f"Player attempted to change the answer, room: {room_name}, username: {username}, "
+                             f"answer: {answer}")
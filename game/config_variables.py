@@ -1,11 +1,112 @@
 import os
 
 # Configure redis
-REDIS_CHANNEL_NAME = "hq_trivia"
+REDIS_CHANNEL_NAME = "hq_trivia"  # control channel, the messages of every room go to "<channel>:<room name>"
 REDIS_URL = os.environ.get("REDIS_URL")
 
 # Redis key names shared between server instances
-NEXT_GAME_ROOM = "next_game_room"  # this key's redis value defines the room_name where the next game will be played
-NEXT_GAME_SERVER = "next_game_server"  # this key's redis value defines the server instance that will run the next game (if any)
+OPEN_ROOMS = "open_game_rooms"  # this key's redis value (sorted set) has the rooms accepting players by their creation time
+INSTANCE_HEARTBEATS = "instance_heartbeats"  # this key's redis value (sorted set) has the server instances by their latest heartbeat time
+INSTANCE_LOADS = "instance_loads"  # this key's redis value (sorted set) has the server instances by their load score
+ACTIVE_GAMES = "active_games"  # this key's redis value (sorted set) has the rooms with running games by their start time
+OPEN_SHOWS = "open_shows"  # this key's redis value (sorted set) has the shows accepting players by their start time
+INSTANCE_INFO = "instance_info"  # this key's redis value (hash map) has the load details of every server instance
 NORMAL_QUESTIONS = "questions_normal"
 FINAL_QUESTIONS = "questions_final"
+QUESTIONS_VERSION = "questions_version"  # this key's redis value changes every time the questions are reloaded
+QUESTIONS_SOURCE_HASH = "questions_source_hash"  # content hash of the question file loaded the latest
+
+# Configure the server instance start up (Startup)
+STARTUP_RETRY_INTERVAL = 2  # time in seconds before a failed start up phase is retried
+
+# Configure room fan-out (RedisSubscriptionService)
+SUBSCRIPTION_BATCH_SIZE = 256  # maximum number of pubsub messages dispatched at once
+SUBSCRIPTION_SLOW_BATCH = 0.5  # batch delivery time in seconds, which is reported as slow
+
+# Configure room event streams and session resumption
+ROOM_EVENTS_MAXLEN = 256  # approximate number of the latest messages kept in the event stream of a room
+ROOM_EVENTS_TTL = 600  # time in seconds an event stream is kept after its latest message
+RESUME_MAX_EVENTS = 256  # maximum number of missed messages replayed to a client which resumes its session
+DISCONNECT_GRACE = 10  # time in seconds a disconnected player can resume the session before leaving the game
+SESSION_SECRET = os.environ.get("SESSION_SECRET") or os.urandom(32).hex()  # key of the session tokens, random for every process if it is not set
+
+# Configure player updates
+PLAYERS_UPDATE_FLUSH_DELAY = 0.2  # time in seconds for collecting the players who joined or left before publishing them at once
+REGISTRY_SWEEP_INTERVAL = 30  # time in seconds between the sweeps of the players gone without a disconnect
+REGISTRY_SWEEP_BATCH_SIZE = 1000  # number of players checked by a sweep before yielding to the other greenlets
+
+# Configure the question bank
+QUESTIONS_SYNC_INTERVAL = 60  # time in seconds between the question bank version checks
+QUESTIONS_LOAD_CHUNK = 1000  # number of questions written to redis in one pipelined round trip
+DECK_POOL_MIN = 2  # minimum number of question decks kept ready for the new games
+DECK_POOL_MAX = 50  # maximum number of question decks kept ready for the new games
+DECK_LEAD_TIME = 30  # time in seconds of the game starts the question decks are kept ready for
+DECK_RATE_INTERVAL = 10  # time in seconds between the game start rate estimates
+DECK_RATE_SMOOTHING = 0.3  # weight of the latest game start rate estimate in the smoothed rate
+DECK_REFILL_INTERVAL = 1  # time in seconds between the checks of a full question deck pool
+
+# Configure game scheduling across server instances (InstanceScheduler)
+MAX_ROOM_PLAYERS = 1000  # maximum number of players in a room
+MAX_OPEN_ROOMS = 10  # maximum number of rooms accepting players at the same time
+HEARTBEAT_INTERVAL = 2  # time in seconds between the server instance load updates
+HEARTBEAT_TTL = 10  # time in seconds after which a server instance without heartbeats is considered dead
+LOOP_LAG_INTERVAL = 0.5  # time in seconds between the event loop lag measurements
+ASSIGNED_GAMES_TIMEOUT = 5  # time in seconds of a blocking wait for the games assigned by other server instances
+LOAD_GAME_WEIGHT = 100  # load score of a game, in connected sockets
+LOAD_LAG_WEIGHT = 10000  # load score of a second of event loop lag, in connected sockets
+
+# Configure the live shows (game/shows.py)
+SHOW_ROOM_PREFIX = "show-"  # name prefix of the show rooms, the players of a show are sharded across server instances
+SHOW_GAME_TIMER = 60  # time in seconds for joining a show, unless it is given when the show is created
+SHOW_REPORT_POLL = 0.02  # time in seconds between the checks whether all the shards have reported the round answers
+SHOW_REPORT_TIMEOUT = 1  # time in seconds after the round deadline the round is closed even if some shards have not reported
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN")  # token required by the admin endpoints, they are disabled if it is not set
+
+# Configure game failover (GameSupervisor)
+GAME_LEASE_TTL = 15  # time in seconds after which a game without lease renewals is taken over by another server instance
+GAME_LEASE_INTERVAL = 5  # time in seconds between the game lease renewals
+SWEEP_INTERVAL = 30  # time in seconds between the searches for orphaned games and redis keys
+
+# Configure game timing (DeadlineScheduler)
+GAME_TIMER = float(os.environ.get("GAME_TIMER", 10))  # time in seconds for joining a game by other players
+ROUND_TIMER = float(os.environ.get("ROUND_TIMER", 10))  # time in seconds for answering a question in each round
+GAME_READY_DELAY = float(os.environ.get("GAME_READY_DELAY", 2))  # time in seconds between closing a game for new players and its first round
+ROUND_BREAK = float(os.environ.get("ROUND_BREAK", 10))  # time in seconds between the end of a round and the next round
+
+# Configure answer collection (AnswerBuffer)
+ANSWER_FLUSH_INTERVAL = 0.05  # time in seconds for buffering answers to the games on other server instances before flushing them to redis
+ANSWER_COLLECT_GRACE = 0.25  # time in seconds after the round deadline for the buffered answers to reach redis before the round is scored
+ROUND_PROGRESS_INTERVAL = 1  # time in seconds between the live answer distribution updates of an open round
+
+# Configure redis connection pools (RedisLayer)
+REDIS_POOLS = {  # role: (maximum number of connections, time in seconds to wait for a free connection, socket timeout in seconds)
+    "hot": (64, 2, 2),  # player registration, answers and player updates
+    "game": (32, 5, 5),  # game rounds
+    "background": (8, 10, 15),  # question bank, instance scheduling and game failover, the socket timeout is longer than the blocking reads
+    "pubsub": (2, 10, None),  # room subscriptions, a subscription waits for messages with no timeout
+}
+REDIS_CONNECT_TIMEOUT = 2  # time in seconds for connecting to redis
+REDIS_RETRY_ATTEMPTS = 3  # maximum number of attempts to execute a command if the connection fails
+REDIS_RETRY_BACKOFF = 0.05  # time in seconds before the first retry of a command, it doubles with every next retry
+
+# Configure the page and static file serving (StaticCache)
+STATIC_MAX_AGE = 31536000  # time in seconds the browsers cache a static file requested by its versioned URL
+STATIC_COMPRESS_MIN_SIZE = 256  # minimum size in bytes of an asset to be stored compressed
+
+# Configure the sampling profiler (SamplingProfiler)
+PROFILER_TOKEN = os.environ.get("PROFILER_TOKEN")  # token required by the profiler endpoints, they are disabled if it is not set
+PROFILER_OUTPUT_DIR = os.environ.get("PROFILER_OUTPUT_DIR", "profiles")  # local directory the profiles are written to
+PROFILER_INTERVAL = 0.005  # time in seconds between the stack samples
+PROFILER_MAX_DEPTH = 128  # maximum number of frames kept of a sampled stack
+PROFILER_DEFAULT_DURATION = 30  # time in seconds of a capture, unless it is given when the capture is started
+PROFILER_MAX_DURATION = 600  # maximum time in seconds of a capture
+
+# Configure task pools (TaskPools), work is spawned in the pool of its subsystem
+TASK_POOLS = {  # pool name: (maximum number of tasks running concurrently, maximum number of tasks waiting for a free slot)
+    "registration": (128, 512),  # player registrations in progress, more players are turned away as the server is busy
+    "fanout": (64, 256),  # rooms being sent to concurrently
+    "timers": (1000, 1000),  # game phase callbacks
+    "game_io": (256, 1024),  # game publishes, eliminations and player reads
+    "game_start": (32, 128),  # games being created or resumed
+    "questions": (16, 64),  # question refills of the games
+}
@@ -0,0 +1,191 @@
+import json
+from redis.client import Script
+from socketio import packet
+
+import game.config_variables as conf
+
+try:
+    import msgpack
+except ImportError:  # msgpack is optional, all the clients get JSON without it
+    msgpack = None
+
+
+JSON_ENCODING = "json"
+MSGPACK_ENCODING = "msgpack"
+# Encodings the server can send the game messages in, the most compact first
+SUPPORTED_ENCODINGS = (MSGPACK_ENCODING, JSON_ENCODING) if msgpack is not None else (JSON_ENCODING,)
+# Encodings which clients receive in their own socket.io rooms (see get_room), JSON clients join the game room itself
+BINARY_ENCODINGS = tuple(encoding for encoding in SUPPORTED_ENCODINGS if encoding != JSON_ENCODING)
+# Separates the destination room name from the message in the published envelopes (see publish)
+ENVELOPE_SEPARATOR = "\n"
+# Socket.IO event name of all the game messages
+EVENT_NAME = "message"
+
+# Appends a game message to the event stream of its room and publishes it to the room channel (see publish):
+#   KEYS[1] - room event stream;
+#   ARGV[1] - room channel, ARGV[2] - room name, ARGV[3] - JSON message, ARGV[4] - approximate maximum number of events
+#   kept in the stream, ARGV[5] - time in seconds the stream is kept after its latest event.
+# The published message gets the stream entry id as its sequence number ("seq", the last key, so the message still
+# starts with its type). Returns the stream entry id.
+PUBLISH_EVENT_SCRIPT = """
+local seq = redis.call('XADD', KEYS[1], 'MAXLEN', '~', ARGV[4], '*', 'msg', ARGV[3])
+redis.call('EXPIRE', KEYS[1], ARGV[5])
+redis.call('PUBLISH', ARGV[1], ARGV[2] .. '\\n' .. string.sub(ARGV[3], 1, -2) .. ',"seq":"' .. seq .. '"}')
+return seq
+"""
+# The script runs on any client or pipeline it is given (see publish)
+_publish_event_script = Script(None, PUBLISH_EVENT_SCRIPT.encode())
+
+
+def dumps(obj):
+    """
+    Serializes a message to a compact JSON string (no whitespace), as it is published to redis.
+    """
+    return json.dumps(obj, separators=(",", ":"))
+
+
+def get_room_channel(channel_name, room_name):
+    """
+    Returns the redis channel of the room messages, only the server instances with clients in the room subscribe to it.
+    """
+    return f"{channel_name}:{room_name}"
+
+
+def get_events_key(room_name):
+    """
+    Returns the redis stream of the room messages, the clients which reconnect catch up from it (see read_events).
+    """
+    return f"{room_name}-EVENTS"
+
+
+def add_seq(msg_str, seq):
+    """
+    Adds the sequence number (stream entry id) to a JSON message as its last key, as PUBLISH_EVENT_SCRIPT does.
+    """
+    return f'{msg_str[:-1]},"seq":"{seq}"}}'
+
+
+def publish(redis_client, channel_name, room_name, msg):
+    """
+    Publishes a game message to the room channel and appends it to the room event stream, in one round trip. The
+    message is serialized only once: the room name is put in front of the JSON message, so the subscribers route the
+    message and pass it on to the clients without parsing it.
+
+    Arguments:
+        redis_client - (obj) redis client or pipeline.
+        channel_name - (str) redis channel the game messages are published to, the message goes to its room channel.
+        room_name - (str) intended destination.
+        msg - (dict) includes "type" and possibly some other game related keys.
+
+    Returns:
+        None
+    """
+    assert "type" in msg, f"Every published message should have at least 'type' keys but this does not, message: {msg}"
+    _publish_event_script(keys=[get_events_key(room_name)],
+                          args=[get_room_channel(channel_name, room_name), room_name, dumps(msg),
+                                conf.ROOM_EVENTS_MAXLEN, conf.ROOM_EVENTS_TTL],
+                          client=redis_client)
+
+
+def read_events(redis_client, room_name, last_seq, count):
+    """
+    Reads the room messages published after the one with the sequence number from the room event stream.
+
+    Arguments:
+        redis_client - (obj) redis client.
+        room_name - (str) the game room name.
+        last_seq - (str) sequence number of the latest message the client has received, None if it has received
+            none (all the messages in the stream are read).
+        count - (int) maximum number of messages to be read.
+
+    Returns:
+        msg_strs - (list) JSON messages with their sequence numbers, in the order they were published.
+        is_complete - (bool) False if the client has missed more messages than the stream keeps (or than the count),
+            so it cannot catch up.
+    """
+    # One more message than the count is read to know if there are more, along with the latest received one
+    entries = redis_client.xrange(get_events_key(room_name), min=last_seq or "-", max="+",
+                                  count=count + 1 if last_seq is None else count + 2)
+    if last_seq is not None:
+        if not entries or entries[0][0] != last_seq:
+            # The message with the sequence number is not in the stream anymore
+            return [], False
+        entries = entries[1:]
+    return [add_seq(fields["msg"], seq) for seq, fields in entries[:count]], len(entries) <= count
+
+
+def open_envelope(envelope):
+    """
+    Splits a published envelope (see publish).
+
+    Returns:
+        room_name - (str) intended destination, None if the envelope is malformed.
+        msg_str - (str) JSON message.
+    """
+    room_name, separator, msg_str = envelope.partition(ENVELOPE_SEPARATOR)
+    if not separator or not room_name or not msg_str.startswith("{"):
+        return None, envelope
+    return room_name, msg_str
+
+
+def encode_json_packet(msg_strs):
+    """
+    Builds the Socket.IO event packet for the JSON messages to a room, several messages are wrapped in a message of
+    type "batch". The JSON messages are pasted in as they are, which gives the same packet as Socket.IO encoding the
+    parsed messages.
+
+    Arguments:
+        msg_strs - (list) JSON messages, in the order they were published.
+
+    Returns:
+        encoded_packet - (str) packet to be sent to every client in the room.
+    """
+    msg_str = msg_strs[0] if len(msg_strs) == 1 else '{"type":"batch","messages":[' + ",".join(msg_strs) + "]}"
+    return f'{packet.EVENT}["{EVENT_NAME}",{msg_str}]'
+
+
+def encode_binary_packets(msg_strs, encoding):
+    """
+    Builds the Socket.IO binary event packets for the messages to a room in a binary encoding (see
+    encode_json_packet).
+
+    Returns:
+        encoded_packets - (list) the packet header (str) followed by its binary attachments (bytes), all to be sent to
+            every client in the room.
+    """
+    msgs = [json.loads(msg_str) for msg_str in msg_strs]
+    msg = msgs[0] if len(msgs) == 1 else {"type": "batch", "messages": msgs}
+    return packet.Packet(packet.EVENT, data=[EVENT_NAME, encode(msg, encoding)], namespace="/").encode()
+
+
+def negotiate_encoding(requested):
+    """
+    Picks the encoding of the game messages for a client.
+
+    Arguments:
+        requested - (list) encodings the client can decode, in the order of its preference.
+
+    Returns:
+        encoding - (str) the first requested encoding supported by the server, JSON if there is none.
+    """
+    if isinstance(requested, list):
+        for encoding in requested:
+            if encoding in SUPPORTED_ENCODINGS:
+                return encoding
+    return JSON_ENCODING
+
+
+def get_room(room_name, encoding):
+    """
+    Returns the socket.io room of the game room clients that receive the game messages in the encoding.
+    """
+    return room_name if encoding == JSON_ENCODING else f"{room_name}:{encoding}"
+
+
+def encode(msg, encoding):
+    """
+    Encodes a message (dict) to be sent to socket.io clients in a binary encoding.
+    """
+    if encoding == MSGPACK_ENCODING:
+        return msgpack.packb(msg, use_bin_type=True)
+    raise ValueError(f"Unsupported binary encoding: {encoding}")
@@ -0,0 +1,209 @@
+import eventlet
+
+import game.config_variables as conf
+import game.metrics as metrics
+from game.tasks import task_pools
+from game.modules import is_show_room
+
+
+# Renews the leases of the games which are still owned by the server instance (see GameSupervisor.renew_leases):
+#   KEYS - game lease keys;
+#   ARGV[1] - name of the server instance, ARGV[2] - lease time to live in seconds.
+# Returns the list of 1 (renewed) or 0 (lost) for every lease.
+RENEW_LEASES_SCRIPT = """
+local renewed = {}
+for i, lease_key in ipairs(KEYS) do
+    if redis.call('GET', lease_key) == ARGV[1] then
+        redis.call('EXPIRE', lease_key, ARGV[2])
+        renewed[i] = 1
+    else
+        renewed[i] = 0
+    end
+end
+return renewed
+"""
+
+
+class GameSupervisor:
+    """
+    A thread-like object, that keeps the leases of the games run by this server instance, resumes the games of the
+    server instances which died (their leases expired) from their latest checkpoints and garbage-collects orphaned room
+    and answer keys in redis (when started). *This is a singleton.
+    """
+    _singleton = None
+
+    def __new__(cls, *args, **kwargs):
+        """
+        Assures that class follows the singleton patter.
+        """
+        assert cls._singleton is None, "This class instance reinitialization is not expected"
+        if not cls._singleton:
+            cls._singleton = super(GameSupervisor, cls).__new__(cls)
+        return cls._singleton
+
+    def __init__(self, server_name, redis_client, game_factory, scheduler, logger):
+        """
+        Arguments:
+             server_name - (str) name of the server instance that runs this code.
+             redis_client - (obj) redis client for the game leases and the clean up.
+             game_factory - (GameFactory) runs the games on this server instance.
+             scheduler - (InstanceScheduler) knows the live server instances.
+             logger - (obj) app logger.
+        """
+        self.server_name = server_name
+        self.redis_client = redis_client
+        self.game_factory = game_factory
+        self.scheduler = scheduler
+        self.logger = logger
+        self._renew_leases_script = self.redis_client.register_script(RENEW_LEASES_SCRIPT)
+
+    def renew_leases(self):
+        """
+        Renews the leases of the games run by this server instance. A game which lease has been taken over by another
+        server instance is stopped.
+        """
+        games = list(self.game_factory.games.values())
+        if not games:
+            return
+        with metrics.REDIS_LATENCY.time(site="lease_renewal"):
+            renewed = self._renew_leases_script(keys=[game.lease_key for game in games],
+                                                args=[self.server_name, conf.GAME_LEASE_TTL])
+        for game, is_renewed in zip(games, renewed):
+            if not is_renewed:
+                game.is_stopped = True
+
+    def take_over(self, room_name):
+        """
+        Resumes the game in the room on this server instance if its lease can be acquired. The game is finished (its
+        keys are removed) if there is nothing to resume.
+
+        Arguments:
+            room_name - (str) the game room name.
+
+        Returns:
+            is_resumed - (bool) whether the game is resumed on this server instance.
+        """
+        if not self.redis_client.set(f"{room_name}-LEASE", self.server_name, nx=True, ex=conf.GAME_LEASE_TTL):
+            # Another server instance has been faster
+            return False
+        pipe = self.redis_client.pipeline(transaction=False)
+        pipe.hgetall(f"{room_name}-STATE")
+        # The players of a show are in its shards, the show is resumed if anyone has joined it
+        pipe.scard(f"{room_name}-NAMES" if is_show_room(room_name) else room_name)
+        state, players_cnt = pipe.execute()
+        if not state or players_cnt == 0:
+            self.logger.warning(f"Game in {room_name} lost its server instance and has nothing to resume")
+            self.remove_game(room_name)
+            return False
+        self.logger.warning(f"Game in {room_name} lost its server instance {state.get('server_name')}, it is taken "
+                            f"over by {self.server_name} after round {state['round_cnt']}")
+        self.redis_client.set(f"{room_name}-SERVER", self.server_name)
+        task_pools["game_start"].spawn(self.game_factory.create_new_game, room_name, state)
+        return True
+
+    def remove_game(self, room_name):
+        """
+        Removes all the game records of the room from redis.
+        """
+        pipe = self.redis_client.pipeline(transaction=True)
+        pipe.delete(room_name, f"{room_name}-SERVER", f"{room_name}-STATE", f"{room_name}-LEASE")
+        pipe.zrem(conf.ACTIVE_GAMES, room_name)
+        pipe.zrem(conf.OPEN_ROOMS, room_name)
+        if is_show_room(room_name):
+            server_names = self.redis_client.smembers(f"{room_name}-SHARDS")
+            pipe.delete(f"{room_name}-NAMES", f"{room_name}-SHARDS",
+                        *(f"{room_name}-SHARD-{server_name}" for server_name in server_names))
+            pipe.zrem(conf.OPEN_SHOWS, room_name)
+        pipe.execute()
+
+    def sweep(self):
+        """
+        Takes over the active games which leases have expired and removes the orphaned keys: answers and states of the
+        rooms with no active games, room sets which are neither open nor assigned to a server instance and game host
+        records of the server instances which died before starting the game.
+        """
+        active_games = self.redis_client.zrange(conf.ACTIVE_GAMES, 0, -1)
+        if active_games:
+            pipe = self.redis_client.pipeline(transaction=False)
+            for room_name in active_games:
+                pipe.exists(f"{room_name}-LEASE")
+            for room_name, has_lease in zip(active_games, pipe.execute()):
+                if not has_lease:
+                    self.take_over(room_name)
+
+        keys = list(self.redis_client.scan_iter(match="room-*", count=1000))
+        # The open rooms and the active games are read after the scan, so a room opened or a game started while the
+        # scan runs is not taken for an orphan
+        pipe = self.redis_client.pipeline(transaction=True)
+        pipe.zrange(conf.ACTIVE_GAMES, 0, -1)
+        pipe.zrange(conf.OPEN_ROOMS, 0, -1)
+        active_games, open_rooms = map(set, pipe.execute())
+        room_keys = set()
+        orphaned_keys = []
+        game_hosts = {}
+        for key in keys:
+            if "-ROUND-" in key:
+                if key.split("-ROUND-")[0] not in active_games:
+                    orphaned_keys.append(key)
+            elif key.endswith("-STATE") or key.endswith("-LEASE"):
+                if key.rsplit("-", 1)[0] not in active_games:
+                    orphaned_keys.append(key)
+            elif key.endswith("-SERVER"):
+                game_hosts[key.rsplit("-", 1)[0]] = key
+            elif key.endswith("-EVENTS"):
+                # The event streams expire on their own, the clients of an ended game might still catch up from them
+                continue
+            else:
+                room_keys.add(key)
+
+        for room_name in room_keys:
+            if room_name not in open_rooms and room_name not in active_games and room_name not in game_hosts:
+                orphaned_keys.append(room_name)
+        # A game assigned to a server instance which died before starting it
+        for room_name, game_host_key in game_hosts.items():
+            if room_name not in active_games and room_name not in open_rooms:
+                game_host = self.redis_client.get(game_host_key)
+                if game_host is None or game_host in self.scheduler.instance_loads:
+                    continue
+                if not self.redis_client.scard(room_name):
+                    orphaned_keys.append(game_host_key)
+                elif self.redis_client.set(f"{room_name}-LEASE", self.server_name, nx=True, ex=conf.GAME_LEASE_TTL):
+                    self.logger.warning(f"Game in {room_name} was assigned to {game_host} which is not alive, it is "
+                                        f"started by {self.server_name}")
+                    self.redis_client.set(game_host_key, self.server_name)
+                    task_pools["game_start"].spawn(self.game_factory.create_new_game, room_name)
+
+        if orphaned_keys:
+            self.logger.info(f"Removing {len(orphaned_keys)} orphaned game keys")
+            self.redis_client.delete(*orphaned_keys)
+
+    def _run_leases(self):
+        """
+        Renews the game leases until the process ends.
+        """
+        while True:
+            try:
+                self.renew_leases()
+            except Exception as e:
+                self.logger.error(f"Game lease renewal failed: {e}")
+            eventlet.sleep(conf.GAME_LEASE_INTERVAL)
+
+    def _run_sweeper(self):
+        """
+        Sweeps redis until the process ends.
+        """
+        while True:
+            eventlet.sleep(conf.SWEEP_INTERVAL)
+            try:
+                # A sweep is a scan and a number of round trips, it has its own histogram
+                with metrics.GAME_SWEEP_LATENCY.time():
+                    self.sweep()
+            except Exception as e:
+                self.logger.error(f"Game sweep failed: {e}")
+
+    def start(self):
+        """
+        Maintains the game leases and sweeps redis in the background.
+        """
+        task_pools.spawn(self._run_leases)
+        task_pools.spawn(self._run_sweeper)
@@ -0,0 +1,218 @@
+import math
+import time
+from contextlib import contextmanager
+
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class MetricsRegistry:
+    """
+    Keeps the metrics of the server instance and exposes them in the Prometheus text format.
+    """
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+
+    def expose(self):
+        """
+        Returns the current values of all the metrics in the Prometheus text exposition format (str).
+        """
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.metric_type}")
+            for suffix, labels, value in metric.collect():
+                lines.append(f"{metric.name}{suffix}{_format_labels(labels)} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    pairs = ",".join(f'{name}="{_escape(value)}"' for name, value in labels)
+    return "{" + pairs + "}"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value))
+
+
+class _Metric:
+    """
+    A metric with optional labels. Instead of being updated, its values can be read at exposition time from a
+    function (see set_function).
+    """
+    metric_type = "untyped"
+
+    def __init__(self, name, documentation, labelnames=(), metrics_registry=None):
+        """
+        Arguments:
+            name - (str) metric name.
+            documentation - (str) metric description.
+            labelnames - (tuple) names of the metric labels.
+            metrics_registry - (MetricsRegistry) where the metric is exposed, the process registry by default.
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}  # Label values (tuple) to the metric value
+        self._function = None
+        (registry if metrics_registry is None else metrics_registry).register(self)
+
+    def _get_key(self, labels):
+        assert set(labels) == set(self.labelnames), f"{self.name} expects labels {self.labelnames}, got {labels}"
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def set_function(self, function):
+        """
+        Reads the metric values from the function at exposition time. The function returns the value of a metric
+        without labels, or a dict of the label values (tuple) to the value.
+        """
+        self._function = function
+
+    def collect(self):
+        """
+        Returns the samples of the metric as (name suffix, labels, value).
+        """
+        values = self._values
+        if self._function is not None:
+            values = self._function()
+            if not isinstance(values, dict):
+                values = {(): values}
+        return [("", tuple(zip(self.labelnames, key)), value) for key, value in values.items()]
+
+
+class Counter(_Metric):
+    """
+    A value which only goes up.
+    """
+    metric_type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._get_key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    """
+    A value which goes up and down.
+    """
+    metric_type = "gauge"
+
+    def set(self, value, **labels):
+        self._values[self._get_key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._get_key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(_Metric):
+    """
+    Distribution of observed values (e.g. latencies in seconds) in cumulative buckets.
+    """
+    metric_type = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), metrics_registry=None, buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames, metrics_registry)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value, **labels):
+        key = self._get_key(labels)
+        series = self._values.get(key)
+        if series is None:
+            # Bucket counts, sum and count
+            series = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[0][i] += 1
+                break
+        series[1] += value
+        series[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """
+        Observes the time in seconds spent in the with block (or in the function, if used as a decorator).
+        """
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - started, **labels)
+
+    def collect(self):
+        samples = []
+        for key, (bucket_counts, total, count) in self._values.items():
+            labels = tuple(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, bucket_counts):
+                cumulative += bucket_count
+                samples.append(("_bucket", labels + (("le", _format_value(bound)),), cumulative))
+            samples.append(("_sum", labels, total))
+            samples.append(("_count", labels, count))
+        return samples
+
+
+# Server instance
+CONNECTED_SOCKETS = Gauge("hq_connected_sockets", "Socket.IO clients connected to this server instance")
+REGISTERED_PLAYERS = Gauge("hq_registered_players", "Players registered to games on this server instance")
+LOCAL_ROOMS = Gauge("hq_local_rooms", "Game rooms with players on this server instance")
+ROOM_PLAYERS = Gauge("hq_room_players", "Players on this server instance in every game room", ["room"])
+ACTIVE_GAMES = Gauge("hq_active_games", "Games run by this server instance")
+GREENLETS = Gauge("hq_greenlets", "Greenlets alive running the tasks and the background services")
+EVENT_LOOP_LAG = Gauge("hq_event_loop_lag_seconds", "Smoothed lateness of the event loop")
+TIMER_JITTER = Gauge("hq_timer_jitter_seconds", "Lateness of the latest game phase callback")
+SERVER_READY = Gauge("hq_server_ready", "Whether the server instance is warmed up and takes players")
+STARTUP_PHASE_SECONDS = Gauge("hq_startup_phase_seconds", "Time spent in every start up phase", ["phase"])
+# Player requests
+STATIC_RESPONSES = Counter("hq_static_responses_total", "Pages and static files served from memory by status",
+                           ["status"])
+REGISTRATION_LATENCY = Histogram("hq_registration_seconds", "Time spent handling a player registration")
+ANSWER_LATENCY = Histogram("hq_answer_seconds", "Time spent handling a player answer")
+SESSION_RESUMES = Counter("hq_session_resumes_total", "Sessions resumed by reconnecting players by result", ["result"])
+REPLAYED_MESSAGES = Counter("hq_replayed_messages_total", "Missed messages replayed on registration or resume")
+# Redis
+REDIS_LATENCY = Histogram("hq_redis_command_seconds", "Redis round trip time by call site", ["site"])
+REDIS_POOL_IN_USE = Gauge("hq_redis_pool_connections_in_use", "Redis connections taken from the pool", ["role"])
+REDIS_POOL_WAITING = Gauge("hq_redis_pool_waiting", "Redis commands waiting for a free connection", ["role"])
+REDIS_POOL_WAIT = Counter("hq_redis_pool_wait_seconds_total", "Time spent acquiring redis connections", ["role"])
+REDIS_POOL_EXHAUSTED = Counter("hq_redis_pool_exhausted_total", "Redis commands failed as no connection was freed in "
+                               "time", ["role"])
+REDIS_RETRIES = Counter("hq_redis_retries_total", "Redis commands retried after a connection failure", ["role"])
+# Task pools
+TASK_POOL_RUNNING = Gauge("hq_task_pool_running", "Slots in use in the task pool", ["pool"])
+TASK_POOL_QUEUED = Gauge("hq_task_pool_queued", "Tasks waiting for a free slot in the task pool", ["pool"])
+TASK_POOL_SATURATION = Gauge("hq_task_pool_saturation", "Share of the task pool slots in use", ["pool"])
+TASK_POOL_REJECTED = Counter("hq_task_pool_rejected_total", "Tasks shed as the task pool was saturated", ["pool"])
+# Message fan-out
+DISPATCH_LAG = Histogram("hq_pubsub_dispatch_lag_seconds", "Time a message waits between its receipt from redis and "
+                         "its dispatch to the clients")
+DISPATCH_BATCH_LATENCY = Histogram("hq_pubsub_batch_seconds", "Time spent delivering a batch of messages")
+PUBSUB_QUEUE_DEPTH = Gauge("hq_pubsub_queue_depth", "Messages received from redis and waiting to be dispatched")
+# Game failover
+GAME_SWEEP_LATENCY = Histogram("hq_game_sweep_seconds", "Time spent sweeping redis for the games left by the dead "
+                               "server instances")
+# Questions
+QUESTION_REFILL_LATENCY = Histogram("hq_question_refill_seconds", "Time spent preparing more questions for a game")
+DECK_POOL_READY = Gauge("hq_deck_pool_ready", "Question decks ready for the new games")
+DECK_POOL_TARGET = Gauge("hq_deck_pool_target", "Question decks to be kept ready for the new games")
+DECK_POOL_MISSES = Counter("hq_deck_pool_misses_total", "Games started with no question deck ready")
+QUESTION_UPDATE_LIMIT_EXHAUSTED = Counter("hq_question_update_limit_exhausted_total", "Question refills refused as "
+                                          "the game has reached its update limit")
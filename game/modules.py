@@ -1,12 +1,21 @@
+import re
+import sys
 import time
 import random
 import string
 import json
 from collections import deque
 import eventlet
+import eventlet.queue
 
 import game.config_variables as conf
-from game.questionnaire import QuestionManager
+import game.metrics as metrics
+from game.profiler import profiler
+from game.tasks import task_pools
+from game.questionnaire import QuestionManager, deck_pool
+from game.timers import deadline_scheduler, monotonic2epoch_ms
+from game.encoding import BINARY_ENCODINGS, publish, open_envelope, encode_json_packet, encode_binary_packets, get_room, \
+    get_room_channel
 
 
 class GetNewCode:
@@ -23,13 +32,37 @@ class GetNewCode:
         return f"{cls.cnt:04}-" + ''.join(random.choice(letters) if i != 4 else '-' for i in range(9))
 
 
+def is_show_room(room_name):
+    """
+    Whether the room is a show, a mega-room with its players sharded across server instances (see game/shows.py).
+    """
+    return room_name.startswith(conf.SHOW_ROOM_PREFIX)
+
+
 get_new_code = GetNewCode()
+# Names of the game rooms and shows, made of a code (see GetNewCode)
+ROOM_NAME_PATTERN = re.compile(rf"(room-|{re.escape(conf.SHOW_ROOM_PREFIX)})\d{{4}}-[a-z]{{4}}-[a-z]{{4}}")
+
+
+def is_room_name(name):
+    """
+    Whether the name is a well-formed game room or show name.
+    """
+    return ROOM_NAME_PATTERN.fullmatch(name) is not None
 
 
 class RedisSubscriptionService:
     """
-    A thread-like object, that subscribes to all messages in redis and informs clients in the specified rooms and
-    maintains its subscription in the background (when started). *This is a singleton.
+    A thread-like object, that subscribes to the messages of the rooms with clients on this server instance in redis and
+    informs clients in the specified rooms and maintains its subscription in the background (when started). Every room
+    has its own channel, the service subscribes to it when the first local client joins the room and unsubscribes when
+    the last one leaves (see UserRegistry.add_room_listener), so a server instance handles only the traffic of its own
+    rooms. *This is a singleton.
+
+    Messages are read from the pubsub connection into a queue and dispatched in batches: every batch is grouped by
+    room and each room receives its messages as one coalesced emit, sent from a bounded pool of workers. A message is
+    never parsed on the way: its Socket.IO packet is built from the published JSON once and the same packet is written
+    to every client in the room.
     """
     _singleton = None
 
@@ -42,74 +75,216 @@ class RedisSubscriptionService:
             cls._singleton = super(RedisSubscriptionService, cls).__new__(cls)
         return cls._singleton
 
-    def __init__(self, redis_client, channel_name, socketio, logger):
+    def __init__(self, redis_client, channel_name, socketio, logger, batch_size=None):
         """
         Arguments:
              redis_client - (obj) redis client where the pubssub is to be subscribed to.
-             channel_name - (str) redis channel where the pubssub is to be subscribed to.
-             socketio - (obj) socketio app, required for sending messages to rooms.
+             channel_name - (str) redis channel where the pubssub is to be subscribed to, the room channels are named
+                after it (see game.encoding.get_room_channel).
+             socketio - (obj) socketio app, its server knows the clients in the rooms and sends the packets to them.
              logger - (obj) app logger.
+             batch_size - (int) maximum number of messages dispatched in one batch.
         """
+        self.channel_name = channel_name
         self.pubsub = redis_client.pubsub()
-        self.pubsub.subscribe(channel_name)
         self.socketio = socketio
         self.logger = logger
+        self.batch_size = conf.SUBSCRIPTION_BATCH_SIZE if batch_size is None else batch_size
+        self.msg_q = eventlet.queue.LightQueue()
+        self.send_pool = task_pools["fanout"]
+        self._message_listeners = []
+        # Dispatch statistics
+        self.last_batch_size = 0
+        self.last_batch_latency = 0.0  # Seconds spent delivering the latest batch
+
+    def room_opened(self, room_name):
+        """
+        Subscribes to the messages of a room which got its first client on this server instance.
+        """
+        self.pubsub.subscribe(get_room_channel(self.channel_name, room_name))
+
+    def room_closed(self, room_name):
+        """
+        Unsubscribes from the messages of a room which has no clients on this server instance anymore.
+        """
+        self.pubsub.unsubscribe(get_room_channel(self.channel_name, room_name))
+
+    def add_message_listener(self, listener):
+        """
+        Registers an object with a room_messages(room_name, msg_strs) method, called with the messages (JSON str) of
+        every room before they are sent out. It is called from the dispatch loop, so it must not block.
+        """
+        self._message_listeners.append(listener)
+
+    @property
+    def queue_depth(self):
+        """
+        Number of messages read from redis and waiting to be dispatched.
+        """
+        return self.msg_q.qsize()
 
     def _iter_data(self):
         """
         Returns redis posts of data type "message" when they are published.
 
         Returns:
-            msg_str - (str) a JSON with the message content.
+            envelope - (str) the room name and a JSON with the message content (see game.encoding.publish).
         """
         for post in self.pubsub.listen():
             if post["type"] == "message":
                 msg_str = post.get("data")
                 yield msg_str
 
-    def send(self, msg_str):
+    def _group_by_room(self, envelopes):
         """
-        Sends out the message.
+        Groups a batch of messages by their destination room keeping the publishing order.
 
         Arguments:
-            msg_str - (str) a JSON with the message content. This string should be a JSON string and contain at least
-                two keys "room_name" (intended destination), and "type" (message type)
+            envelopes - (list) published envelopes (see game.encoding.publish).
 
         Returns:
-            None
+            rooms - (dict) room name to the list of the messages (JSON str) to be sent to this room.
         """
-        try:
-            msg = json.loads(msg_str)
-        except json.decoder.JSONDecodeError:
-            self.logger.error(f"Incorrect message format was read: {msg_str}. A correct message should be a "
-                              f"JSON string")
-        else:
-            if "type" in msg and "room_name" in msg:
-                room_name = msg["room_name"]
-                del msg["room_name"]
-                self.socketio.send(msg, room=room_name)
+        rooms = {}
+        for envelope in envelopes:
+            room_name, msg_str = open_envelope(envelope)
+            if room_name is not None:
+                rooms.setdefault(room_name, []).append(msg_str)
             else:
-                self.logger.warning(f"Incorrect message format was read: {msg_str}. A correct message should have "
-                                    f"'room_name' and 'type' keys")
+                self.logger.warning(f"Incorrect message format was read: {envelope}. A correct message should be a "
+                                    f"room name and a JSON string separated by a new line")
+        return rooms
+
+    def _get_participants(self, room_name):
+        """
+        Returns the session ids of the clients connected to this server instance in the socket.io room.
+        """
+        try:
+            return list(self.socketio.server.manager.get_participants("/", room_name))
+        except KeyError:
+            # Nobody has joined the room on this server instance
+            return []
+
+    def send(self, room_name, msg_strs):
+        """
+        Sends out the messages to the room as one packet. Several messages are wrapped in a message of type "batch".
+        The packet is encoded once and written to every client in the room, the clients which negotiated a binary
+        encoding get their own packet, also encoded once for all of them (see game/encoding.py).
+
+        Arguments:
+            room_name - (str) intended destination.
+            msg_strs - (list) messages (JSON str) to be sent, in the order they were published.
+
+        Returns:
+            None
+        """
+        profiler.tag(room_name)
+        eio = self.socketio.server.eio
+        session_ids = self._get_participants(room_name)
+        if session_ids:
+            encoded_packet = encode_json_packet(msg_strs)
+            for session_id in session_ids:
+                eio.send(session_id, encoded_packet, binary=False)
+        for encoding in BINARY_ENCODINGS:
+            session_ids = self._get_participants(get_room(room_name, encoding))
+            if session_ids:
+                encoded_packets = encode_binary_packets(msg_strs, encoding)
+                for session_id in session_ids:
+                    for i, encoded_packet in enumerate(encoded_packets):
+                        # The packet header is followed by its binary attachments
+                        eio.send(session_id, encoded_packet, binary=i > 0)
+
+    def dispatch(self):
+        """
+        Drains the message queue in batches and sends every batch out room by room.
+        """
+        while True:
+            batch = [self.msg_q.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.msg_q.get_nowait())
+                except eventlet.queue.Empty:
+                    break
+            started = time.monotonic()
+            for received, _ in batch:
+                metrics.DISPATCH_LAG.observe(started - received)
+            for room_name, msgs in self._group_by_room([envelope for _, envelope in batch]).items():
+                for listener in self._message_listeners:
+                    listener.room_messages(room_name, msgs)
+                self.send_pool.spawn(self.send, room_name, msgs)
+            self.send_pool.waitall()
+            self.last_batch_size = len(batch)
+            self.last_batch_latency = time.monotonic() - started
+            metrics.DISPATCH_BATCH_LATENCY.observe(self.last_batch_latency)
+            if self.last_batch_latency > conf.SUBSCRIPTION_SLOW_BATCH:
+                self.logger.warning(f"Slow message fan-out: {self.last_batch_size} messages sent in "
+                                    f"{self.last_batch_latency:.3f} sec, {self.queue_depth} messages are waiting")
 
     def run(self):
         """
-        Listens for new messages and sends them to the specified rooms
+        Listens for new messages and queues them up for dispatching along with the time they were received.
         """
-        for msg_str in self._iter_data():
-            eventlet.spawn(self.send, msg_str)
+        for envelope in self._iter_data():
+            self.msg_q.put((time.monotonic(), envelope))
 
     def start(self):
         """
-        Maintains Redis subscription in the background.
+        Subscribes to the control channel and maintains Redis subscription in the background.
+        """
+        self.pubsub.subscribe(self.channel_name)
+        task_pools.spawn(self.dispatch)
+        task_pools.spawn(self.run)
+
+    def send_to_client(self, session_id, msg_strs, encoding):
+        """
+        Sends out the messages to one client as one packet in its encoding (see RedisSubscriptionService.send), e.g.
+        the messages it has missed while reconnecting.
+
+        Arguments:
+            session_id - (str) SID of the client.
+            msg_strs - (list) messages (JSON str) to be sent, in the order they were published.
+            encoding - (str) encoding of the game messages the client has negotiated.
+        """
+        eio = self.socketio.server.eio
+        if encoding in BINARY_ENCODINGS:
+            for i, encoded_packet in enumerate(encode_binary_packets(msg_strs, encoding)):
+                eio.send(session_id, encoded_packet, binary=i > 0)
+        else:
+            eio.send(session_id, encode_json_packet(msg_strs), binary=False)
+
+
+class PlayerRecord:
+    """
+    Registration of a client in a game room. The records are slotted, as there is one for every connected player.
+    """
+    __slots__ = ("username", "room_name")
+
+    def __init__(self, username, room_name):
         """
-        eventlet.spawn(self.run)
+        Arguments:
+            username - (str) player's name.
+            room_name - (str) game room of the player, it is interned, so all the records of a room share one string.
+        """
+        self.username = username
+        self.room_name = sys.intern(room_name)
 
 
 class UserRegistry(dict):
     """
-    A dictionary-like data structure that registers clients by session id (SID) and publishes the updates via the
-    specified redis_pubsub client. *This is a singleton.
+    A dictionary-like data structure that registers clients by session id (SID) to their PlayerRecord and publishes the
+    updates via the specified redis_pubsub client. It keeps an index of the SIDs in every room with clients on this
+    server instance and informs the room listeners when a room gets its first client or loses its last one. *This is a
+    singleton.
+
+    The player updates are buffered and published in one pipelined round trip (see UserRegistry._flush_updates), and the
+    records of the clients which are gone without a disconnect are swept in batches (see UserRegistry.sweep), so no
+    greenlet is spawned per client. A registered player takes about 135 bytes on CPython 3.8 (the record, and the
+    registry and room index entries; see tests/benchmark_registry.py) next to its SID and username strings, down from
+    about 350 bytes with a dict per player.
+
+    A client which disconnects keeps its record for a grace period, so the player can resume the session after a
+    network blip without the other players being told (see UserRegistry.disconnect). The player can also resume it
+    from a new connection before the server notices that the old one is gone (see UserRegistry.resume).
     """
     _singleton = None
 
@@ -122,51 +297,283 @@ class UserRegistry(dict):
             cls._singleton = super(UserRegistry, cls).__new__(cls)
         return cls._singleton
 
-    def __init__(self, redis_client, channel_name, logger):
+    def __init__(self, redis_client, channel_name, logger, flush_delay=None, is_connected=None, sweep_interval=None,
+                 sweep_batch_size=None, disconnect_grace=None):
         """
         Arguments:
-             server_name - (str) name of the server instance that runs this code.
              redis_client - (obj) redis client for publishing updates about the players joining or leaving rooms.
+             channel_name - (str) redis channel the game messages are published to.
              logger - (obj) app logger.
+             flush_delay - (float) time in seconds for collecting the player updates before publishing them at once.
+             is_connected - (function) whether the client with the SID is still connected, the records of the clients
+                which are not are swept (no sweeping if None).
+             sweep_interval - (float) time in seconds between the sweeps of the records of the clients which are gone.
+             sweep_batch_size - (int) number of records checked by a sweep before yielding to the other greenlets.
+             disconnect_grace - (float) time in seconds a disconnected client can resume the session before it is
+                unregistered.
         """
         super().__init__()
         self.redis_client = redis_client
         self.channel_name = channel_name
         self.logger = logger
+        self.flush_delay = conf.PLAYERS_UPDATE_FLUSH_DELAY if flush_delay is None else flush_delay
+        self.is_connected = is_connected
+        self.sweep_interval = conf.REGISTRY_SWEEP_INTERVAL if sweep_interval is None else sweep_interval
+        self.sweep_batch_size = conf.REGISTRY_SWEEP_BATCH_SIZE if sweep_batch_size is None else sweep_batch_size
+        self.disconnect_grace = conf.DISCONNECT_GRACE if disconnect_grace is None else disconnect_grace
+        # Disconnected clients in the grace period, SID to the timer unregistering it
+        self._disconnected = {}
+        # Players who joined or left and are not published yet, they are published in one go (e.g. on a dyno restart)
+        self._joined_buffer = []
+        self._left_buffer = []
+        self._is_flush_scheduled = False
+        # Clients on this server instance in every room, username to SID
+        self.local_rooms = {}
+        self._room_listeners = []
+        self._player_listeners = []
 
-    def __setitem__(self, session_id, user_info):
-        eventlet.spawn(self._publish, "joined", user_info)
-        super().__setitem__(session_id, user_info)
+    def add_room_listener(self, listener):
+        """
+        Registers an object with room_opened(room_name) and room_closed(room_name) methods, called when a room gets its
+        first client on this server instance and when it loses its last one.
+        """
+        self._room_listeners.append(listener)
+        for room_name in self.local_rooms:
+            listener.room_opened(room_name)
+
+    def add_player_listener(self, listener):
+        """
+        Registers an object with a player_left(player) method, called when a client is unregistered.
+        """
+        self._player_listeners.append(listener)
+
+    def get_room_sids(self, room_name):
+        """
+        Returns the SIDs of the clients on this server instance in the room (iterable, empty if there are none).
+        """
+        return self.local_rooms.get(room_name, {}).values()
+
+    def __setitem__(self, session_id, player):
+        if session_id in self:
+            self._leave_room(session_id, self[session_id])
+        # The listeners are informed before anything is published to the room
+        self._enter_room(session_id, player)
+        super().__setitem__(session_id, player)
+        # The players of a show are not broadcast (see game/shows.py)
+        if not is_show_room(player.room_name):
+            self._joined_buffer.append(player)
+            self._schedule_flush()
 
     def __delitem__(self, session_id):
-        eventlet.spawn(self._publish, "left", self.get(session_id).copy())
+        player = self[session_id]
         super().__delitem__(session_id)
+        for listener in self._player_listeners:
+            listener.player_left(player)
+        self._leave_room(session_id, player)
+        if not is_show_room(player.room_name):
+            self._left_buffer.append(player)
+            self._schedule_flush()
 
-    def _publish(self, action_str, user_info):
+    def disconnect(self, session_id):
+        """
+        Unregisters a client which has disconnected when the grace period is over, unless the player resumes the
+        session in the meantime (see UserRegistry.resume).
         """
-        Publishes updates about the players joining or leaving rooms on the specified redis channel.
+        if self.disconnect_grace <= 0:
+            del self[session_id]
+            return
+        self._disconnected[session_id] = deadline_scheduler.call_later(self.disconnect_grace, self._expire,
+                                                                       session_id)
 
-        Arguments:
-           action_str - (str) description of player action 'left' or 'joined';
-           user_info - (dict) includes "room_name" and "username" keys with str values
+    def _expire(self, session_id):
+        """
+        Unregisters a disconnected client which has not resumed the session in the grace period.
+        """
+        if self._disconnected.pop(session_id, None) is None:
+            # The session has been resumed
+            return
+        del self[session_id]
+
+    def resume(self, session_id, username, room_name):
+        """
+        Moves the record of a player to the new SID of the player, nothing is published as the player has never left.
+        The player is either disconnected and in the grace period, or still registered with a connection the server
+        has not noticed to be gone yet (it takes up to the ping timeout), the caller is to close that connection.
+
+        Returns:
+            player - (PlayerRecord) the record of the player, None if there is no session to be resumed or the client
+                with the SID is registered already.
+            replaced_session_id - (str) the old SID of the player if its client is still connected, otherwise None.
+        """
+        old_session_id = self.local_rooms.get(room_name, {}).get(username)
+        if old_session_id is None or session_id in self:
+            return None, None
+        timer = self._disconnected.pop(old_session_id, None)
+        if timer is not None:
+            deadline_scheduler.cancel(timer)
+        player = self[old_session_id]
+        # The new SID takes the place of the old one in the room, so the room is not closed in between
+        self._enter_room(session_id, player)
+        super().__setitem__(session_id, player)
+        super().__delitem__(old_session_id)
+        self._leave_room(old_session_id, player)
+        return player, None if timer is not None else old_session_id
+
+    def _enter_room(self, session_id, player):
+        """
+        Adds a client to the room index, the room listeners are informed if it is the first client on this server
+        instance.
+        """
+        session_ids = self.local_rooms.get(player.room_name)
+        if session_ids is None:
+            session_ids = self.local_rooms[player.room_name] = {}
+            for listener in self._room_listeners:
+                listener.room_opened(player.room_name)
+        session_ids[player.username] = session_id
+
+    def _leave_room(self, session_id, player):
+        """
+        Removes a client from the room index, the room listeners are informed if it was the last client on this server
+        instance.
+        """
+        session_ids = self.local_rooms[player.room_name]
+        # The username is taken over by the new SID of a resumed session
+        if session_ids.get(player.username) == session_id:
+            del session_ids[player.username]
+        if not session_ids:
+            del self.local_rooms[player.room_name]
+            for listener in self._room_listeners:
+                listener.room_closed(player.room_name)
+
+    def _schedule_flush(self):
+        if not self._is_flush_scheduled:
+            self._is_flush_scheduled = True
+            task_pools.spawn_after(self.flush_delay, self._flush_updates)
+
+    def _flush_updates(self):
+        """
+        Publishes all the players who joined since the previous flush (one message per player) and all the players who
+        left (one message per room), and removes the players who left from the room records, with a single pipelined
+        round trip.
 
         Returns:
            None
         """
-        assert "room_name" in user_info and "username" in user_info, \
-            f"Every published message should have at least 'room_name' and 'username'keys but this does not, " \
-            f"message: {user_info}"
-        # Broadcast that the new user has joined/left the group
-        self.redis_client.publish(self.channel_name, json.dumps({
-            "room_name": user_info["room_name"],
-            "type": "players_update",
-            "action": action_str,
-            "username": user_info["username"],
-        }))
-        # Update the room records
-        if action_str == "left":
-            if self.redis_client.exists(user_info["room_name"], user_info["username"]):
-                self.redis_client.srem(user_info["room_name"], user_info["username"])
+        joined_buffer, self._joined_buffer = self._joined_buffer, []
+        left_buffer, self._left_buffer = self._left_buffer, []
+        self._is_flush_scheduled = False
+        rooms = {}
+        for player in left_buffer:
+            rooms.setdefault(player.room_name, []).append(player.username)
+
+        pipe = self.redis_client.pipeline(transaction=False)
+        for player in joined_buffer:
+            # Broadcast that the new user has joined the group
+            publish(pipe, self.channel_name, player.room_name, {
+                "type": "players_update",
+                "action": "joined",
+                "username": player.username,
+            })
+        for room_name, usernames in rooms.items():
+            # Broadcast that the users have left the group
+            publish(pipe, self.channel_name, room_name, {
+                "type": "players_update",
+                "action": "left",
+                "usernames": usernames,
+            })
+            # Update the room records
+            pipe.srem(room_name, *usernames)
+        with metrics.REDIS_LATENCY.time(site="player_update"):
+            pipe.execute()
+
+    def sweep(self):
+        """
+        Unregisters the clients which are gone without a disconnect (as if they disconnected), checking the records in
+        batches.
+
+        Returns:
+            swept_cnt - (int) number of the unregistered clients.
+        """
+        swept_cnt = 0
+        session_ids = list(self)
+        for i in range(0, len(session_ids), self.sweep_batch_size):
+            for session_id in session_ids[i:i + self.sweep_batch_size]:
+                if session_id in self and session_id not in self._disconnected and not self.is_connected(session_id):
+                    del self[session_id]
+                    swept_cnt += 1
+            eventlet.sleep(0)
+        if swept_cnt:
+            self.logger.warning(f"{swept_cnt} players gone without a disconnect are unregistered")
+        return swept_cnt
+
+    def run(self):
+        """
+        Sweeps the records of the clients which are gone at every sweep interval.
+        """
+        while True:
+            eventlet.sleep(self.sweep_interval)
+            try:
+                self.sweep()
+            except Exception as e:
+                self.logger.error(f"Player registry sweep failed: {e}")
+
+    def start(self):
+        """
+        Runs the sweeps in the background (if there is a way to check the clients, see is_connected).
+        """
+        if self.is_connected is not None:
+            task_pools.spawn(self.run)
+
+
+# Registers a player in one round trip (see GameFactory.register_player):
+#   KEYS[1] - OPEN_ROOMS;
+#   ARGV[1] - username, ARGV[2] - room name to be used if a new room is to be opened, ARGV[3] - minimum number of
+#   players, ARGV[4] - maximum number of players in a room, ARGV[5] - maximum number of open rooms, ARGV[6] - name of
+#   the server instance to host a game if it is to be created, ARGV[7] - current time, ARGV[8] - name of the server
+#   instance that runs the script (a game hosted by another server instance is pushed to its '-GAMES' list).
+# Players join the oldest open room which has space and no player with the same name. A new room is opened if there is
+# no such room. A room stops accepting players when it is full or when its game starts (see Game.run).
+# Returns {room_name, status, game_host, is_game_starting, other_players, last_seq}, where status is 1 if the player is
+# registered, 0 if the username is taken and -1 if all the rooms are full, and last_seq is the id of the latest entry
+# in the room event stream (empty if there is none), the messages published after it are replayed to the player.
+REGISTER_PLAYER_SCRIPT = """
+local room_name = false
+local is_name_taken = false
+local open_rooms = redis.call('ZRANGE', KEYS[1], 0, -1)
+for _, room in ipairs(open_rooms) do
+    if redis.call('SISMEMBER', room, ARGV[1]) == 1 then
+        is_name_taken = true
+    elseif redis.call('SCARD', room) < tonumber(ARGV[4]) then
+        room_name = room
+        break
+    end
+end
+if not room_name then
+    if is_name_taken then
+        return {'', 0, '', 0, {}, ''}
+    elseif #open_rooms >= tonumber(ARGV[5]) then
+        return {'', -1, '', 0, {}, ''}
+    end
+    room_name = ARGV[2]
+    redis.call('ZADD', KEYS[1], ARGV[7], room_name)
+end
+local game_host = ''
+local room_server_key = room_name .. '-SERVER'
+if tonumber(ARGV[3]) - redis.call('SCARD', room_name) <= 1 then
+    if redis.call('SET', room_server_key, ARGV[6], 'NX') then
+        game_host = ARGV[6]
+        if game_host ~= ARGV[8] then
+            redis.call('RPUSH', game_host .. '-GAMES', room_name)
+        end
+    end
+end
+local other_players = redis.call('SMEMBERS', room_name)
+if redis.call('SADD', room_name, ARGV[1]) + #other_players >= tonumber(ARGV[4]) then
+    redis.call('ZREM', KEYS[1], room_name)
+end
+local events = redis.call('XREVRANGE', room_name .. '-EVENTS', '+', '-', 'COUNT', 1)
+return {room_name, 1, game_host, redis.call('EXISTS', room_server_key), other_players, events[1] and events[1][1] or ''}
+"""
 
 
 class GameFactory:
@@ -184,7 +591,8 @@ class GameFactory:
             cls._singleton = super(GameFactory, cls).__new__(cls)
         return cls._singleton
 
-    def __init__(self, server_name, redis_client, min_players, channel_name, logger):
+    def __init__(self, server_name, redis_client, min_players, channel_name, logger, scheduler, max_players=None,
+                 max_open_rooms=None, game_redis_client=None):
         """
         Arguments:
              server_name - (str) name of the server instance that runs this code.
@@ -192,17 +600,30 @@ class GameFactory:
              min_players - (int) minimum number of players for the game to start.
              channel_name - (str) redis channel where game instances publish questions to.
              logger - (obj) app logger.
+             scheduler - (InstanceScheduler) picks the server instance to host a new game.
+             max_players - (int) maximum number of players in a room.
+             max_open_rooms - (int) maximum number of rooms accepting players at the same time.
+             game_redis_client - (obj) redis client for running the games, the same as redis_client if not provided.
         """
         self.server_name = server_name
         self.redis_client = redis_client
+        self.game_redis_client = redis_client if game_redis_client is None else game_redis_client
         self.min_players = min_players
         self.channel_name = channel_name
         self.logger = logger
+        self.scheduler = scheduler
+        self.max_players = conf.MAX_ROOM_PLAYERS if max_players is None else max_players
+        self.max_open_rooms = conf.MAX_OPEN_ROOMS if max_open_rooms is None else max_open_rooms
+        # Games run by this server instance, room name to game
+        self.games = {}
+        # Room name prefix to the class of the games in such rooms, other rooms play Game
+        self.game_classes = {}
+        self._register_script = self.redis_client.register_script(REGISTER_PLAYER_SCRIPT)
 
     def register_player(self, username):
         """"
-        Registers a player to the game (next_room_in) in redis. This function launches a new game if the minimum number
-        of players is reached.
+        Registers a player to the oldest open room with space in redis. This function launches a new game on the least
+        loaded server instance if the minimum number of players is reached.
 
         Arguments:
             username - (str) desired username.
@@ -216,58 +637,87 @@ class GameFactory:
             min_players - (int) minimum players to start a new game if there is no conflict with the client name, otherwise 0.
             is_game_starting - (bool) whether a new game was created, this depends on what the player sees when he/she
                 logs in.
-            msg - (json_str) empty if there is no conflict with the username, otherwise a json_str with two attributes
-                where (1) "msg" is a message asking to pick a different name and (2) "type" is "info".
+            msg - (json_str) empty if the player is registered, otherwise a json_str with two attributes where (1) "msg"
+                is a message asking to pick a different name or to try again later and (2) "type" is "info".
+            last_seq - (str) sequence number of the latest message in the room event stream when the player was
+                registered, empty if there is none. The player subscribes to the room after the registration, so the
+                messages published in between are replayed (see game.encoding.read_events).
         """
-        # next_room_in is checked every time because it might be updated by a different server instance. It happens if
-        # a different server has started the previous game, then the player is to be enrolled to the most recent
-        # game room
-        next_room = self._get_next_game_room()
+        # The whole registration runs as one atomic script in redis: the open rooms might be updated by a different
+        # server instance at any moment (e.g. if a different server has started a game) and two servers must not both
+        # decide to run the same game
+        with metrics.REDIS_LATENCY.time(site="register_player"):
+            room_name, status, game_host, is_game_starting, other_players, last_seq = self._register_script(
+                keys=[conf.OPEN_ROOMS],
+                args=[username, "room-" + get_new_code(), self.min_players, self.max_players, self.max_open_rooms,
+                      self.scheduler.pick_host(), time.time(), self.server_name],
+            )
 
-        if self.redis_client.sismember(next_room, username):
+        if status == 0:
             # Client with this name is already registered
             return username, False, set(), self.min_players, False, '{' \
                 '"msg": "This username already exists, please pick a different one", ' \
                 '"type": "info"' \
-                '}'
+                '}', ""
+        elif status < 0:
+            self.logger.warning(f"All {self.max_open_rooms} open rooms are full, player {username} is turned away")
+            return username, False, set(), self.min_players, False, '{' \
+                '"msg": "All game rooms are full at the moment, please try again later", ' \
+                '"type": "info"' \
+                '}', ""
         else:
-            if self.min_players - self.redis_client.scard(next_room) <= 1:
-                # Spawn a new game
-                if self.redis_client.exists(conf.NEXT_GAME_SERVER):
-                    pass
-                else:
-                    # Register this server instance to run the next game
-                    self.redis_client[conf.NEXT_GAME_SERVER] = self.server_name
-                    # Create a new game
-                    eventlet.spawn(self.create_new_game, next_room)
-            other_players = self.redis_client.smembers(next_room)
-            self.redis_client.sadd(next_room, username)
-            return username, next_room, other_players, self.min_players, self.redis_client.exists(conf.NEXT_GAME_SERVER), ""
-
-    def _get_next_game_room(self):
-        """"
-        Gets the room name that will be in play next from redis. Creates a new room name if there is no info about the
-        next room in play.
+            profiler.tag(room_name)
+            if game_host:
+                self.scheduler.add_game(game_host)
+            if game_host == self.server_name:
+                # This server instance is registered to run the game (otherwise, the script has assigned the game to
+                # the least loaded server instance)
+                task_pools["game_start"].spawn(self.create_new_game, room_name)
+            return username, room_name, set(other_players), self.min_players, bool(is_game_starting), "", last_seq
 
-        Returns:
-            room_name - the room that will be in play next.
+    def add_game_class(self, room_prefix, game_class):
         """
-        if self.redis_client.exists(conf.NEXT_GAME_ROOM):
-            pass
-        else:
-            self.redis_client[conf.NEXT_GAME_ROOM] = "room-" + get_new_code()
-        return self.redis_client[conf.NEXT_GAME_ROOM]
+        Registers a subclass of Game which plays the games in the rooms which names start with the prefix.
+        """
+        self.game_classes[room_prefix] = game_class
+
+    def create_new_game(self, room_name, state=None, game_timer=None):
+        """
+        Starts a new game in the room on this server instance.
+
+        Arguments:
+            room_name - (str) the game room name.
+            state - (dict) checkpointed state if the game is resumed after its previous server instance has died.
+            game_timer - (float) available time in seconds for joining the game by the players.
+        """
+        profiler.tag(room_name)
+        game_class = next((game_class for room_prefix, game_class in self.game_classes.items()
+                           if room_name.startswith(room_prefix)), Game)
+        new_game = game_class(room_name, self.game_redis_client, self.channel_name, self.logger, self.server_name,
+                              state)
+        with metrics.REDIS_LATENCY.time(site="create_game"):
+            self.game_redis_client.set(new_game.lease_key, self.server_name, ex=conf.GAME_LEASE_TTL)
+        self.games[room_name] = new_game
+        self.scheduler.active_games = len(self.games)
+        new_game.start(game_timer=game_timer, on_end=lambda: self._remove_game(room_name))
 
-    def create_new_game(self, room_name):
-        new_game = Game(room_name, self.redis_client, self.channel_name, self.logger)
-        new_game.start()
+    def _remove_game(self, room_name):
+        """
+        Forgets the game which has ended or stopped.
+        """
+        self.games.pop(room_name, None)
+        self.scheduler.active_games = len(self.games)
 
 
 class Game:
     """
-    A thread-like object, that plays the game for the registered players.
+    A thread-like object, that plays the game for the registered players. The game phases are callbacks fired by the
+    process deadline scheduler (see DeadlineScheduler), so a game does not hold a greenlet while waiting.
+
+    The game state is checkpointed to redis ("<room_name>-STATE") at every round boundary, so if the server instance
+    running the game dies, another instance can resume the game from the next round (see GameSupervisor).
     """
-    def __init__(self, room_name, redis_client, channel_name, logger):
+    def __init__(self, room_name, redis_client, channel_name, logger, server_name="", state=None):
         """
         Arguments:
             room_name - (str) the game room name, only players who joined this room are in this game. Also, a redis
@@ -276,112 +726,249 @@ class Game:
             redis_client - (obj) redis client for game messages communication.
             channel_name - (str) redis channel the game messages are published to.
             logger - (obj) app logger.
+            server_name - (str) name of the server instance that runs the game.
+            state - (dict) checkpointed state of the game to be resumed (see Game.checkpoint), None for a new game.
         """
         self.room_name = room_name
         self.redis_client = redis_client
         self.channel_name = channel_name
         self.logger = logger
+        self.server_name = server_name
         # Game info
-        self.round_cnt = 0
+        self.round_cnt = 0 if state is None else int(state["round_cnt"])
+        self.round_timer = 0
+        self.next_deadline = 0.0  # time.monotonic() time when the next round opens
+        self.round_deadline = 0.0  # time.monotonic() time when the current round closes
+        self.round_answer_key = None  # Key of the round open for answers
+        # Statistics of the current round answers received by this server instance, kept as the answers arrive
+        self.round_question = None
+        self.option_cnt = {}  # Number of answers for every option
+        self.players_submitted = set()
+        self.players_correct = set()
+        self.progress_published = None  # Option counts in the latest "round_progress" message
+        self.on_end = None
+        self.is_resumed = state is not None
+        self.is_stopped = False  # Set if another server instance has taken the game over
         self.players = set()
-        eventlet.spawn(self._get_payers)
-        self.question_q = QuestionManager(self.redis_client, self.logger)
+        task_pools["game_io"].spawn(self._get_payers)
+        # A new game takes a ready deck of questions, a resumed one draws the questions it has not asked yet
+        self.question_q = deck_pool.take() if state is None else None
+        if self.question_q is None:
+            self.question_q = QuestionManager(self.logger,
+                                              seen_hashes=None if state is None else json.loads(state["seen"]))
+
+    @property
+    def state_key(self):
+        """
+        Redis hash map where the game state is checkpointed.
+        """
+        return f"{self.room_name}-STATE"
+
+    @property
+    def lease_key(self):
+        """
+        Redis key which value is the name of the server instance running the game while its lease is not expired.
+        """
+        return f"{self.room_name}-LEASE"
+
+    def checkpoint(self):
+        """
+        Saves the game state to redis, which is enough to resume the game from the next round.
+        """
+        pipe = self.redis_client.pipeline(transaction=True)
+        pipe.hset(self.state_key, mapping={
+            "server_name": self.server_name,
+            "round_cnt": self.round_cnt,
+            "seen": json.dumps({key: list(hashes) for key, hashes in self.question_q.question_idx_ctrl.items()}),
+        })
+        pipe.zadd(conf.ACTIVE_GAMES, {self.room_name: time.time()}, nx=True)
+        with metrics.REDIS_LATENCY.time(site="checkpoint"):
+            pipe.execute()
 
     def _get_payers(self):
-        self.players = self.redis_client.smembers(self.room_name)
+        profiler.tag(self.room_name)
+        with metrics.REDIS_LATENCY.time(site="game_players"):
+            self.players = self.redis_client.smembers(self.room_name)
 
-    def _run_new_round(self, round_timer):
-        """"
-        Runs a round of game for the players registered in this game (room). This includes asking a question, collecting
-        the answers, removing players who answered incorrectly from the game, and prompting results back to the users.
+    def submit_answer(self, round_answer_key, username, answer):
+        """
+        Registers a player's answer received by this server instance in memory.
 
         Arguments:
-            round_timer - (int) available time in seconds for answering a question.
+            round_answer_key - (str) key of the round the answer is submitted to.
+            username - (str) player's name.
+            answer - (str) player's answer.
 
         Returns:
-            players_in_game - (int) number of players who are still in the game (submitted the correct answers).
+            status - (int) 1 if the answer is registered, 2 if the player has already answered, 0 if the player is not
+                in the game and -1 if the round is closed (same as REPORT_ANSWERS_SCRIPT).
+        """
+        if round_answer_key != self.round_answer_key or time.monotonic() > self.round_deadline:
+            return -1
+        if username not in self.players:
+            return 0
+        if username in self.players_submitted:
+            return 2
+        self.players_submitted.add(username)
+        if answer in self.option_cnt:
+            self.option_cnt[answer] += 1
+            if answer == self.round_question["answer"]:
+                self.players_correct.add(username)
+        else:
+            self.logger.error(f"Player's answer does not match any available options, username: {username}, "
+                              f"answer: {answer}, available options: {self.round_question['options']}")
+        return 1
+
+    def _get_option_counts(self, remote_cnt=None):
+        """
+        Returns the number of answers for every option of the current round (in the order of the options).
+
+        Arguments:
+            remote_cnt - (dict) number of answers for every option received by other server instances.
+        """
+        remote_cnt = remote_cnt or {}
+        return [cnt + int(remote_cnt.get(option, 0)) for option, cnt in self.option_cnt.items()]
+
+    def _publish_progress(self, round_answer_key):
+        """
+        Publishes the answer distribution of the open round if it has changed, and schedules the next update.
+
+        Arguments:
+            round_answer_key - (str) key of the round which progress is published.
         """
+        profiler.tag(self.room_name)
+        if round_answer_key != self.round_answer_key or self.is_stopped:
+            return
+        with metrics.REDIS_LATENCY.time(site="round_progress"):
+            remote_cnt = self.redis_client.hgetall(f"{round_answer_key}-STATS")
+        counts = self._get_option_counts(remote_cnt)
+        if counts != self.progress_published:
+            self.progress_published = counts
+            self._publish({"type": "round_progress",
+                           "round": self.round_cnt,
+                           "counts": counts,
+                           "answered": sum(counts),
+                           })
+        if time.monotonic() + conf.ROUND_PROGRESS_INTERVAL < self.round_deadline:
+            deadline_scheduler.call_later(conf.ROUND_PROGRESS_INTERVAL, self._publish_progress, round_answer_key)
+
+    def _open_round(self):
+        """"
+        Opens a round of game for the players registered in this game (room), which includes asking a question. The
+        round is closed at its deadline (see Game._close_round).
+        """
+        profiler.tag(self.room_name)
+        if self.is_stopped:
+            self._stop()
+            return
         self.round_cnt += 1
 
         # Initialize the info required to run a new round
         question = self.question_q.pop()
         if len(question["question"]) == 0:
             self.logger.error("CRITICAL ERROR: not enough questions for a round to run")
-        # Players' answers are to be submitted to the hash table with the round key below. When submitting, the hash
-        # is the player username and the value is the question answer
+        # Players' answers received by this server instance are kept in memory, the answers received by other server
+        # instances are submitted to the hash table with the round key below. When submitting, the hash is the player
+        # username and the value is the question answer. Answers are accepted while the deadline key exists and its
+        # value (epoch time in ms) is not earlier than the time the answer was received
         round_answer_key = f"{self.room_name}-ROUND-{self.round_cnt}-ANSWERS"
+        self.round_deadline = self.next_deadline + self.round_timer
+        self.round_answer_key = round_answer_key
+        self.round_question = question
+        self.option_cnt = dict.fromkeys(question["options"], 0)
+        self.players_submitted = set()
+        self.players_correct = set()
+        self.progress_published = None
+        deadline_ms = monotonic2epoch_ms(self.round_deadline)
+        with metrics.REDIS_LATENCY.time(site="open_round"):
+            self.redis_client.set(f"{round_answer_key}-DEADLINE", deadline_ms, px=int(self.round_timer * 1000) + 1000)
 
         # Launch a new round
-        eventlet.spawn(self._publish, {"type": "new_round",
+        task_pools["game_io"].spawn(self._publish, {"type": "new_round",
                                        "question": question["question"],
                                        "options": question["options"],
                                        "round_answer_key": round_answer_key,
-                                       "timer": round_timer,
+                                       "timer": self.round_timer,
+                                       "deadline": deadline_ms,
+                                       "server_time": monotonic2epoch_ms(time.monotonic()),
                                        "round": self.round_cnt,
                                        "room": self.room_name,
                                        })
-        # Update players in the game
-        eventlet.spawn(self._get_payers)
-        # Wait until the round is ended
-        eventlet.sleep(round_timer)
-
-        # Get players' answers
-        answers = self.redis_client.hgetall(round_answer_key)
-
-        # Initialize round statistics accounting
-        answer_cnt = 0  # Total number of answers received
-        correct_cnt = 0  # Total number of correct answers received
-        option_cnt = dict.fromkeys(question["options"], 0)  # Total number of answers received for every option
-        correct_answer = question["answer"]
+        # Stream the answer distribution while the round is open and close the round exactly at its deadline
+        deadline_scheduler.call_later(conf.ROUND_PROGRESS_INTERVAL, self._publish_progress, round_answer_key)
+        deadline_scheduler.call_at(self.round_deadline, self._close_round, question, round_answer_key)
 
-        # Compute round statistics
-        players_submitted = set()
-        for username, answer in answers.items():
-            players_submitted.add(username)
-            if answer in option_cnt:
-                option_cnt[answer] += 1
-                if answer == correct_answer:
-                    correct_cnt += 1
-                else:
-                    # Broadcast players who submitted incorrect answers and remove them form the game
-                    eventlet.spawn(self._publish, {
-                        "type": "players_update",
-                        "action": "left",
-                        "username": username,
-                    })
-                answer_cnt += 1
-            else:
-                self.logger.error(f"Player's answer does not match any available options, username: {username}, "
-                                  f"answer: {answer}, available options: {question['options'].keys()}")
-        # Update stat with the players who did not submit their answers
-        for username in self.players.difference(players_submitted):
-            answer_cnt += 1
-            # Broadcast players who did not submit their answers and remove them form the game
-            eventlet.spawn(self._publish, {
-                "type": "players_update",
-                "action": "left",
-                "username": username,
-            })
+    def _close_round(self, question, round_answer_key, is_grace_over=False):
+        """"
+        Closes the round: collects the answers, removes players who answered incorrectly from the game, and prompts
+        results back to the users. The next round is opened after a break if there are more than one player in the game.
+
+        Arguments:
+            question - (dict) question asked in the round.
+            round_answer_key - (str) redis hash map key, where the answers are registered.
+            is_grace_over - (bool) whether the answers received by other server instances had time to reach redis.
+        """
+        profiler.tag(self.room_name)
+        if self.is_stopped:
+            self._stop()
+            return
+        if not is_grace_over and not self.players.issubset(self.players_submitted):
+            # Some answers received by other server instances by the deadline might still be buffered (see AnswerBuffer)
+            deadline_scheduler.call_at(self.round_deadline + conf.ANSWER_COLLECT_GRACE, self._close_round, question,
+                                       round_answer_key, True)
+            return
+        # Stop accepting answers. Redis is only read if some players have not answered through this server instance
+        self.round_answer_key = None
+        remote_cnt, remote_answers = {}, {}
+        if not self.players.issubset(self.players_submitted):
+            pipe = self.redis_client.pipeline(transaction=True)
+            pipe.delete(f"{round_answer_key}-DEADLINE")
+            pipe.hgetall(f"{round_answer_key}-STATS")
+            pipe.hgetall(round_answer_key)
+            pipe.delete(round_answer_key, f"{round_answer_key}-STATS")
+            with metrics.REDIS_LATENCY.time(site="close_round"):
+                _, remote_cnt, remote_answers, _ = pipe.execute()
 
-        # Prepare option stats as ratios
-        option_stats = {option: cnt/answer_cnt if answer_cnt else 0 for option, cnt in option_cnt.items()}
-        # Inform all players (no matter they lose or win) about the round results
-        eventlet.spawn(self._publish, {
+        # Round statistics are ready in the answer counters, so they are published before the players who lost are
+        # figured out
+        correct_answer = question["answer"]
+        correct_idx = question["options"].index(correct_answer) if correct_answer in question["options"] else -1
+        counts = self._get_option_counts(remote_cnt)
+        correct_cnt = counts[correct_idx] if correct_idx >= 0 else 0
+        # Inform all players (no matter they lose or win) about the round results. The options are referred to by
+        # their indices in the "new_round" message, the players who did not answer count in "answered" as well
+        task_pools["game_io"].spawn(self._publish, {
             "type": "round_stats",
             "round": self.round_cnt,
-            "options": question["options"],
-            "stats": option_stats,
-            "correct_answer": correct_answer,
+            "counts": counts,
+            "answered": max(len(self.players), sum(counts)),
+            "correct": correct_idx,
             "players_in_game": correct_cnt,
+            "server_time": monotonic2epoch_ms(time.monotonic()),
         })
-        # Clean up the hash table for recording the round answers
-        self.redis_client.delete(round_answer_key)
-        return correct_cnt
+
+        # Players who submitted incorrect answers or did not submit at all lose. Broadcast all of them at once and
+        # remove them form the game
+        players_correct = self.players_correct.union(
+            username for username, answer in remote_answers.items() if answer == correct_answer)
+        eliminated = list(self.players.difference(players_correct))
+        if eliminated:
+            self.players = self.players.intersection(players_correct)
+            task_pools["game_io"].spawn(self._eliminate, eliminated)
+        self.checkpoint()
+
+        # Run rounds until there are more than one player in the game
+        if correct_cnt > 1 and not self.is_stopped:
+            self.next_deadline = self.round_deadline + conf.ROUND_BREAK
+            deadline_scheduler.call_at(self.next_deadline, self._open_round)
+        elif self.is_stopped:
+            self._stop()
+        else:
+            self._end()
 
     def _publish(self, info):
         """
-        Publishes round updates. Also, removes players who submitted incorrect answers from the game room (if "left"
-        action provided).
+        Publishes round updates.
 
         Arguments:
            info - (dict) includes "type" and possibly some other game related keys.
@@ -389,53 +976,102 @@ class Game:
         Returns:
            None
         """
-        assert "type" in info, f"Every published message should have at least 'type' keys but this does not, message: {info}"
-        info["room_name"] = self.room_name
+        profiler.tag(self.room_name)
         # Broadcast the received info
-        self.redis_client.publish(self.channel_name, json.dumps(info))
-        # Remove the user from this game if asked
-        if "action" in info and info["action"] == "left":
-            assert "username" in info, "Username should be provided on 'left' action str"
-            if self.redis_client.exists(self.room_name, info["username"]):
-                self.redis_client.srem(self.room_name, info["username"])
-
-    def run(self, game_timer=10, round_timer=10):
-        """"
-        Runs a series of rounds until there is only one player left.
+        with metrics.REDIS_LATENCY.time(site="game_publish"):
+            publish(self.redis_client, self.channel_name, self.room_name, info)
+
+    def _eliminate(self, usernames):
+        """
+        Broadcasts the players who lost the round as one "eliminated" message and removes them from the game room. Both
+        are done in a single pipelined round trip no matter how many players lost.
 
         Arguments:
-            game_timer - (int) available time in seconds for joining a game by other players.
-            round_timer - (int) available time in seconds for answering a question in each round.
+           usernames - (list) names of the players to be removed from the game.
 
         Returns:
-            None
+           None
         """
+        profiler.tag(self.room_name)
+        pipe = self.redis_client.pipeline(transaction=False)
+        publish(pipe, self.channel_name, self.room_name, {
+            "type": "players_update",
+            "action": "eliminated",
+            "usernames": usernames,
+        })
+        pipe.srem(self.room_name, *usernames)
+        with metrics.REDIS_LATENCY.time(site="eliminate"):
+            pipe.execute()
 
-        # Notify players about starting new game
-        eventlet.spawn(self._publish, {"type": "new_game", "timer": game_timer})
-        # Wait until it is time to start the game
-        eventlet.sleep(game_timer)
+    def start(self, game_timer=None, round_timer=None, on_end=None):
+        """"
+        Starts the game asynchronously: the game runs a series of rounds until there is only one player left. A
+        resumed game continues from the round after the latest checkpoint. All the game phases are driven by the
+        process deadline scheduler at absolute deadlines, so the time spent on publishing and scoring does not make
+        the rounds drift.
 
-        # Stop users from joining this game
-        self.redis_client.delete(conf.NEXT_GAME_ROOM)
-        self.redis_client.delete(conf.NEXT_GAME_SERVER)
+        Arguments:
+            game_timer - (float) available time in seconds for joining a game by other players.
+            round_timer - (float) available time in seconds for answering a question in each round.
+            on_end - (function) called without arguments when the game ends or stops.
 
-        eventlet.sleep(2)  # Allow the latest players to get ready
-        # Run rounds until there are more than one player in the game
-        players_in_game = 2
-        while players_in_game > 1:
-            players_in_game = self._run_new_round(round_timer)
-            eventlet.sleep(10)  # Delay between rounds
+        Returns:
+            None
+        """
+        game_timer = conf.GAME_TIMER if game_timer is None else game_timer
+        self.round_timer = conf.ROUND_TIMER if round_timer is None else round_timer
+        self.on_end = on_end
+        self.checkpoint()
+        if self.is_resumed:
+            # Answers to the interrupted round must not be counted in the round which replays it
+            round_answer_key = f"{self.room_name}-ROUND-{self.round_cnt + 1}-ANSWERS"
+            self.redis_client.delete(round_answer_key, f"{round_answer_key}-STATS")
+            self.logger.info(f"Game in {self.room_name} is resumed after round {self.round_cnt}")
+            self.next_deadline = time.monotonic() + conf.GAME_READY_DELAY
+        else:
+            # Notify players about starting new game
+            joining_deadline = time.monotonic() + game_timer
+            task_pools["game_io"].spawn(self._publish, {"type": "new_game",
+                                           "timer": game_timer,
+                                           "deadline": monotonic2epoch_ms(joining_deadline),
+                                           })
+            # Stop users from joining this game when it is time to start the game
+            deadline_scheduler.call_at(joining_deadline, self._close_joining)
+            # Allow the latest players to get ready
+            self.next_deadline = joining_deadline + conf.GAME_READY_DELAY
+        deadline_scheduler.call_at(self.next_deadline, self._open_round)
 
-        # Clean up the set for keeping track of the users in game
-        self.redis_client.delete(self.room_name)
+    def _close_joining(self):
+        """
+        Stops users from joining this game. The players in the game are known from now on, they are only removed
+        from the game as they lose.
+        """
+        profiler.tag(self.room_name)
+        with metrics.REDIS_LATENCY.time(site="close_joining"):
+            self.redis_client.zrem(conf.OPEN_ROOMS, self.room_name)
+        self._get_payers()
 
-        # Keep track of how many rounds players completed for future question selection
-        self.logger.info(f"Game ends in {self.round_cnt} rounds")
+    def _stop(self):
+        """
+        Stops the game which has been taken over by another server instance.
+        """
+        self.logger.warning(f"Game in {self.room_name} is stopped, it has been taken over by another server")
+        if self.on_end:
+            self.on_end()
 
-    def start(self):
+    def _end(self):
         """
-        Starts the game asynchronously.
+        Cleans up the game records when the game is over.
         """
-        eventlet.spawn(self.run)
+        profiler.tag(self.room_name)
+        # Clean up the set for keeping track of the users in game, the game host record and the game state
+        pipe = self.redis_client.pipeline(transaction=True)
+        pipe.delete(self.room_name, f"{self.room_name}-SERVER", self.state_key, self.lease_key)
+        pipe.zrem(conf.ACTIVE_GAMES, self.room_name)
+        with metrics.REDIS_LATENCY.time(site="end_game"):
+            pipe.execute()
 
+        # Keep track of how many rounds players completed for future question selection
+        self.logger.info(f"Game ends in {self.round_cnt} rounds")
+        if self.on_end:
+            self.on_end()
@@ -0,0 +1,219 @@
+import os
+import re
+import sys
+import json
+import time
+import weakref
+from collections import Counter
+import eventlet
+import eventlet.patcher
+import greenlet
+
+import game.config_variables as conf
+from game.tasks import task_pools
+
+# The sampler runs in an OS thread, as a greenlet would only see the other greenlets when they are switched out (and
+# not while they are using the CPU)
+_threading = eventlet.patcher.original("threading")
+_thread = eventlet.patcher.original("_thread")
+_time = eventlet.patcher.original("time")
+
+COLLAPSED_FORMAT = "collapsed"
+SPEEDSCOPE_FORMAT = "speedscope"
+OUTPUT_FORMATS = (COLLAPSED_FORMAT, SPEEDSCOPE_FORMAT)
+SPEEDSCOPE_SCHEMA = "https://www.speedscope.app/file-format-schema.json"
+
+
+class SamplingProfiler:
+    """
+    Statistical profiler of the server process, that can be switched on at runtime for a limited time. An OS thread
+    takes the stack of the greenlet running in the event loop at a fixed interval, so the profile shows where the CPU
+    time of the process goes (the samples with the event loop hub waiting for I/O show the idle time).
+
+    The greenlets doing work for a game room are tagged with the room name (see tag), so a capture can be limited to one
+    game, and the stacks of a process capture start with their room name.
+
+    The profile is written to local disk as collapsed stacks (one "frame;frame;frame count" line per stack, for
+    flamegraph.pl and most flame graph tools) or as a speedscope file (https://www.speedscope.app).
+    """
+
+    def __init__(self, output_dir=None, interval=None, max_depth=None):
+        """
+        Arguments:
+            output_dir - (str) directory the profiles are written to.
+            interval - (float) time in seconds between the samples.
+            max_depth - (int) maximum number of frames kept of a stack (the innermost ones).
+        """
+        self.output_dir = conf.PROFILER_OUTPUT_DIR if output_dir is None else output_dir
+        self.interval = conf.PROFILER_INTERVAL if interval is None else interval
+        self.max_depth = conf.PROFILER_MAX_DEPTH if max_depth is None else max_depth
+        self.is_active = False
+        self.room_name = None  # Room the active capture is limited to, None for the whole process
+        self.output_format = None
+        self.logger = None
+        self._greenlet_rooms = weakref.WeakKeyDictionary()  # Tagged greenlet to its room name
+        self._running_greenlet = None  # Greenlet currently running in the event loop thread
+        self._previous_trace = None
+        self._samples = Counter()  # (room name, stack of code objects from the outermost) to the number of samples
+        self._started = 0.0
+        self._thread = None
+        self._timer = None
+
+    def tag(self, room_name):
+        """
+        Attributes the samples of the current greenlet to the game room (for the rest of the greenlet life). Greenlets
+        are only tagged while a capture is active, so this is nearly free otherwise.
+        """
+        if self.is_active:
+            self._greenlet_rooms[greenlet.getcurrent()] = room_name
+
+    def start(self, room_name=None, duration=None, output_format=None, logger=None):
+        """
+        Starts a capture, which is written to disk when it is stopped (see stop) or when its duration is over.
+
+        Arguments:
+            room_name - (str) game room the capture is limited to, the whole process is profiled if None.
+            duration - (float) time in seconds after which the capture is stopped, capped by PROFILER_MAX_DURATION.
+            output_format - (str) "collapsed" or "speedscope".
+            logger - (obj) logger the written profile is reported to.
+
+        Returns:
+            is_started - (bool) False if a capture is already active.
+        """
+        output_format = COLLAPSED_FORMAT if output_format is None else output_format
+        assert output_format in OUTPUT_FORMATS, f"Unsupported profile format '{output_format}', the supported formats " \
+                                                f"are {list(OUTPUT_FORMATS)}"
+        if self.is_active:
+            return False
+        duration = min(conf.PROFILER_DEFAULT_DURATION if duration is None else duration, conf.PROFILER_MAX_DURATION)
+        self.room_name = room_name
+        self.output_format = output_format
+        self.logger = logger
+        self._samples = Counter()
+        self._greenlet_rooms.clear()
+        self._running_greenlet = greenlet.getcurrent()
+        # Keeps track of the running greenlet, the trace function is called by the event loop thread on every switch
+        self._previous_trace = greenlet.settrace(self._trace)
+        self.is_active = True
+        self._started = time.monotonic()
+        self._thread = _threading.Thread(target=self._sample, args=(_thread.get_ident(),), daemon=True)
+        self._thread.start()
+        self._timer = task_pools.spawn_after(duration, self.stop)
+        return True
+
+    def stop(self):
+        """
+        Stops the active capture and writes the profile to disk.
+
+        Returns:
+            file_path - (str) path of the written profile, None if no capture is active.
+        """
+        if not self.is_active:
+            return None
+        self.is_active = False
+        # The sampler finishes its sample within one interval
+        self._thread.join()
+        greenlet.settrace(self._previous_trace)
+        # Only cancelled if the capture is stopped before its duration is over
+        self._timer.cancel()
+        self._running_greenlet = None
+        self._greenlet_rooms.clear()
+        file_path = self._write(time.monotonic() - self._started)
+        if self.logger is not None:
+            self.logger.info(f"Profile of {self.room_name or 'the process'} ({sum(self._samples.values())} samples) is "
+                             f"written to {file_path}")
+        return file_path
+
+    def _trace(self, event, args):
+        if event in ("switch", "throw"):
+            self._running_greenlet = args[1]
+        if self._previous_trace is not None:
+            self._previous_trace(event, args)
+
+    def _sample(self, thread_id):
+        """
+        Takes the samples of the event loop thread until the capture is stopped (runs in its own OS thread).
+        """
+        while self.is_active:
+            frame = sys._current_frames().get(thread_id)
+            room_name = self._greenlet_rooms.get(self._running_greenlet)
+            if frame is not None and (self.room_name is None or room_name == self.room_name):
+                stack = []
+                while frame is not None and len(stack) < self.max_depth:
+                    stack.append(frame.f_code)
+                    frame = frame.f_back
+                stack.reverse()
+                self._samples[(room_name, tuple(stack))] += 1
+            _time.sleep(self.interval)
+
+    def _write(self, duration):
+        """
+        Writes the samples of the capture to a file in the output directory.
+        """
+        os.makedirs(self.output_dir, exist_ok=True)
+        # The room name is sanitised, so the profile is always written into the output directory
+        room_name = re.sub(r"[^A-Za-z0-9_-]", "_", self.room_name or "process")
+        name = f"{room_name}-{os.getpid()}-{time.strftime('%Y%m%d-%H%M%S')}"
+        if self.output_format == SPEEDSCOPE_FORMAT:
+            file_path = os.path.join(self.output_dir, f"{name}.speedscope.json")
+            with open(file_path, "w") as f:
+                json.dump(self._get_speedscope_profile(name, duration), f)
+        else:
+            file_path = os.path.join(self.output_dir, f"{name}.collapsed.txt")
+            with open(file_path, "w") as f:
+                for stack, cnt in self._get_stacks():
+                    f.write(f"{';'.join(stack)} {cnt}\n")
+        return file_path
+
+    def _get_stacks(self):
+        """
+        Returns the sampled stacks as (frame names from the outermost, number of samples), the room name is the
+        outermost frame of the stacks of a process capture.
+        """
+        stacks = Counter()
+        for (room_name, codes), cnt in self._samples.items():
+            stack = [get_frame_name(code) for code in codes]
+            if self.room_name is None and room_name is not None:
+                stack.insert(0, room_name)
+            stacks[tuple(stack)] += cnt
+        return stacks.most_common()
+
+    def _get_speedscope_profile(self, name, duration):
+        frames = []
+        frame_indexes = {}
+        samples = []
+        weights = []
+        for stack, cnt in self._get_stacks():
+            sample = []
+            for frame_name in stack:
+                if frame_name not in frame_indexes:
+                    frame_indexes[frame_name] = len(frames)
+                    frames.append({"name": frame_name})
+                sample.append(frame_indexes[frame_name])
+            samples.append(sample)
+            weights.append(cnt * self.interval)
+        return {
+            "$schema": SPEEDSCOPE_SCHEMA,
+            "name": name,
+            "exporter": "hq_trivia",
+            "shared": {"frames": frames},
+            "profiles": [{
+                "type": "sampled",
+                "name": name,
+                "unit": "seconds",
+                "startValue": 0,
+                "endValue": duration,
+                "samples": samples,
+                "weights": weights,
+            }],
+        }
+
+
+def get_frame_name(code):
+    """
+    Returns the flame graph name of a function: "function (file:line)".
+    """
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+profiler = SamplingProfiler()
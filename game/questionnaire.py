@@ -1,19 +1,31 @@
 # 'questions_1' were borrowed form https://github.com/joebandenburg/fibbage-questions/blob/master/questions.json
 
+import csv
 import json
+import math
+import time
+import uuid
+import hashlib
 import random
 from collections import deque
 import eventlet
+import eventlet.queue
 
 import game.config_variables as conf
+import game.metrics as metrics
+from game.tasks import task_pools
 
 
-def load_questions2redis(redis_client, file_path=None, file_ext=None, category_dict=None):
+def load_questions2redis(redis_client, file_path=None, file_ext=None, category_dict=None, chunk_size=None):
     """
     Loads questions from a file to the specified redis hash maps, where each question category corresponds to a separate
     hash map. In a hash map, a hash is a question count number (from 0 to N) and a value is a JSON string in a
     specified format.
 
+    The file is streamed, so its size is not limited by memory, and the questions are written with chunked pipelined
+    HSET mappings into temporary keys which replace the hash maps when the load is completed. The load is skipped if
+    the file content hash matches the one of the latest load (conf.QUESTIONS_SOURCE_HASH).
+
     Notes:
         (1) Each question JSON str should have the following keys
             - 'category',
@@ -21,58 +33,436 @@ def load_questions2redis(redis_client, file_path=None, file_ext=None, category_d
             - 'answer',
             - 'alternateSpellings',
             - 'suggestions'.
-        (2) Only supports JSON files at the moment.
+        (2) Supported file formats:
+            - 'json', an object where each category_dict key maps to a list of questions (see questions_1.json);
+            - 'ndjson', one question per line, where a question also has a 'bank' key with its category_dict key;
+            - 'csv', a file with a header, which columns are 'bank' and the question keys, where 'alternateSpellings'
+              and 'suggestions' are lists separated by '|'.
 
     Arguments:
         redis_client - (obj) redis client, to where the data is to be loaded.
         file_path - (str) local path to the file to be loaded including the file name and excluding the extension.
-        file_ext - (str) file extension, e.g., 'json', 'csv'.
+        file_ext - (str) file extension, e.g., 'json', 'ndjson', 'csv'.
         category_dict - (dict) a dictionary that shows where to map a category from the file to the redis_client,
             e.g., {'questionnaire_field': 'redis_field'}
+        chunk_size - (int) number of questions written to redis in one pipelined round trip.
 
     Returns:
-        None
+        is_loaded - (bool) whether the questions were loaded, False if they were already up to date.
     """
-    assert (file_path is None) and (file_ext is None) and (category_dict is None), \
-        "Only expected to work with the default values at the moment"
     file_path = "./questions/questions_1" if file_path is None else file_path
     file_ext = "json" if file_ext is None else file_ext
     category_dict = {
         "normal": conf.NORMAL_QUESTIONS,
         "final": conf.FINAL_QUESTIONS,
     } if category_dict is None else category_dict
+    chunk_size = conf.QUESTIONS_LOAD_CHUNK if chunk_size is None else chunk_size
+    assert file_ext in QUESTION_READERS, f"Unsupported question file format '{file_ext}', the supported formats are " \
+                                         f"{list(QUESTION_READERS)}"
+
+    source_hash = _get_file_hash(f"{file_path}.{file_ext}", category_dict)
+    if redis_client.get(conf.QUESTIONS_SOURCE_HASH) == source_hash and redis_client.exists(conf.QUESTIONS_VERSION):
+        # Another server instance (or a previous launch) has already loaded this file
+        question_bank.sync(redis_client)
+        return False
 
-    if file_ext == "json":
-        with open(f"{file_path}.{file_ext}") as f:
-            questions = json.load(f)
-    else:
-        raise NotImplemented
-
-    for q_key, redis_key in category_dict.items():
-        for idx, question in enumerate(questions[q_key]):
-            assert ("category" in question) and \
-                   ("question" in question) and \
-                   ("answer" in question) and \
-                   ("alternateSpellings" in question) and \
-                   ("suggestions" in question), \
-                f"One or more keys are missing the selected JSON string question, the expected keys are 'category', " \
-                f"'question', 'answer', 'alternateSpellings', 'suggestions'. The encountered question: {question}"
+    version = uuid.uuid4().hex
+    loading_keys = {redis_key: f"{redis_key}-LOADING-{version}" for redis_key in category_dict.values()}
+    records = {redis_key: [] for redis_key in category_dict.values()}
+    chunk = {redis_key: {} for redis_key in category_dict.values()}
+    chunk_len = 0
+    pipe = redis_client.pipeline(transaction=False)
+    with open(f"{file_path}.{file_ext}", newline="", encoding="utf-8") as f:
+        for q_key, question in QUESTION_READERS[file_ext](f, category_dict):
+            QuestionRecord.validate(question)
+            redis_key = category_dict[q_key]
             question["question"] = question["question"].replace("<BLANK>", " _______ ")
-            redis_client.hset(redis_key, idx, json.dumps(question))
-    del questions
+            chunk[redis_key][len(records[redis_key])] = json.dumps(question)
+            records[redis_key].append(QuestionRecord.from_dict(question))
+            chunk_len += 1
+            if chunk_len == chunk_size:
+                _write_question_chunk(pipe, loading_keys, chunk)
+                chunk_len = 0
+    _write_question_chunk(pipe, loading_keys, chunk)
+
+    # Replace the questions and let the other server instances know that the questions have changed, this instance is
+    # updated right away
+    pipe = redis_client.pipeline(transaction=True)
+    for redis_key, loading_key in loading_keys.items():
+        if records[redis_key]:
+            pipe.rename(loading_key, redis_key)
+        else:
+            pipe.delete(redis_key)
+    pipe.set(conf.QUESTIONS_SOURCE_HASH, source_hash)
+    pipe.set(conf.QUESTIONS_VERSION, version)
+    pipe.execute()
+    question_bank.update(version, records)
+    return True
+
+
+def _write_question_chunk(pipe, loading_keys, chunk):
+    """
+    Writes the collected questions to redis in one round trip and empties the chunk.
+
+    Arguments:
+        pipe - (obj) redis pipeline.
+        loading_keys - (dict) redis key to the temporary key where its questions are loaded to.
+        chunk - (dict) redis key to the {question hash: JSON string question} mapping.
+    """
+    for redis_key, mapping in chunk.items():
+        if mapping:
+            pipe.hset(loading_keys[redis_key], mapping=mapping)
+            mapping.clear()
+    pipe.execute()
+
+
+def _get_file_hash(file_name, category_dict):
+    """
+    Returns a hex digest of the file content and the category mapping it is loaded with.
+    """
+    digest = hashlib.sha256(json.dumps(category_dict, sort_keys=True).encode())
+    with open(file_name, "rb") as f:
+        for block in iter(lambda: f.read(1 << 16), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+# Characters a JSON number can continue with
+NUMBER_CHARS = "0123456789+-.eE"
+
+
+class _JSONStream:
+    """
+    A minimal incremental reader of a JSON text, which decodes one value at a time from a file read in blocks.
+    """
+
+    def __init__(self, f, block_size=1 << 16):
+        """
+        Arguments:
+            f - (obj) text file object.
+            block_size - (int) number of characters read from the file at once.
+        """
+        self.f = f
+        self.block_size = block_size
+        self.decoder = json.JSONDecoder()
+        self.buf = ""
+        self.pos = 0
+        self.is_eof = False
+
+    def _read(self):
+        """
+        Reads the next block of the file into the buffer, returns False at the end of the file.
+        """
+        block = self.f.read(self.block_size)
+        if not block:
+            self.is_eof = True
+            return False
+        self.buf = self.buf[self.pos:] + block
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """
+        Skips whitespaces and returns the next character, an empty string at the end of the file.
+        """
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in " \t\r\n":
+                self.pos += 1
+            if self.pos < len(self.buf) or not self._read():
+                return self.buf[self.pos:self.pos + 1]
+
+    def expect(self, chars):
+        """
+        Consumes the next character, which should be one of the specified ones, and returns it.
+        """
+        char = self.peek()
+        if not char or char not in chars:
+            raise json.decoder.JSONDecodeError(f"Expecting one of '{chars}'", self.buf, self.pos)
+        self.pos += 1
+        return char
+
+    def decode(self):
+        """
+        Decodes the next JSON value.
+        """
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+            except json.decoder.JSONDecodeError:
+                if self._read():
+                    continue
+                raise
+            if isinstance(value, (int, float)) and not self.is_eof and not self.buf[end:].strip(NUMBER_CHARS) and \
+                    self._read():
+                # A number might continue in the next block, e.g. "-0." is decoded as 0 until "-0.5" is read
+                continue
+            self.pos = end
+            return value
+
+
+def _read_json_questions(f, category_dict):
+    """
+    Streams questions from a JSON file, which is an object where each category_dict key maps to a list of questions.
+    Other keys are skipped.
+
+    Arguments:
+        f - (obj) text file object.
+        category_dict - (dict) file category to redis key mapping.
+
+    Returns:
+        (generator) of (file category, question dict) tuples.
+    """
+    stream = _JSONStream(f)
+    stream.expect("{")
+    if stream.peek() == "}":
+        return
+    while True:
+        q_key = stream.decode()
+        stream.expect(":")
+        if q_key in category_dict and stream.peek() == "[":
+            stream.expect("[")
+            if stream.peek() == "]":
+                stream.expect("]")
+            else:
+                while True:
+                    yield q_key, stream.decode()
+                    if stream.expect(",]") == "]":
+                        break
+        else:
+            stream.decode()
+        if stream.expect(",}") == "}":
+            return
+
+
+def _read_ndjson_questions(f, category_dict):
+    """
+    Streams questions from a newline delimited JSON file, where every question has a 'bank' key with its file category.
+    Questions of other categories are skipped.
+
+    Arguments:
+        f - (obj) text file object.
+        category_dict - (dict) file category to redis key mapping.
+
+    Returns:
+        (generator) of (file category, question dict) tuples.
+    """
+    for line in f:
+        if line.strip():
+            question = json.loads(line)
+            q_key = question.pop("bank", None)
+            if q_key in category_dict:
+                yield q_key, question
+
+
+def _read_csv_questions(f, category_dict):
+    """
+    Streams questions from a CSV file with a header, which columns are 'bank' (file category), 'category',
+    'question', 'answer', 'alternateSpellings' and 'suggestions', where the last two are lists separated by '|'.
+    Questions of other categories are skipped.
+
+    Arguments:
+        f - (obj) text file object.
+        category_dict - (dict) file category to redis key mapping.
+
+    Returns:
+        (generator) of (file category, question dict) tuples.
+    """
+    for row in csv.DictReader(f):
+        q_key = row.pop("bank", None)
+        if q_key in category_dict:
+            for list_key in ("alternateSpellings", "suggestions"):
+                if list_key in row:
+                    row[list_key] = [item for item in row[list_key].split("|") if item]
+            yield q_key, row
+
+
+QUESTION_READERS = {
+    "json": _read_json_questions,
+    "ndjson": _read_ndjson_questions,
+    "csv": _read_csv_questions,
+}
+
+
+def sample_without_replacement(population_size, k, exclude=None):
+    """
+    Draws random numbers from [0, population_size) without replacement using a partial Fisher-Yates shuffle. The shuffle
+    is sparse (only the swapped positions are stored), so drawing k numbers takes O(k + number of excluded numbers hit)
+    time and memory no matter how large the population is.
+
+    Arguments:
+        population_size - (int) size of the population to draw from.
+        k - (int) number of numbers to draw.
+        exclude - (set) numbers which must not be drawn, e.g. hashes of the questions already seen in the game.
+
+    Returns:
+        numbers - (list) min(k, number of available numbers) distinct random numbers.
+    """
+    exclude = set() if exclude is None else exclude
+    numbers = []
+    swaps = {}
+    for i in range(population_size):
+        if len(numbers) == k:
+            break
+        j = random.randrange(i, population_size)
+        number = swaps.get(j, j)
+        swaps[j] = swaps.get(i, i)
+        if number not in exclude:
+            numbers.append(number)
+    return numbers
+
+
+QUESTION_KEYS = frozenset(("category", "question", "answer", "alternateSpellings", "suggestions"))
+
+
+class QuestionRecord:
+    """
+    A compact question record as it is stored in the question bank.
+    """
+    __slots__ = ("question", "answer", "alternate_spellings", "suggestions")
+
+    def __init__(self, question, answer, alternate_spellings, suggestions):
+        """
+        Arguments:
+            question - (str) question text.
+            answer - (str) the correct answer.
+            alternate_spellings - (tuple) alternative spellings of the correct answer.
+            suggestions - (tuple) incorrect options.
+        """
+        self.question = question
+        self.answer = answer
+        self.alternate_spellings = alternate_spellings
+        self.suggestions = suggestions
+
+    @staticmethod
+    def validate(question):
+        """
+        Checks that a question dictionary has all the expected keys.
+
+        Arguments:
+            question - (dict) question which should include the following keys: 'category', 'question', 'answer',
+                'alternateSpellings', 'suggestions'.
+        """
+        assert QUESTION_KEYS <= question.keys(), \
+            f"One or more keys are missing the selected JSON string question, the expected keys are 'category', " \
+            f"'question', 'answer', 'alternateSpellings', 'suggestions'. The encountered question: {question}"
+
+    @classmethod
+    def from_dict(cls, question):
+        """
+        Creates a record from a validated question dictionary.
+
+        Arguments:
+            question - (dict) question in the format stored in redis (see QuestionRecord.validate).
+
+        Returns:
+            record - (QuestionRecord) the corresponding question record.
+        """
+        return cls(question["question"], question["answer"], tuple(question["alternateSpellings"]),
+                   tuple(question["suggestions"]))
+
+
+class QuestionBank:
+    """
+    A per-process cache of all the questions stored in redis. Questions are parsed once into compact records and kept
+    in sync with redis through a version key (conf.QUESTIONS_VERSION), so games can draw questions with no redis reads
+    and no JSON parsing. In every category, a question hash is the record index.
+    """
+
+    def __init__(self, redis_keys=None):
+        """
+        Arguments:
+            redis_keys - (iterable) keys of the redis hash maps to be cached.
+        """
+        self.redis_keys = (conf.NORMAL_QUESTIONS, conf.FINAL_QUESTIONS) if redis_keys is None else redis_keys
+        self.version = None
+        self._records = {redis_key: () for redis_key in self.redis_keys}
+
+    def size(self, redis_key):
+        """
+        Returns the number of questions in the category.
+        """
+        return len(self._records.get(redis_key, ()))
+
+    def get(self, redis_key, q_hash):
+        """
+        Returns the question record (QuestionRecord) with the specified hash in the category.
+        """
+        return self._records[redis_key][int(q_hash)]
+
+    def update(self, version, records):
+        """
+        Replaces the cached questions.
+
+        Arguments:
+            version - (str) version of the questions in redis.
+            records - (dict) redis key to the list of question records, where a record index is the question hash.
+        """
+        for redis_key, category_records in records.items():
+            self._records[redis_key] = tuple(category_records)
+        self.version = version
+
+    def sync(self, redis_client):
+        """
+        Reloads the questions from redis if their version has changed since the last update.
+
+        Arguments:
+            redis_client - (obj) redis client where get the questions.
+
+        Returns:
+            is_updated - (bool) whether the cache has been updated.
+        """
+        version = redis_client.get(conf.QUESTIONS_VERSION)
+        if version is None or version == self.version:
+            return False
+        pipe = redis_client.pipeline(transaction=False)
+        for redis_key in self.redis_keys:
+            pipe.hgetall(redis_key)
+        with metrics.REDIS_LATENCY.time(site="question_sync"):
+            all_questions = pipe.execute()
+        records = {}
+        for redis_key, questions in zip(self.redis_keys, all_questions):
+            records[redis_key] = [None] * len(questions)
+            for q_hash, question_str in questions.items():
+                question = json.loads(question_str)
+                QuestionRecord.validate(question)
+                records[redis_key][int(q_hash)] = QuestionRecord.from_dict(question)
+        self.update(version, records)
+        return True
+
+    def run(self, redis_client, logger, interval):
+        """
+        Keeps the cache in sync with redis.
+        """
+        while True:
+            try:
+                if self.sync(redis_client):
+                    logger.info(f"Question bank is updated to version {self.version}")
+            except Exception as e:
+                logger.error(f"Question bank update failed: {e}")
+            eventlet.sleep(interval)
+
+    def start(self, redis_client, logger, interval=None):
+        """
+        Keeps the cache in sync with redis in the background.
+        """
+        task_pools.spawn(self.run, redis_client, logger, conf.QUESTIONS_SYNC_INTERVAL if interval is None else interval)
+
+
+question_bank = QuestionBank()
 
 
 class QuestionManager:
     """
-    A queue-like object, that gets questions from redis and provides an easy access to them through "pop" method. It
-    also controls the number of questions in the queue and gets more questions if needed.
+    A queue-like object, that gets questions from the question bank and provides an easy access to them through "pop"
+    method. It also controls the number of questions in the queue and gets more questions if needed.
     """
 
-    def __init__(self, redis_client, logger, min_questions=5, question_config=None, update_lim=10):
+    def __init__(self, logger, min_questions=5, question_config=None, update_lim=10, bank=None, seen_hashes=None,
+                 is_prepared_in_background=True):
         """
         Arguments:
-             redis_client - (obj) redis client where get the questions.
-                          logger - (obj) app logger.
+             logger - (obj) app logger.
              min_questions - (int) minimum number of questions that should be in the queue at all times.
              question_config - (dict) a dictionary in which the keys are the keys of redis hash maps where the questions
                 are to be drawn from and and the values are the numbers of questions to be drawn from each hash map,
@@ -80,8 +470,13 @@ class QuestionManager:
             update_lim - (int) maximum allowed number of updates (this limit is supposed to cover a case when a user has
                 seen all the questions from the database; alternatively but unlikely, it might harm (1) if the user is a
                 genius and knows all the answers or (2) bad luck with getting random questions)
+            bank - (QuestionBank) where get the questions, the process question bank by default.
+            seen_hashes - (dict) redis key to the hashes of the questions which must not be asked (e.g. when a game is
+                resumed).
+            is_prepared_in_background - (bool) whether the first questions are prepared in the background, otherwise
+                the owner prepares them (see DeckPool).
         """
-        self.redis_client = redis_client
+        self.bank = question_bank if bank is None else bank
         self.logger = logger
         self.min_questions = min_questions
         self.question_config = {
@@ -90,12 +485,13 @@ class QuestionManager:
         } if question_config is None else question_config
         # Keeping track of the game questions
         self.questions_q = deque()
-        self.question_idx_ctrl = {key: set() for key in self.question_config}
+        self.question_idx_ctrl = {key: set() if seen_hashes is None else set(seen_hashes.get(key, ()))
+                                  for key in self.question_config}
         # Control number of updates
         self._update_lim = update_lim
         self.update_count = 0
-        # Prepare questions in the background
-        eventlet.spawn(self._prepare_game_questions)
+        if is_prepared_in_background:
+            task_pools["questions"].submit(self._prepare_game_questions)
 
     def __len__(self):
         """
@@ -112,34 +508,28 @@ class QuestionManager:
              The function only does what it is supposed to do if no run count limit (self._update_lim) is reached.
          """
         if self.update_count < self._update_lim:
-            for redis_hash, q_len in self.question_config.items():
-                q_hashes, q_queue = self._get_random_questions(redis_hash, q_len)
-                if len(self.question_idx_ctrl[redis_hash]) == 0:
-                    self.question_idx_ctrl[redis_hash] = q_hashes
-                    while q_queue:
-                        self.questions_q.append(q_queue.popleft())
-                else:
-                    while q_queue:
-                        question = q_queue.popleft()
-                        if question["hash"] in self.question_idx_ctrl[redis_hash]:
-                            pass
-                        else:
-                            self.question_idx_ctrl[redis_hash].add(question["hash"])
-                            self.questions_q.append(question)
+            with metrics.QUESTION_REFILL_LATENCY.time():
+                for redis_hash, q_len in self.question_config.items():
+                    q_hashes, q_queue = self._get_random_questions(redis_hash, q_len)
+                    if len(q_hashes) < q_len:
+                        self.logger.warning(f"Only {len(q_hashes)} out of {q_len} requested questions are left unseen "
+                                            f"in {redis_hash}")
+                    self.question_idx_ctrl[redis_hash].update(q_hashes)
+                    self.questions_q.extend(q_queue)
             self.update_count += 1
         else:
+            metrics.QUESTION_UPDATE_LIMIT_EXHAUSTED.inc()
             self.logger.error(f"Exceeded maximum number of question updates in a game (limit = {self._update_lim})")
 
     def _get_random_questions(self, redis_key, q_len):
         """
-         Gets a list of random questions of the specified difficulty from redis.
-
-         Note:
-             Assumes that question hashes are the question indices (this is how load_questions2redis loads questions to redis).
+         Gets a list of random questions of the specified difficulty from the question bank. The questions which have
+         already been added to this game are never drawn again.
 
          Arguments:
              redis_key - (str) the redis key to the questions hash map.
-             q_len - (int) number of questions to be returned.
+             q_len - (int) number of questions to be returned, fewer questions are returned if there are not enough
+                unseen questions left.
 
          Returns:
              q_hashes - (set) set of the question hashes (for assuring that the game does not run the same question twice
@@ -148,67 +538,37 @@ class QuestionManager:
                 keys: "question", "options", "answer", "hash"
 
          """
-        num_questions = self.redis_client.hlen(redis_key)
-        q_hashes = self._get_random_number_set(q_len, 0, num_questions)
-        json_questions = self.redis_client.hmget(redis_key, *q_hashes)
+        num_questions = self.bank.size(redis_key)
+        if num_questions == 0:
+            self.logger.error(f"No questions are available in the question bank for {redis_key}")
+            return set(), deque()
+        q_hashes = set(sample_without_replacement(num_questions, q_len, self.question_idx_ctrl[redis_key]))
         q_queue = deque()
-        for i, q_hash in enumerate(q_hashes):
-            q_queue.append(self._map_question_str2dict(q_hash, json_questions[i]))
+        for q_hash in q_hashes:
+            q_queue.append(self._map_record2dict(q_hash, self.bank.get(redis_key, q_hash)))
         return q_hashes, q_queue
 
     @staticmethod
-    def _get_random_number_set(set_len, start, end):
-        """
-        Gets a set of random numbers in the range of [start, end).
-
-        Arguments:
-            start - (int) starting number.
-            end - (int) end number.
-            set_len - (int) length of the set to be generated.
-
-        Returns:
-            numbers - (set) set of random numbers.
-        """
-        numbers = set()
-        while len(numbers) < set_len:
-            rnd = random.randint(start, end - 1)
-            if rnd in numbers:
-                pass
-            else:
-                numbers.add(rnd)
-        return numbers
-
-    @staticmethod
-    def _map_question_str2dict(q_hash, question_str):
+    def _map_record2dict(q_hash, record):
         """
-        Maps a JSON string to a dictionary which is ready to be played.
+        Maps a question record to a dictionary which is ready to be played.
 
          Arguments:
              q_hash - (str or int) the question hash in the corresponding hash map.
-             question_str - (str) question in the JSON string format (includes the following keys:
-                'category', 'question', 'answer', 'alternateSpellings', 'suggestions').
+             record - (QuestionRecord) question from the question bank.
 
          Returns:
              question - (dict) a question dictionary ready to by played, which includes a "question", a correct "answer",
                 3 "options" including the correct option and the question index in the database "hash".
          """
-        question_raw = json.loads(question_str)
-        assert ("category" in question_raw) and \
-               ("question" in question_raw) and \
-               ("answer" in question_raw) and \
-               ("alternateSpellings" in question_raw) and \
-               ("suggestions" in question_raw), \
-            f"One or more keys are missing the selected JSON string question, the expected keys are 'category', " \
-            f"'question', 'answer', 'alternateSpellings', 'suggestions'. The encountered question: {question_raw}"
         assert isinstance(q_hash, int) or isinstance(q_hash, str), "Question hash should be integer or string"
 
         question = {}
         question["hash"] = q_hash
-        question["question"] = question_raw["question"]
-        question["answer"] = question_raw["answer"] if len(question_raw["alternateSpellings"]) == 0 or random.randint(0,
-                                                                                                                      1) == 0 \
-            else random.choice(question_raw["alternateSpellings"])
-        question["options"] = random.sample(question_raw["suggestions"], 2) + [question["answer"]]
+        question["question"] = record.question
+        question["answer"] = record.answer if len(record.alternate_spellings) == 0 or random.randint(0, 1) == 0 \
+            else random.choice(record.alternate_spellings)
+        question["options"] = random.sample(record.suggestions, 2) + [question["answer"]]
         random.shuffle(question["options"])
         return question
 
@@ -219,11 +579,12 @@ class QuestionManager:
 
         Returns:
              question - (dict) first question in the queue (self.questions_q), this question has the following keys:
-                "question", "options", "answer", "hash" (as per map_question_str2dict specification). Returns an empty
+                "question", "options", "answer", "hash" (as per _map_record2dict specification). Returns an empty
                 question if there are no questions in the queue (this is a sign of an error or a bug).
         """
         if len(self.questions_q) - 1 < self.min_questions:
-            eventlet.spawn(self._prepare_game_questions)
+            # A refill shed by a saturated pool is retried by the next pop
+            task_pools["questions"].submit(self._prepare_game_questions)
         if len(self.questions_q) == 0:
             return {
                 "question": "",
@@ -233,3 +594,108 @@ class QuestionManager:
             }
         else:
             return self.questions_q.popleft()
+
+
+class DeckPool:
+    """
+    A bounded pool of question decks ready for the new games, where a deck is a QuestionManager with its first questions
+    drawn, their options sampled and shuffled, so a game takes a deck in O(1) and its first round never waits for the
+    questions. A background producer keeps the pool filled, one deck at a time off the critical path, with as many decks
+    as the games expected to start within the lead time (DECK_LEAD_TIME), estimated from the smoothed game start rate.
+    The decks drawn from an outdated question bank are dropped.
+    """
+
+    def __init__(self, bank=None, min_decks=None, max_decks=None, lead_time=None, rate_interval=None):
+        """
+        Arguments:
+            bank - (QuestionBank) where get the questions, the process question bank by default.
+            min_decks - (int) minimum number of decks kept ready.
+            max_decks - (int) maximum number of decks kept ready.
+            lead_time - (float) time in seconds of the game starts the decks are kept ready for.
+            rate_interval - (float) time in seconds between the game start rate estimates.
+        """
+        self.bank = question_bank if bank is None else bank
+        self.min_decks = conf.DECK_POOL_MIN if min_decks is None else min_decks
+        self.max_decks = conf.DECK_POOL_MAX if max_decks is None else max_decks
+        self.lead_time = conf.DECK_LEAD_TIME if lead_time is None else lead_time
+        self.rate_interval = conf.DECK_RATE_INTERVAL if rate_interval is None else rate_interval
+        self.logger = None
+        self.decks = deque()  # (question bank version, QuestionManager)
+        self.target = self.min_decks  # Number of decks to be kept ready
+        self.start_rate = 0.0  # Smoothed number of game starts per second
+        self._start_cnt = 0  # Game starts since the latest rate estimate
+        self._wakeup = eventlet.queue.LightQueue()
+
+    def __len__(self):
+        """
+        Propagates the number of ready decks as the object length
+        """
+        return len(self.decks)
+
+    def take(self):
+        """
+        Takes a deck for a new game.
+
+        Returns:
+            question_manager - (QuestionManager) the questions of the game, None if no deck is ready (the game
+                prepares its own questions).
+        """
+        self._start_cnt += 1
+        if self._wakeup.getting():
+            # The producer is waiting for the pool to go below the target
+            self._wakeup.put(None)
+        while self.decks:
+            version, question_manager = self.decks.popleft()
+            if version == self.bank.version:
+                return question_manager
+        metrics.DECK_POOL_MISSES.inc()
+        return None
+
+    def _prepare_deck(self):
+        question_manager = QuestionManager(self.logger, bank=self.bank, is_prepared_in_background=False)
+        question_manager._prepare_game_questions()
+        return self.bank.version, question_manager
+
+    def _update_target(self, start_rate):
+        """
+        Smooths the game start rate and sets the number of decks to be kept ready accordingly.
+        """
+        self.start_rate = conf.DECK_RATE_SMOOTHING * start_rate + (1 - conf.DECK_RATE_SMOOTHING) * self.start_rate
+        self.target = min(max(math.ceil(self.start_rate * self.lead_time), self.min_decks), self.max_decks)
+
+    def run(self):
+        """
+        Keeps the pool filled up to the target number of decks.
+        """
+        rate_started = time.monotonic()
+        while True:
+            now = time.monotonic()
+            if now - rate_started >= self.rate_interval:
+                self._update_target(self._start_cnt / (now - rate_started))
+                self._start_cnt = 0
+                rate_started = now
+            if self.decks and self.decks[-1][0] != self.bank.version:
+                self.decks.clear()
+            if len(self.decks) >= self.target or not all(self.bank.size(key) for key in self.bank.redis_keys):
+                try:
+                    self._wakeup.get(timeout=conf.DECK_REFILL_INTERVAL)
+                except eventlet.queue.Empty:
+                    pass
+                continue
+            try:
+                self.decks.append(self._prepare_deck())
+            except Exception as e:
+                self.logger.error(f"Question deck preparation failed: {e}")
+                eventlet.sleep(conf.DECK_REFILL_INTERVAL)
+            # The games go first
+            eventlet.sleep(0)
+
+    def start(self, logger):
+        """
+        Keeps the pool filled in the background.
+        """
+        self.logger = logger
+        task_pools.spawn(self.run)
+
+
+deck_pool = DeckPool()
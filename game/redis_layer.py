@@ -0,0 +1,177 @@
+import time
+import random
+import eventlet
+import redis
+
+import game.config_variables as conf
+
+
+class MeteredConnectionPool(redis.BlockingConnectionPool):
+    """
+    A bounded connection pool: a command waits for a free connection up to the pool timeout instead of opening a new
+    one. Keeps the statistics of acquiring connections.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.waiting = 0  # Commands currently waiting for a connection
+        self.acquired_cnt = 0
+        self.exhausted_cnt = 0  # Commands failed as no connection was freed in time
+        self.wait_time = 0.0  # Total time in seconds spent acquiring connections
+        self.max_wait_time = 0.0
+
+    def get_connection(self, command_name, *keys, **options):
+        started = time.monotonic()
+        self.waiting += 1
+        try:
+            connection = super().get_connection(command_name, *keys, **options)
+        except redis.ConnectionError as e:
+            if str(e) == "No connection available.":
+                self.exhausted_cnt += 1
+            raise
+        finally:
+            self.waiting -= 1
+            wait_time = time.monotonic() - started
+            self.wait_time += wait_time
+            self.max_wait_time = max(self.max_wait_time, wait_time)
+        self.acquired_cnt += 1
+        return connection
+
+    def get_stats(self):
+        """
+        Returns the pool statistics (dict).
+        """
+        idle = sum(1 for connection in list(self.pool.queue) if connection is not None)
+        return {
+            "max_connections": self.max_connections,
+            "in_use": len(self._connections) - idle,
+            "waiting": self.waiting,
+            "acquired": self.acquired_cnt,
+            "exhausted": self.exhausted_cnt,
+            "wait_time": self.wait_time,
+            "max_wait_time": self.max_wait_time,
+        }
+
+
+# Commands which are safe to repeat if the connection fails after they are sent, as they do not change the data
+IDEMPOTENT_COMMANDS = frozenset((
+    "PING", "SCRIPT", "EXISTS", "TTL", "PTTL", "GET", "MGET", "HGET", "HMGET", "HGETALL", "HLEN", "LLEN", "LRANGE",
+    "SCARD", "SISMEMBER", "SMEMBERS", "ZCARD", "ZSCORE", "ZRANGE", "ZRANGEBYSCORE", "XLEN", "XRANGE", "SCAN",
+))
+
+
+class RetryingRedis(redis.Redis):
+    """
+    Redis client that retries a command with exponential backoff if it fails before the command is sent, i.e. no
+    connection is freed in the pool in time or the connection to redis cannot be made (or times out). Once a command is sent it might
+    have been executed whatever happens to the connection afterwards (e.g. the reply is lost to a reset), so it is only
+    retried then if it does not change the data (see IDEMPOTENT_COMMANDS). Pipelines are not retried.
+    """
+
+    def __init__(self, *args, retry_attempts=None, retry_backoff=None, **kwargs):
+        """
+        Arguments:
+            retry_attempts - (int) maximum number of attempts to execute a command.
+            retry_backoff - (float) time in seconds before the first retry, it doubles with every next retry.
+        """
+        super().__init__(*args, **kwargs)
+        self.retry_attempts = conf.REDIS_RETRY_ATTEMPTS if retry_attempts is None else retry_attempts
+        self.retry_backoff = conf.REDIS_RETRY_BACKOFF if retry_backoff is None else retry_backoff
+        self.retried_cnt = 0
+
+    def _backoff(self, attempt):
+        self.retried_cnt += 1
+        eventlet.sleep(self.retry_backoff * 2 ** (attempt - 1) * random.uniform(0.5, 1.5))
+
+    def execute_command(self, *args, **options):
+        pool = self.connection_pool
+        command_name = args[0]
+        attempt = 1
+        while True:
+            try:
+                # Takes a connection from the pool and connects it, nothing is sent to redis yet
+                connection = self.connection or pool.get_connection(command_name, **options)
+            except (redis.ConnectionError, redis.TimeoutError):
+                if attempt >= self.retry_attempts:
+                    raise
+                self._backoff(attempt)
+                attempt += 1
+                continue
+            try:
+                connection.send_command(*args)
+                return self.parse_response(connection, command_name, **options)
+            except (redis.ConnectionError, redis.TimeoutError) as e:
+                connection.disconnect()
+                if isinstance(e, redis.TimeoutError) or command_name.upper() not in IDEMPOTENT_COMMANDS or \
+                   attempt >= self.retry_attempts:
+                    raise
+            finally:
+                if not self.connection:
+                    pool.release(connection)
+            self._backoff(attempt)
+            attempt += 1
+
+
+class RedisLayer:
+    """
+    Redis clients of the server instance, one per kind of work, each of them with its own bounded connection pool (see
+    REDIS_POOLS in config_variables.py), so a burst of one kind of work (e.g. a slow game round) does not starve the
+    others (e.g. logins):
+        - "hot" - player registration, answers and player updates;
+        - "game" - game rounds;
+        - "background" - question bank, instance scheduling and game failover;
+        - "pubsub" - room subscriptions, which hold their connection while waiting for messages.
+    *This is a singleton.
+    """
+    _singleton = None
+
+    def __new__(cls, *args, **kwargs):
+        """
+        Assures that class follows the singleton patter.
+        """
+        assert cls._singleton is None, "This class instance reinitialization is not expected"
+        if not cls._singleton:
+            cls._singleton = super(RedisLayer, cls).__new__(cls)
+        return cls._singleton
+
+    def __init__(self, redis_url, pools=None):
+        """
+        Arguments:
+            redis_url - (str) redis to connect to.
+            pools - (dict) role to (maximum number of connections, time in seconds to wait for a free connection, socket
+                timeout in seconds).
+        """
+        self.clients = {}
+        for role, (max_connections, timeout, socket_timeout) in (conf.REDIS_POOLS if pools is None else pools).items():
+            connection_pool = MeteredConnectionPool.from_url(
+                redis_url,
+                max_connections=max_connections,
+                timeout=timeout,
+                socket_timeout=socket_timeout,
+                socket_connect_timeout=conf.REDIS_CONNECT_TIMEOUT,
+                decode_responses=True,
+            )
+            self.clients[role] = RetryingRedis(connection_pool=connection_pool)
+
+    @property
+    def hot(self):
+        return self.clients["hot"]
+
+    @property
+    def game(self):
+        return self.clients["game"]
+
+    @property
+    def background(self):
+        return self.clients["background"]
+
+    @property
+    def pubsub(self):
+        return self.clients["pubsub"]
+
+    def get_stats(self):
+        """
+        Returns the connection pool statistics and the number of retried commands of every client (role to dict).
+        """
+        return {role: {**client.connection_pool.get_stats(), "retried": client.retried_cnt}
+                for role, client in self.clients.items()}
@@ -0,0 +1,160 @@
+import json
+import time
+import eventlet
+
+import game.config_variables as conf
+import game.metrics as metrics
+from game.tasks import task_pools
+
+
+class InstanceScheduler:
+    """
+    A thread-like object, that heartbeats the load of this server instance (active games, connected sockets and event
+    loop lag) into redis and keeps a snapshot of the load of all the live server instances for picking the least loaded
+    one to host a new game. It also runs the games other server instances have assigned to this one (when started).
+    *This is a singleton.
+    """
+    _singleton = None
+
+    def __new__(cls, *args, **kwargs):
+        """
+        Assures that class follows the singleton patter.
+        """
+        assert cls._singleton is None, "This class instance reinitialization is not expected"
+        if not cls._singleton:
+            cls._singleton = super(InstanceScheduler, cls).__new__(cls)
+        return cls._singleton
+
+    def __init__(self, server_name, redis_client, user_registry, logger, heartbeat_interval=None):
+        """
+        Arguments:
+             server_name - (str) name of the server instance that runs this code.
+             redis_client - (obj) redis client for sharing the server instance load.
+             user_registry - (UserRegistry) clients connected to this server instance.
+             logger - (obj) app logger.
+             heartbeat_interval - (float) time in seconds between the load updates.
+        """
+        self.server_name = server_name
+        self.redis_client = redis_client
+        self.user_registry = user_registry
+        self.logger = logger
+        self.heartbeat_interval = conf.HEARTBEAT_INTERVAL if heartbeat_interval is None else heartbeat_interval
+        # Load of this server instance
+        self.active_games = 0  # Maintained by GameFactory
+        self.loop_lag = 0.0  # Smoothed event loop lag in seconds
+        # Load snapshot of all the live server instances, server name to its load score
+        self.instance_loads = {}
+
+    @property
+    def games_key(self):
+        """
+        Redis list where other server instances push the rooms this server instance is to run games in.
+        """
+        return f"{self.server_name}-GAMES"
+
+    def get_load(self):
+        """
+        Returns:
+            load - (dict) load of this server instance: "games", "sockets" and "loop_lag".
+        """
+        return {"games": self.active_games, "sockets": len(self.user_registry), "loop_lag": self.loop_lag}
+
+    def get_load_score(self):
+        """
+        Returns:
+            score - (float) single number load of this server instance, the lower the better.
+        """
+        return self.active_games * conf.LOAD_GAME_WEIGHT + len(self.user_registry) + \
+            self.loop_lag * conf.LOAD_LAG_WEIGHT
+
+    def pick_host(self):
+        """
+        Picks the least loaded live server instance to host a new game, the snapshot is not changed as the game might
+        not be created (see InstanceScheduler.add_game).
+
+        Returns:
+            server_name - (str) name of the picked server instance.
+        """
+        self.instance_loads.setdefault(self.server_name, self.get_load_score())
+        return min(self.instance_loads, key=self.instance_loads.get)
+
+    def add_game(self, server_name):
+        """
+        Increases the load of the server instance in the snapshot by a game assigned to it, so the games assigned until
+        the next heartbeat are spread among the instances.
+        """
+        if server_name in self.instance_loads:
+            self.instance_loads[server_name] += conf.LOAD_GAME_WEIGHT
+
+    def heartbeat(self):
+        """
+        Publishes the load of this server instance, drops the instances with expired heartbeats and updates the load
+        snapshot.
+        """
+        now = time.time()
+        pipe = self.redis_client.pipeline(transaction=False)
+        pipe.zadd(conf.INSTANCE_HEARTBEATS, {self.server_name: now})
+        pipe.zadd(conf.INSTANCE_LOADS, {self.server_name: self.get_load_score()})
+        pipe.hset(conf.INSTANCE_INFO, self.server_name, json.dumps(self.get_load()))
+        pipe.zrangebyscore(conf.INSTANCE_HEARTBEATS, "-inf", now - conf.HEARTBEAT_TTL)
+        pipe.zrange(conf.INSTANCE_LOADS, 0, -1, withscores=True)
+        with metrics.REDIS_LATENCY.time(site="heartbeat"):
+            dead_instances, instance_loads = pipe.execute()[-2:]
+
+        if dead_instances:
+            self.logger.warning(f"Server instances stopped sending heartbeats: {dead_instances}")
+            pipe = self.redis_client.pipeline(transaction=False)
+            pipe.zrem(conf.INSTANCE_HEARTBEATS, *dead_instances)
+            pipe.zrem(conf.INSTANCE_LOADS, *dead_instances)
+            pipe.hdel(conf.INSTANCE_INFO, *dead_instances)
+            pipe.execute()
+        dead_instances = set(dead_instances)
+        self.instance_loads = {server_name: score for server_name, score in instance_loads
+                               if server_name not in dead_instances}
+
+    def _run_heartbeat(self):
+        """
+        Sends heartbeats until the process ends.
+        """
+        while True:
+            try:
+                self.heartbeat()
+            except Exception as e:
+                self.logger.error(f"Server instance heartbeat failed: {e}")
+            eventlet.sleep(self.heartbeat_interval)
+
+    def _run_lag_monitor(self):
+        """
+        Measures how late the event loop wakes up a sleeping greenlet and keeps its moving average.
+        """
+        while True:
+            started = time.monotonic()
+            eventlet.sleep(conf.LOOP_LAG_INTERVAL)
+            lag = max(time.monotonic() - started - conf.LOOP_LAG_INTERVAL, 0.0)
+            self.loop_lag = 0.8 * self.loop_lag + 0.2 * lag
+
+    def _run_assigned_games(self, create_new_game):
+        """
+        Runs the games other server instances have assigned to this one.
+        """
+        while True:
+            try:
+                item = self.redis_client.blpop(self.games_key, timeout=conf.ASSIGNED_GAMES_TIMEOUT)
+            except Exception as e:
+                self.logger.error(f"Failed to get assigned games: {e}")
+                eventlet.sleep(self.heartbeat_interval)
+                continue
+            if item:
+                task_pools["game_start"].spawn(create_new_game, item[1])
+
+    def start(self, create_new_game):
+        """
+        Maintains the heartbeats and runs the assigned games in the background.
+
+        Arguments:
+            create_new_game - (function) creates and starts a game in the room which name is the only argument.
+        """
+        self.heartbeat()
+        task_pools.spawn(self._run_heartbeat)
+        task_pools.spawn(self._run_lag_monitor)
+        task_pools.spawn(self._run_assigned_games, create_new_game)
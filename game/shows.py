@@ -0,0 +1,390 @@
+import json
+import time
+
+import game.config_variables as conf
+import game.metrics as metrics
+from game.profiler import profiler
+from game.tasks import task_pools
+from game.timers import deadline_scheduler, monotonic2epoch_ms
+from game.modules import Game
+
+
+# Registers a player to a show in one round trip (see ShowRegistry.register_player):
+#   KEYS[1] - OPEN_SHOWS;
+#   ARGV[1] - username, ARGV[2] - name of the server instance the player is connected to.
+# Players join the oldest open show, into the shard of their server instance. A show stops accepting players when its
+# game starts (see Show._close_joining).
+# Returns {room_name, status, last_seq}, where status is 1 if the player is registered, 0 if the username is taken and
+# -1 if no show is open, and last_seq is the id of the latest entry in the show event stream (empty if there is none).
+REGISTER_SHOW_PLAYER_SCRIPT = """
+local shows = redis.call('ZRANGE', KEYS[1], 0, 0)
+if #shows == 0 then
+    return {'', -1, ''}
+end
+local room_name = shows[1]
+if redis.call('SADD', room_name .. '-NAMES', ARGV[1]) == 0 then
+    return {room_name, 0, ''}
+end
+redis.call('SADD', room_name .. '-SHARD-' .. ARGV[2], ARGV[1])
+redis.call('SADD', room_name .. '-SHARDS', ARGV[2])
+local events = redis.call('XREVRANGE', room_name .. '-EVENTS', '+', '-', 'COUNT', 1)
+return {room_name, 1, events[1] and events[1][1] or ''}
+"""
+
+
+def get_shard_key(room_name, server_name):
+    """
+    Returns the redis set of the players of the show who are still in the game and connected to the server instance.
+    """
+    return f"{room_name}-SHARD-{server_name}"
+
+
+class ShowShard:
+    """
+    The part of a show played by the players connected to this server instance. The shard scores the answers of its
+    players in memory, reports the answer counts of every round to the coordinating game (see Show) at the round
+    deadline and eliminates its players who answered incorrectly when the round stats are published, so no player set
+    or answer of the show crosses server instances.
+    """
+
+    def __init__(self, room_name, server_name, redis_client, logger):
+        """
+        Arguments:
+            room_name - (str) the show room name.
+            server_name - (str) name of the server instance that runs this code.
+            redis_client - (obj) redis client for reporting the round answers and keeping the shard set.
+            logger - (obj) app logger.
+        """
+        self.room_name = room_name
+        self.server_name = server_name
+        self.redis_client = redis_client
+        self.logger = logger
+        self.players = set()  # Players of this shard who are still in the game
+        # The current round, as announced by the "new_round" message
+        self.round_answer_key = None
+        self.round_deadline_ms = 0
+        self.options = []
+        self.answers = {}  # Player's name to the answer
+        self.option_cnt = {}  # Number of answers for every option
+
+    @property
+    def shard_key(self):
+        return get_shard_key(self.room_name, self.server_name)
+
+    def open_round(self, msg):
+        """
+        Starts accepting the answers to the round announced by a "new_round" message, the answers are reported at the
+        round deadline.
+        """
+        self.round_answer_key = msg["round_answer_key"]
+        self.round_deadline_ms = msg["deadline"]
+        self.options = msg["options"]
+        self.answers = {}
+        self.option_cnt = dict.fromkeys(self.options, 0)
+        deadline = time.monotonic() + self.round_deadline_ms / 1000 - time.time()
+        deadline_scheduler.call_at(deadline, self._report, self.round_answer_key)
+
+    def submit_answer(self, round_answer_key, username, answer):
+        """
+        Registers a player's answer in memory.
+
+        Returns:
+            status - (int) 1 if the answer is registered, 2 if the player has already answered, 0 if the player is not
+                in the game and -1 if the round is closed (same as Game.submit_answer).
+        """
+        if round_answer_key != self.round_answer_key or time.time() * 1000 > self.round_deadline_ms:
+            return -1
+        if username not in self.players:
+            return 0
+        if username in self.answers:
+            return 2
+        self.answers[username] = answer
+        if answer in self.option_cnt:
+            self.option_cnt[answer] += 1
+        else:
+            self.logger.error(f"Player's answer does not match any available options, username: {username}, "
+                              f"answer: {answer}, available options: {self.options}")
+        return 1
+
+    def _report(self, round_answer_key):
+        """
+        Adds the answer counts of this shard to the round answer counts of the show and marks the shard as reported.
+        """
+        profiler.tag(self.room_name)
+        if round_answer_key != self.round_answer_key:
+            return
+        self.round_answer_key = None
+        stats_key = f"{round_answer_key}-SHARD-STATS"
+        reports_key = f"{round_answer_key}-SHARD-REPORTS"
+        pipe = self.redis_client.pipeline(transaction=True)
+        for option, cnt in self.option_cnt.items():
+            if cnt:
+                pipe.hincrby(stats_key, option, cnt)
+        pipe.sadd(reports_key, self.server_name)
+        # The counts expire on their own if the show does not collect them
+        pipe.pexpireat(stats_key, self.round_deadline_ms + 60000)
+        pipe.pexpireat(reports_key, self.round_deadline_ms + 60000)
+        with metrics.REDIS_LATENCY.time(site="show_report"):
+            pipe.execute()
+
+    def close_round(self, msg, options, answers):
+        """
+        Eliminates the players of this shard who answered the round incorrectly or did not answer, as announced by a
+        "round_stats" message.
+
+        Arguments:
+            msg - (dict) the "round_stats" message.
+            options - (list) options of the round.
+            answers - (dict) answers of the players to the round, player's name to the answer.
+        """
+        profiler.tag(self.room_name)
+        correct_idx = msg["correct"]
+        correct_answer = options[correct_idx] if 0 <= correct_idx < len(options) else None
+        eliminated = [username for username in self.players if answers.get(username) != correct_answer]
+        if eliminated:
+            self.players.difference_update(eliminated)
+            with metrics.REDIS_LATENCY.time(site="show_eliminate"):
+                self.redis_client.srem(self.shard_key, *eliminated)
+
+
+class ShowRegistry:
+    """
+    Registers the players connected to this server instance to the shows and keeps a shard of every show with players
+    on this server instance (see ShowShard). The shards follow the rounds of their shows from the room messages (see
+    RedisSubscriptionService.add_message_listener). *This is a singleton.
+    """
+    _singleton = None
+
+    def __new__(cls, *args, **kwargs):
+        """
+        Assures that class follows the singleton patter.
+        """
+        assert cls._singleton is None, "This class instance reinitialization is not expected"
+        if not cls._singleton:
+            cls._singleton = super(ShowRegistry, cls).__new__(cls)
+        return cls._singleton
+
+    def __init__(self, server_name, redis_client, logger, flush_delay=None, game_redis_client=None):
+        """
+        Arguments:
+             server_name - (str) name of the server instance that runs this code.
+             redis_client - (obj) redis client for registering players.
+             logger - (obj) app logger.
+             flush_delay - (float) time in seconds for collecting the players who left before removing them at once.
+             game_redis_client - (obj) redis client for running the shards, the same as redis_client if not provided.
+        """
+        self.server_name = server_name
+        self.redis_client = redis_client
+        self.game_redis_client = redis_client if game_redis_client is None else game_redis_client
+        self.logger = logger
+        self.flush_delay = conf.PLAYERS_UPDATE_FLUSH_DELAY if flush_delay is None else flush_delay
+        # Shows with players on this server instance, room name to shard
+        self.shards = {}
+        self._left_buffer = []
+        self._is_flush_scheduled = False
+        self._register_script = self.redis_client.register_script(REGISTER_SHOW_PLAYER_SCRIPT)
+
+    def register_player(self, username):
+        """
+        Registers a player to the oldest open show in redis (see GameFactory.register_player for the returned values).
+        """
+        with metrics.REDIS_LATENCY.time(site="register_show_player"):
+            room_name, status, last_seq = self._register_script(keys=[conf.OPEN_SHOWS],
+                                                                args=[username, self.server_name])
+
+        if status == 0:
+            return username, False, set(), 0, False, '{' \
+                '"msg": "This username already exists, please pick a different one", ' \
+                '"type": "info"' \
+                '}', ""
+        elif status < 0:
+            return username, False, set(), 0, False, '{' \
+                '"msg": "No show is open for joining at the moment, please try again later", ' \
+                '"type": "info"' \
+                '}', ""
+        profiler.tag(room_name)
+        shard = self.shards.get(room_name)
+        if shard is None:
+            shard = self.shards[room_name] = ShowShard(room_name, self.server_name, self.game_redis_client,
+                                                       self.logger)
+        shard.players.add(username)
+        # The other players of a show are not listed
+        return username, room_name, set(), 0, True, "", last_seq
+
+    def submit_answer(self, room_name, round_answer_key, username, answer):
+        """
+        Registers a player's answer in the shard of the show (see ShowShard.submit_answer).
+        """
+        shard = self.shards.get(room_name)
+        return 0 if shard is None else shard.submit_answer(round_answer_key, username, answer)
+
+    def room_messages(self, room_name, msg_strs):
+        """
+        Follows the rounds of the shows with players on this server instance. Only the round messages of the shows are
+        parsed, as the messages are dispatched to the clients without parsing them.
+        """
+        shard = self.shards.get(room_name)
+        if shard is None:
+            return
+        for msg_str in msg_strs:
+            if msg_str.startswith('{"type":"new_round"'):
+                shard.open_round(json.loads(msg_str))
+            elif msg_str.startswith('{"type":"round_stats"'):
+                # The next round might be opened before the players are eliminated, so the round answers go along
+                task_pools["game_io"].spawn(shard.close_round, json.loads(msg_str), shard.options, shard.answers)
+
+    def room_opened(self, room_name):
+        pass
+
+    def room_closed(self, room_name):
+        """
+        Drops the shard of a show which has no players on this server instance anymore.
+        """
+        if self.shards.pop(room_name, None) is not None:
+            task_pools["game_io"].spawn(self.redis_client.srem, f"{room_name}-SHARDS", self.server_name)
+
+    def player_left(self, player):
+        """
+        Removes a player who left a show from its shard, the players are removed in one go (see
+        ShowRegistry._flush_left).
+        """
+        shard = self.shards.get(player.room_name)
+        if shard is None:
+            return
+        shard.players.discard(player.username)
+        self._left_buffer.append(player)
+        if not self._is_flush_scheduled:
+            self._is_flush_scheduled = True
+            task_pools.spawn_after(self.flush_delay, self._flush_left)
+
+    def _flush_left(self):
+        """
+        Removes the players who left the shows since the previous flush from their shards and frees their names, with
+        a single pipelined round trip.
+        """
+        left_buffer, self._left_buffer = self._left_buffer, []
+        self._is_flush_scheduled = False
+        rooms = {}
+        for player in left_buffer:
+            rooms.setdefault(player.room_name, []).append(player.username)
+        pipe = self.redis_client.pipeline(transaction=False)
+        for room_name, usernames in rooms.items():
+            pipe.srem(get_shard_key(room_name, self.server_name), *usernames)
+            pipe.srem(f"{room_name}-NAMES", *usernames)
+        with metrics.REDIS_LATENCY.time(site="show_player_update"):
+            pipe.execute()
+
+
+class Show(Game):
+    """
+    A game for a mega-room: the players are partitioned into shards, one per server instance they are connected to
+    (see ShowShard), so the game coordinating the show only merges the per-shard answer counts into the round stats and
+    the round close does not grow with the audience. The players figure out whether they are still in the game from
+    the round stats, the eliminated players are not broadcast, neither are the live answer counts.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.players_cnt = 0  # Players who are still in the show, across all the shards
+        super().__init__(*args, **kwargs)
+
+    @property
+    def shards_key(self):
+        """
+        Redis set of the server instances with a shard of the show.
+        """
+        return f"{self.room_name}-SHARDS"
+
+    def _get_payers(self):
+        profiler.tag(self.room_name)
+        with metrics.REDIS_LATENCY.time(site="game_players"):
+            server_names = self.redis_client.smembers(self.shards_key)
+            pipe = self.redis_client.pipeline(transaction=False)
+            for server_name in server_names:
+                pipe.scard(get_shard_key(self.room_name, server_name))
+            self.players_cnt = sum(pipe.execute())
+
+    def _publish_progress(self, round_answer_key):
+        pass
+
+    def _close_round(self, question, round_answer_key, is_grace_over=False):
+        """"
+        Closes the round once all the shards have reported their answers (or when the report timeout is over), and
+        publishes the merged round stats. The shards eliminate their players who answered incorrectly on their own.
+
+        Arguments:
+            question - (dict) question asked in the round.
+            round_answer_key - (str) key of the round, the shards report to "<key>-SHARD-STATS".
+            is_grace_over - (bool) whether the report timeout is over.
+        """
+        profiler.tag(self.room_name)
+        if self.is_stopped:
+            self._stop()
+            return
+        stats_key = f"{round_answer_key}-SHARD-STATS"
+        reports_key = f"{round_answer_key}-SHARD-REPORTS"
+        pipe = self.redis_client.pipeline(transaction=False)
+        pipe.smembers(self.shards_key)
+        pipe.smembers(reports_key)
+        with metrics.REDIS_LATENCY.time(site="show_reports"):
+            server_names, reported = pipe.execute()
+        if not server_names.issubset(reported) and not is_grace_over:
+            is_grace_over = time.monotonic() + conf.SHOW_REPORT_POLL > self.round_deadline + conf.SHOW_REPORT_TIMEOUT
+            deadline_scheduler.call_later(conf.SHOW_REPORT_POLL, self._close_round, question, round_answer_key,
+                                          is_grace_over)
+            return
+        if not server_names.issubset(reported):
+            self.logger.warning(f"Shards {list(server_names - reported)} of the show in {self.room_name} have not "
+                                f"reported round {self.round_cnt} in time")
+        self.round_answer_key = None
+        pipe = self.redis_client.pipeline(transaction=True)
+        pipe.hgetall(stats_key)
+        pipe.delete(f"{round_answer_key}-DEADLINE", stats_key, reports_key)
+        with metrics.REDIS_LATENCY.time(site="close_round"):
+            shard_cnt, _ = pipe.execute()
+
+        correct_answer = question["answer"]
+        correct_idx = question["options"].index(correct_answer) if correct_answer in question["options"] else -1
+        counts = self._get_option_counts(shard_cnt)
+        correct_cnt = counts[correct_idx] if correct_idx >= 0 else 0
+        task_pools["game_io"].spawn(self._publish, {
+            "type": "round_stats",
+            "round": self.round_cnt,
+            "counts": counts,
+            "answered": max(self.players_cnt, sum(counts)),
+            "correct": correct_idx,
+            "players_in_game": correct_cnt,
+            "show": True,
+            "server_time": monotonic2epoch_ms(time.monotonic()),
+        })
+        self.players_cnt = correct_cnt
+        self.checkpoint()
+
+        if correct_cnt > 1 and not self.is_stopped:
+            self.next_deadline = self.round_deadline + conf.ROUND_BREAK
+            deadline_scheduler.call_at(self.next_deadline, self._open_round)
+        elif self.is_stopped:
+            self._stop()
+        else:
+            self._end()
+
+    def start(self, game_timer=None, round_timer=None, on_end=None):
+        if self.is_resumed:
+            # Reports to the interrupted round must not be counted in the round which replays it
+            round_answer_key = f"{self.room_name}-ROUND-{self.round_cnt + 1}-ANSWERS"
+            self.redis_client.delete(f"{round_answer_key}-SHARD-STATS", f"{round_answer_key}-SHARD-REPORTS")
+        super().start(game_timer, round_timer, on_end)
+
+    def _close_joining(self):
+        profiler.tag(self.room_name)
+        with metrics.REDIS_LATENCY.time(site="close_joining"):
+            self.redis_client.zrem(conf.OPEN_SHOWS, self.room_name)
+        self._get_payers()
+
+    def _end(self):
+        """
+        Cleans up the show records (including the shards) when the show is over.
+        """
+        server_names = self.redis_client.smembers(self.shards_key)
+        self.redis_client.delete(self.shards_key, f"{self.room_name}-NAMES",
+                                 *(get_shard_key(self.room_name, server_name) for server_name in server_names))
+        super()._end()
@@ -0,0 +1,100 @@
+import time
+import eventlet
+
+import game.config_variables as conf
+import game.metrics as metrics
+from game.tasks import task_pools
+
+
+class Startup:
+    """
+    A thread-like object, that warms the server instance up in phases in the background (when started), so the process
+    accepts connections as soon as it is imported: the import only builds the objects, the phases connect to redis,
+    load the questions, subscribe and start the background services. A phase which fails is retried until it succeeds,
+    so the phases are expected to be safe to repeat. The server instance is ready when all the phases are done, the
+    traffic is gated on it (see the /readyz endpoint). *This is a singleton.
+    """
+    _singleton = None
+
+    def __new__(cls, *args, **kwargs):
+        """
+        Assures that class follows the singleton patter.
+        """
+        assert cls._singleton is None, "This class instance reinitialization is not expected"
+        if not cls._singleton:
+            cls._singleton = super(Startup, cls).__new__(cls)
+        return cls._singleton
+
+    def __init__(self, logger, retry_interval=None):
+        """
+        Arguments:
+             logger - (obj) app logger.
+             retry_interval - (float) time in seconds before a failed phase is retried.
+        """
+        self.logger = logger
+        self.retry_interval = conf.STARTUP_RETRY_INTERVAL if retry_interval is None else retry_interval
+        self.created = time.monotonic()  # The start up is created first thing on import
+        self.phases = []  # (phase name, function)
+        self.phase = None  # Phase in progress
+        self.phase_timings = {}  # Phase name to the time in seconds it took, including the import
+        self.is_ready = False
+        self.ready_time = None  # Time in seconds from the import to being ready
+        self.last_error = None
+
+    def add_phase(self, name, function):
+        """
+        Registers a phase, the phases run in the order they are added.
+
+        Arguments:
+            name - (str) phase name.
+            function - (function) does the phase work, called without arguments.
+        """
+        self.phases.append((name, function))
+
+    def _record(self, name, started):
+        self.phase_timings[name] = time.monotonic() - started
+        metrics.STARTUP_PHASE_SECONDS.set(self.phase_timings[name], phase=name)
+
+    def run(self):
+        """
+        Runs the phases one by one, a failed phase is retried until it succeeds.
+        """
+        for name, function in self.phases:
+            self.phase = name
+            started = time.monotonic()
+            while True:
+                try:
+                    function()
+                    break
+                except Exception as e:
+                    self.last_error = f"{name}: {e}"
+                    self.logger.error(f"Start up phase '{name}' failed, it is retried in {self.retry_interval} sec: "
+                                      f"{e}")
+                    eventlet.sleep(self.retry_interval)
+            self._record(name, started)
+        self.phase = None
+        self.last_error = None
+        self.ready_time = time.monotonic() - self.created
+        self.is_ready = True
+        timings = ", ".join(f"{name} {seconds:.3f}" for name, seconds in self.phase_timings.items())
+        self.logger.info(f"Server instance is ready in {self.ready_time:.3f} sec ({timings})")
+
+    def start(self):
+        """
+        Runs the phases in the background, called at the end of the import.
+        """
+        self._record("import", self.created)
+        task_pools.spawn(self.run)
+
+    def get_status(self):
+        """
+        Returns the start up status (dict).
+        """
+        return {
+            "is_ready": self.is_ready,
+            "phase": self.phase,
+            "phase_timings": {name: round(seconds, 3) for name, seconds in self.phase_timings.items()},
+            "ready_time": None if self.ready_time is None else round(self.ready_time, 3),
+            "uptime": round(time.monotonic() - self.created, 3),
+            "error": self.last_error,
+        }
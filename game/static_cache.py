@@ -0,0 +1,180 @@
+import os
+import gzip
+import hashlib
+import mimetypes
+
+import game.config_variables as conf
+
+try:
+    import brotli
+except ImportError:  # brotli is optional, the clients get gzip without it
+    brotli = None
+
+
+IDENTITY_ENCODING = "identity"
+GZIP_ENCODING = "gzip"
+BROTLI_ENCODING = "br"
+# Content encodings the assets are stored in, the most compact first
+CONTENT_ENCODINGS = (BROTLI_ENCODING, GZIP_ENCODING, IDENTITY_ENCODING) if brotli is not None \
+    else (GZIP_ENCODING, IDENTITY_ENCODING)
+# ETag suffix of every content encoding, each stored variant has its own strong ETag
+ETAG_SUFFIXES = {IDENTITY_ENCODING: "", GZIP_ENCODING: "-gz", BROTLI_ENCODING: "-br"}
+
+
+def compress(body, encoding):
+    """
+    Compresses the asset body with the content encoding at the highest level, as it is only done once.
+    """
+    if encoding == BROTLI_ENCODING:
+        return brotli.compress(body, quality=11)
+    if encoding == GZIP_ENCODING:
+        # A fixed modification time keeps the output (and so its ETag) the same across restarts
+        return gzip.compress(body, compresslevel=9, mtime=0)
+    return body
+
+
+def negotiate_content_encoding(accept_encoding, encodings):
+    """
+    Picks the content encoding of the response from the "Accept-Encoding" request header.
+
+    Arguments:
+        accept_encoding - (str) the header value, None if the request has no such header.
+        encodings - (tuple) encodings the asset is stored in, the most compact first.
+
+    Returns:
+        encoding - (str) the most compact encoding the client accepts, identity if it accepts none of them.
+    """
+    accepted = {}
+    for item in (accept_encoding or "").split(","):
+        coding, _, params = item.strip().partition(";")
+        quality = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        accepted[coding.strip().lower()] = quality
+    for encoding in encodings:
+        if accepted.get(encoding, accepted.get("*", 0.0)) > 0:
+            return encoding
+    return IDENTITY_ENCODING
+
+
+def is_not_modified(if_none_match, etag):
+    """
+    Whether the client has the representation with the ETag according to the "If-None-Match" request header (the
+    weak comparison is used, as the header only controls caching).
+    """
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    return any(tag.strip().replace("W/", "", 1) == etag for tag in if_none_match.split(","))
+
+
+class StaticAsset:
+    """
+    A page or static file kept in memory in every content encoding it is served in.
+    """
+    __slots__ = ("content_type", "version", "variants")
+
+    def __init__(self, body, content_type):
+        """
+        Arguments:
+            body - (bytes) the asset content.
+            content_type - (str) "Content-Type" of the asset.
+        """
+        self.content_type = content_type
+        # The content hash versions the asset URL and its ETags
+        self.version = hashlib.sha256(body).hexdigest()[:16]
+        # Content encoding to (body, ETag), the compressed variants are only kept if they are smaller
+        self.variants = {IDENTITY_ENCODING: (body, f'"{self.version}"')}
+        if len(body) >= conf.STATIC_COMPRESS_MIN_SIZE:
+            for encoding in CONTENT_ENCODINGS:
+                if encoding != IDENTITY_ENCODING:
+                    compressed = compress(body, encoding)
+                    if len(compressed) < len(body):
+                        self.variants[encoding] = (compressed, f'"{self.version}{ETAG_SUFFIXES[encoding]}"')
+
+
+class StaticCache(dict):
+    """
+    A dictionary-like data structure of the assets served from memory by name (the URL path without the leading
+    slash). The assets are built once: the files are read, hashed and compressed when the server instance starts, so
+    serving a page or a static file costs a lookup and a header check, and a client with a fresh copy gets a 304.
+
+    The URLs of the static files carry their content hash (see StaticCache.get_url), so a versioned URL is cached by
+    the browsers for good and a new version of a file gets a new URL.
+    """
+
+    def load_dir(self, static_dir, url_prefix="static"):
+        """
+        Adds all the files in the directory (recursively), named after their path in the directory under the prefix.
+        """
+        for dir_path, _, file_names in os.walk(static_dir):
+            for file_name in sorted(file_names):
+                file_path = os.path.join(dir_path, file_name)
+                with open(file_path, "rb") as f:
+                    body = f.read()
+                name = "/".join((url_prefix, os.path.relpath(file_path, static_dir).replace(os.sep, "/")))
+                self.add(name, body, mimetypes.guess_type(file_name)[0] or "application/octet-stream")
+
+    def add(self, name, body, content_type):
+        """
+        Builds the asset and keeps it under the name.
+
+        Arguments:
+            name - (str) URL path of the asset without the leading slash.
+            body - (bytes or str) the asset content, a str is encoded to UTF-8.
+            content_type - (str) "Content-Type" of the asset.
+        """
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+            content_type = f"{content_type}; charset=utf-8"
+        self[name] = StaticAsset(body, content_type)
+
+    def get_url(self, name):
+        """
+        Returns the versioned URL of the asset (relative, as the page refers to its assets), the name if it is unknown.
+        """
+        asset = self.get(name)
+        return name if asset is None else f"{name}?v={asset.version}"
+
+    def lookup(self, name, accept_encoding=None, if_none_match=None, version=None):
+        """
+        Builds the response to a request of the asset.
+
+        Arguments:
+            name - (str) URL path of the asset without the leading slash.
+            accept_encoding - (str) "Accept-Encoding" request header.
+            if_none_match - (str) "If-None-Match" request header.
+            version - (str) version in the requested URL (see StaticCache.get_url), the asset is only cached for good
+                if it is the current version.
+
+        Returns:
+            status - (int) 200, 304 if the client has a fresh copy, or 404 if there is no such asset.
+            body - (bytes) the asset content in the negotiated content encoding, empty unless the status is 200.
+            headers - (dict) response headers.
+        """
+        asset = self.get(name)
+        if asset is None:
+            return 404, b"", {}
+        encoding = negotiate_content_encoding(accept_encoding, tuple(
+            encoding for encoding in CONTENT_ENCODINGS if encoding in asset.variants))
+        body, etag = asset.variants[encoding]
+        headers = {
+            "ETag": etag,
+            "Vary": "Accept-Encoding",
+            "Cache-Control": f"public, max-age={conf.STATIC_MAX_AGE}, immutable" if version == asset.version
+            else "no-cache",
+        }
+        if is_not_modified(if_none_match, etag):
+            return 304, b"", headers
+        headers["Content-Type"] = asset.content_type
+        if encoding != IDENTITY_ENCODING:
+            headers["Content-Encoding"] = encoding
+        return 200, body, headers
+
+
+static_cache = StaticCache()
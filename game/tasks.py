@@ -0,0 +1,199 @@
+import traceback
+from collections import deque
+from contextlib import contextmanager
+import eventlet
+
+import game.config_variables as conf
+
+
+class PoolSaturated(Exception):
+    """
+    Raised when a task pool has no free slot and its queue is full, so the work is to be shed.
+    """
+
+
+class TaskPool:
+    """
+    A bounded pool of greenlets with a bounded queue of the tasks waiting for a free greenlet. Work can be:
+        - submitted (see TaskPool.submit), which is queued if all the greenlets are busy and shed if the queue is full;
+        - spawned (see TaskPool.spawn), which is never shed: the caller waits for a free greenlet if the pool is
+          saturated (backpressure on the caller);
+        - run by the caller in a slot of the pool (see TaskPool.slot), e.g. a Socket.IO handler, which is rejected if
+          the pool is saturated.
+    """
+
+    def __init__(self, name, size, max_queue):
+        """
+        Arguments:
+            name - (str) pool name, the subsystem it runs the tasks of.
+            size - (int) maximum number of tasks running concurrently.
+            max_queue - (int) maximum number of tasks (or callers, see TaskPool.slot) waiting for a free slot.
+        """
+        self.name = name
+        self.size = size
+        self.max_queue = max_queue
+        self.pool = eventlet.GreenPool(size)
+        self._queue = deque()  # Submitted tasks (function, args) waiting for a free greenlet
+        self._waiting = 0  # Callers waiting for a free slot
+        self.rejected_cnt = 0
+
+    @property
+    def running(self):
+        """
+        Number of the slots in use, by the greenlets of the pool and by the callers in a slot (see TaskPool.slot), as
+        both take the pool semaphore.
+        """
+        return self.size - self.pool.free()
+
+    @property
+    def queued(self):
+        """
+        Number of the tasks and callers waiting for a free slot.
+        """
+        return len(self._queue) + self._waiting
+
+    def is_saturated(self):
+        """
+        Whether the pool would shed more work.
+        """
+        return self.pool.free() == 0 and self.queued >= self.max_queue
+
+    def submit(self, function, *args):
+        """
+        Runs the function in the pool, as soon as a greenlet is free.
+
+        Returns:
+            is_accepted - (bool) False if the task is shed as the pool is saturated.
+        """
+        if self.pool.free():
+            self.pool.spawn_n(self._run, function, args)
+        elif len(self._queue) < self.max_queue:
+            self._queue.append((function, args))
+        else:
+            self.rejected_cnt += 1
+            return False
+        return True
+
+    def spawn(self, function, *args):
+        """
+        Runs the function in the pool, the caller waits for a free greenlet if the pool is saturated.
+        """
+        if self.pool.free() or len(self._queue) >= self.max_queue:
+            # Blocks until a greenlet is free (a greenlet is only freed when the queue is empty)
+            self.pool.spawn_n(self._run, function, args)
+        else:
+            self._queue.append((function, args))
+
+    @contextmanager
+    def slot(self):
+        """
+        Runs the with block in a slot of the pool, waiting for a free slot if there is none.
+
+        Raises:
+            PoolSaturated - if the pool is saturated.
+        """
+        if self.is_saturated():
+            self.rejected_cnt += 1
+            raise PoolSaturated(f"Task pool '{self.name}' is saturated")
+        self._waiting += 1
+        try:
+            self.pool.sem.acquire()
+        finally:
+            self._waiting -= 1
+        try:
+            yield
+        finally:
+            self.pool.sem.release()
+            # The queued tasks might have been waiting for the slot
+            while self._queue and self.pool.free():
+                function, args = self._queue.popleft()
+                self.pool.spawn_n(self._run, function, args)
+
+    def waitall(self):
+        """
+        Waits until all the tasks in the pool (including the queued ones) are done.
+        """
+        self.pool.waitall()
+
+    def _run(self, function, args):
+        """
+        Runs the task, and then the queued tasks while there are any.
+        """
+        while True:
+            try:
+                function(*args)
+            except Exception:
+                traceback.print_exc()
+            if not self._queue:
+                return
+            function, args = self._queue.popleft()
+
+    def get_stats(self):
+        """
+        Returns the pool statistics (dict).
+        """
+        return {
+            "size": self.size,
+            "running": self.running,
+            "queued": self.queued,
+            "saturation": self.running / self.size,
+            "rejected": self.rejected_cnt,
+        }
+
+
+class TaskPools(dict):
+    """
+    The named task pools of the server process, one per subsystem (see TASK_POOLS in config_variables.py), so a burst of
+    work in one subsystem cannot take the greenlets (and the redis connections they hold) of the others.
+
+    The greenlets spawned outside the pools (the background services and the delayed flushes) are spawned through it
+    too (see TaskPools.spawn), so the greenlets of the server instance are counted as they come and go instead of being
+    looked for on every scrape.
+    """
+
+    def __init__(self, pools=None):
+        """
+        Arguments:
+            pools - (dict) pool name to (maximum number of tasks running concurrently, maximum number of tasks waiting).
+        """
+        super().__init__()
+        for name, (size, max_queue) in (conf.TASK_POOLS if pools is None else pools).items():
+            self[name] = TaskPool(name, size, max_queue)
+        self.background_cnt = 0  # Greenlets alive which were spawned outside the pools
+
+    def spawn(self, function, *args):
+        """
+        Runs the function in a greenlet of its own outside the pools (see eventlet.spawn), e.g. a background service.
+        """
+        return self._track(eventlet.spawn(function, *args))
+
+    def spawn_after(self, seconds, function, *args):
+        """
+        Runs the function in a greenlet of its own outside the pools after the delay (see eventlet.spawn_after).
+        """
+        return self._track(eventlet.spawn_after(seconds, function, *args))
+
+    def _track(self, green_thread):
+        self.background_cnt += 1
+        # Called when the greenlet exits, also if it is cancelled before it starts
+        green_thread.link(self._untrack)
+        return green_thread
+
+    def _untrack(self, green_thread):
+        self.background_cnt -= 1
+
+    def count_greenlets(self):
+        """
+        Returns the number of greenlets alive which run the work of the server instance: the ones of the pools and the
+        ones spawned outside them (see TaskPools.spawn). The greenlets serving the client connections are not included.
+        """
+        return self.background_cnt + sum(pool.pool.running() for pool in self.values())
+
+    def get_stats(self):
+        """
+        Returns the statistics of every pool (pool name to dict).
+        """
+        return {name: pool.get_stats() for name, pool in self.items()}
+
+
+task_pools = TaskPools()
@@ -0,0 +1,99 @@
+import heapq
+import itertools
+import time
+import eventlet
+import eventlet.queue
+
+from game.tasks import task_pools
+
+
+class DeadlineScheduler:
+    """
+    A thread-like object, that fires callbacks at absolute time.monotonic() deadlines for all the games in the process
+    (when started). Deadlines are kept in a heap, so one greenlet drives any number of games, and every callback runs in
+    a bounded pool of workers, so a slow callback does not delay the other deadlines.
+    """
+
+    def __init__(self, pool=None):
+        """
+        Arguments:
+            pool - (TaskPool) where the callbacks run, the "timers" task pool by default.
+        """
+        self._timers = []  # Heap of [deadline, sequence number, callback, args]
+        self._sequence = itertools.count()
+        self._wakeup = eventlet.queue.LightQueue()
+        self.pool = task_pools["timers"] if pool is None else pool
+        # Lateness of the latest callback in seconds
+        self.last_jitter = 0.0
+
+    def __len__(self):
+        """
+        Propagates the number of pending timers as the object length
+        """
+        return len(self._timers)
+
+    def call_at(self, deadline, callback, *args):
+        """
+        Schedules a callback.
+
+        Arguments:
+            deadline - (float) time.monotonic() time when the callback is to be called.
+            callback - (function) function to be called.
+            args - arguments of the callback.
+
+        Returns:
+            timer - (list) timer handle for cancelling the call.
+        """
+        timer = [deadline, next(self._sequence), callback, args]
+        heapq.heappush(self._timers, timer)
+        if self._timers[0] is timer:
+            # The scheduler might be waiting for a later deadline
+            self._wakeup.put(None)
+        return timer
+
+    def call_later(self, delay, callback, *args):
+        """
+        Schedules a callback in delay seconds (see DeadlineScheduler.call_at).
+        """
+        return self.call_at(time.monotonic() + delay, callback, *args)
+
+    @staticmethod
+    def cancel(timer):
+        """
+        Cancels a scheduled call.
+        """
+        timer[2] = None
+
+    def run(self):
+        """
+        Fires the callbacks when their deadlines come.
+        """
+        while True:
+            timeout = self._timers[0][0] - time.monotonic() if self._timers else None
+            if timeout is None or timeout > 0:
+                try:
+                    self._wakeup.get(timeout=timeout)
+                except eventlet.queue.Empty:
+                    pass
+            now = time.monotonic()
+            while self._timers and self._timers[0][0] <= now:
+                deadline, _, callback, args = heapq.heappop(self._timers)
+                if callback is not None:
+                    self.last_jitter = now - deadline
+                    self.pool.spawn(callback, *args)
+
+    def start(self):
+        """
+        Runs the scheduler in the background.
+        """
+        task_pools.spawn(self.run)
+
+
+def monotonic2epoch_ms(deadline):
+    """
+    Converts a time.monotonic() deadline to the wall clock time in milliseconds since the epoch (for the clients).
+    """
+    return int((time.time() + deadline - time.monotonic()) * 1000)
+
+
+deadline_scheduler = DeadlineScheduler()
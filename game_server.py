@@ -1,45 +1,145 @@
 import os
+import hmac
+import time
+import hashlib
 import logging
 import eventlet
-import redis
-from flask import Flask, render_template, request
+from flask import Flask, Response, abort, jsonify, render_template, request
 from flask_socketio import SocketIO, join_room
 
 import game.config_variables as conf
-from game.questionnaire import load_questions2redis
-from game.modules import get_new_code, RedisSubscriptionService, UserRegistry, GameFactory
+import game.metrics as metrics
+from game.startup import Startup
+from game.questionnaire import load_questions2redis, question_bank, deck_pool
+from game.profiler import profiler, OUTPUT_FORMATS
+from game.static_cache import static_cache
+from game.tasks import task_pools, PoolSaturated
+from game.modules import get_new_code, is_room_name, RedisSubscriptionService, PlayerRecord, UserRegistry, GameFactory
+from game.shows import ShowRegistry, Show
+from game.answers import AnswerBuffer
+from game.encoding import negotiate_encoding, get_room, read_events
+from game.scheduler import InstanceScheduler
+from game.failover import GameSupervisor
+from game.timers import deadline_scheduler
+from game.redis_layer import RedisLayer
 
 
-# Initialize the app
-app = Flask(__name__)
+# Initialize the app (the static files are served from memory, see serve_static)
+app = Flask(__name__, static_folder=None)
 app.config["SECRET_KEY"] = "89dfg-lkdf3-892ls-ljg06"  # Used for signing the session cookies
 socketio = SocketIO(app)
 # Configure logger
 gunicorn_logger = logging.getLogger("gunicorn.error")
 app.logger.handlers = gunicorn_logger.handlers
 app.logger.setLevel(gunicorn_logger.level)
-# Configure redis
-redis_client = redis.from_url(conf.REDIS_URL, decode_responses=True)
+# The import only builds the objects, the work which needs redis is done by the start up phases in the background
+startup = Startup(app.logger)
+# Configure redis: every kind of work has its own connection pool
+redis_layer = RedisLayer(conf.REDIS_URL)
 
 # Configure the game server
 SERVER_INSTANCE_NAME = "SERVER" + get_new_code()
 MIN_PLAYERS = 2  # Minimum number of players to start a game
 
-# Clean up on first Heroku Dyno instance launched
-redis_client.delete(conf.NORMAL_QUESTIONS)
-redis_client.delete(conf.NEXT_GAME_SERVER)
-redis_client.delete(conf.NEXT_GAME_ROOM)
-redis_client.delete(conf.NEXT_GAME_SERVER)
-# Set up questionnaire
-load_questions2redis(redis_client)
+# Build the page and the static files once, they are served from memory
+static_cache.load_dir(os.path.join(app.root_path, "static"))
+app.jinja_env.globals["asset_url"] = static_cache.get_url
+with app.app_context():
+    static_cache.add("", render_template("index.html"), "text/html")
 
 # Create instances
-user_registry = UserRegistry(redis_client, conf.REDIS_CHANNEL_NAME,  app.logger)
-game_factory = GameFactory(SERVER_INSTANCE_NAME, redis_client, MIN_PLAYERS, conf.REDIS_CHANNEL_NAME, app.logger)
+user_registry = UserRegistry(redis_layer.hot, conf.REDIS_CHANNEL_NAME,  app.logger,
+                             is_connected=lambda session_id: socketio.server.manager.is_connected(session_id, "/"))
+scheduler = InstanceScheduler(SERVER_INSTANCE_NAME, redis_layer.background, user_registry, app.logger)
+game_factory = GameFactory(SERVER_INSTANCE_NAME, redis_layer.hot, MIN_PLAYERS, conf.REDIS_CHANNEL_NAME, app.logger,
+                           scheduler, game_redis_client=redis_layer.game)
+game_factory.add_game_class(conf.SHOW_ROOM_PREFIX, Show)
+game_supervisor = GameSupervisor(SERVER_INSTANCE_NAME, redis_layer.background, game_factory, scheduler, app.logger)
+show_registry = ShowRegistry(SERVER_INSTANCE_NAME, redis_layer.hot, app.logger, game_redis_client=redis_layer.game)
+answer_buffer = AnswerBuffer(redis_layer.hot, game_factory, app.logger, show_registry=show_registry)
 
-# Run in the background
-redis_subscription = RedisSubscriptionService(redis_client, conf.REDIS_CHANNEL_NAME, socketio, app.logger)
-redis_subscription.start()
+redis_subscription = RedisSubscriptionService(redis_layer.pubsub, conf.REDIS_CHANNEL_NAME, socketio, app.logger)
+user_registry.add_room_listener(redis_subscription)
+user_registry.add_room_listener(show_registry)
+user_registry.add_player_listener(show_registry)
+redis_subscription.add_message_listener(show_registry)
+deadline_scheduler.start()
+deck_pool.start(app.logger)
+
+
+def warm_up_questions():
+    """
+    Loads the questions to redis (skipped if the questions in redis are up to date) and into the question bank, which
+    is kept in sync in the background from then on.
+    """
+    load_questions2redis(redis_layer.background)
+    question_bank.sync(redis_layer.background)
+    question_bank.start(redis_layer.background, app.logger)
+
+
+def start_services():
+    """
+    Joins the server instances and runs the game services in the background.
+    """
+    scheduler.start(game_factory.create_new_game)
+    game_supervisor.start()
+    user_registry.start()
+
+
+startup.add_phase("redis", redis_layer.hot.ping)
+startup.add_phase("questions", warm_up_questions)
+startup.add_phase("subscriptions", redis_subscription.start)
+startup.add_phase("services", start_services)
+
+# Expose the state of the instances as metrics (read on scrapes)
+metrics.CONNECTED_SOCKETS.set_function(lambda: len(socketio.server.eio.sockets))
+metrics.REGISTERED_PLAYERS.set_function(lambda: len(user_registry))
+metrics.LOCAL_ROOMS.set_function(lambda: len(user_registry.local_rooms))
+metrics.ROOM_PLAYERS.set_function(lambda: {(room_name,): len(session_ids)
+                                           for room_name, session_ids in user_registry.local_rooms.items()})
+metrics.ACTIVE_GAMES.set_function(lambda: len(game_factory.games))
+metrics.GREENLETS.set_function(task_pools.count_greenlets)
+metrics.EVENT_LOOP_LAG.set_function(lambda: scheduler.loop_lag)
+metrics.TIMER_JITTER.set_function(lambda: deadline_scheduler.last_jitter)
+metrics.PUBSUB_QUEUE_DEPTH.set_function(lambda: redis_subscription.queue_depth)
+metrics.DECK_POOL_READY.set_function(lambda: len(deck_pool))
+metrics.DECK_POOL_TARGET.set_function(lambda: deck_pool.target)
+for metric, stat in ((metrics.REDIS_POOL_IN_USE, "in_use"), (metrics.REDIS_POOL_WAITING, "waiting"),
+                     (metrics.REDIS_POOL_WAIT, "wait_time"), (metrics.REDIS_POOL_EXHAUSTED, "exhausted"),
+                     (metrics.REDIS_RETRIES, "retried")):
+    metric.set_function(lambda stat=stat: {(role,): stats[stat] for role, stats in redis_layer.get_stats().items()})
+for metric, stat in ((metrics.TASK_POOL_RUNNING, "running"), (metrics.TASK_POOL_QUEUED, "queued"),
+                     (metrics.TASK_POOL_SATURATION, "saturation"), (metrics.TASK_POOL_REJECTED, "rejected")):
+    metric.set_function(lambda stat=stat: {(name,): stats[stat] for name, stats in task_pools.get_stats().items()})
+metrics.SERVER_READY.set_function(lambda: int(startup.is_ready))
+
+
+@app.route("/healthz")
+def check_health():
+    """
+    Returns 200 as long as the process serves requests (liveness), along with the start up status.
+    """
+    return jsonify(startup.get_status())
+
+
+@app.route("/readyz")
+def check_readiness():
+    """
+    Returns 200 once the server instance is warmed up and takes players, 503 until then (see game/startup.py).
+    """
+    return jsonify(startup.get_status()), 200 if startup.is_ready else 503
+
+
+def get_cached_response(name):
+    """
+    Returns the cached page or static file in the encoding the client accepts, or 304 if the client has a fresh copy.
+    """
+    status, body, headers = static_cache.lookup(name, request.headers.get("Accept-Encoding"),
+                                                request.headers.get("If-None-Match"), request.args.get("v"))
+    metrics.STATIC_RESPONSES.inc(status=status)
+    if status == 404:
+        abort(404)
+    return Response(body, status, headers)
 
 
 @app.route("/")
@@ -47,25 +147,148 @@ def load_web_page():
     """
     Returns the main html page.
     """
-    return render_template("index.html")
+    return get_cached_response("")
+
+
+@app.route("/static/<path:filename>")
+def serve_static(filename):
+    """
+    Returns a static file, it is cached for good if requested by its versioned URL (see StaticCache.get_url).
+    """
+    return get_cached_response(f"static/{filename}")
+
+
+@app.route("/metrics")
+def get_metrics():
+    """
+    Returns the metrics of this server instance in the Prometheus text format.
+    """
+    return Response(metrics.registry.expose(), mimetype="text/plain; version=0.0.4")
+
+
+def check_token(token, header):
+    """
+    Rejects the requests without the configured token in the header, the endpoints do not exist if no token is
+    configured.
+    """
+    if not token:
+        abort(404)
+    if not hmac.compare_digest(request.headers.get(header, ""), token):
+        abort(403)
+
+
+@app.route("/profiler/start", methods=["POST"])
+def start_profiler():
+    """
+    Starts a profile capture of this server instance (see game/profiler.py).
+
+    Query arguments:
+        "room" - (optional) game room the capture is limited to, the whole process is profiled otherwise.
+        "duration" - (optional) time in seconds after which the capture is stopped and written to disk.
+        "format" - (optional) "collapsed" (default) or "speedscope".
+    """
+    check_token(conf.PROFILER_TOKEN, "X-Profiler-Token")
+    output_format = request.args.get("format", OUTPUT_FORMATS[0])
+    duration = request.args.get("duration", type=float)
+    room_name = request.args.get("room")
+    # The room name is a part of the profile file name, so only the room names are accepted
+    if output_format not in OUTPUT_FORMATS or (duration is not None and duration <= 0) or \
+       (room_name is not None and not is_room_name(room_name)):
+        abort(400)
+    is_started = profiler.start(room_name=room_name, duration=duration, output_format=output_format,
+                                logger=app.logger)
+    return jsonify({"is_started": is_started, "room": profiler.room_name, "format": profiler.output_format}), \
+        200 if is_started else 409
+
+
+@app.route("/profiler/stop", methods=["POST"])
+def stop_profiler():
+    """
+    Stops the active profile capture and returns the path of the profile written to disk.
+    """
+    check_token(conf.PROFILER_TOKEN, "X-Profiler-Token")
+    file_path = profiler.stop()
+    return jsonify({"file": file_path}), 200 if file_path else 409
+
+
+@app.route("/admin/shows", methods=["POST"])
+def create_show():
+    """
+    Opens a show for joining and runs its game on this server instance (see game/shows.py). The players join the
+    oldest open show when they register with the "show" flag.
+
+    Query arguments:
+        "start_in" - (optional) time in seconds for joining the show, before its first round.
+    """
+    check_token(conf.ADMIN_TOKEN, "X-Admin-Token")
+    if not startup.is_ready:
+        abort(503)
+    start_in = request.args.get("start_in", conf.SHOW_GAME_TIMER, type=float)
+    if start_in <= 0:
+        abort(400)
+    room_name = conf.SHOW_ROOM_PREFIX + get_new_code()
+    pipe = redis_layer.hot.pipeline(transaction=True)
+    pipe.set(f"{room_name}-SERVER", SERVER_INSTANCE_NAME)
+    pipe.zadd(conf.OPEN_SHOWS, {room_name: time.time()})
+    pipe.execute()
+    game_factory.create_new_game(room_name, game_timer=start_in)
+    app.logger.info(f"Show {room_name} is open for joining for {start_in} sec")
+    return jsonify({"room": room_name, "start_in": start_in})
+
+
+def get_session_token(room_name, username):
+    """
+    Returns the token which lets the player resume the session in the room (see resume_session).
+    """
+    return hmac.new(conf.SESSION_SECRET.encode(), f"{room_name}\n{username}".encode(), hashlib.sha256).hexdigest()
+
+
+def replay_events(room_name, last_seq, encoding, site):
+    """
+    Sends the client of the current request the room messages published after the one with the sequence number (see
+    game.encoding.read_events).
+
+    Returns:
+        is_complete - (bool) whether all the messages are replayed, the stream only keeps the latest ones.
+    """
+    with metrics.REDIS_LATENCY.time(site=site):
+        msg_strs, is_complete = read_events(redis_layer.hot, room_name, last_seq, conf.RESUME_MAX_EVENTS)
+    if msg_strs:
+        redis_subscription.send_to_client(request.sid, msg_strs, encoding)
+        metrics.REPLAYED_MESSAGES.inc(len(msg_strs))
+    return is_complete
+
+
+@socketio.on("connect")
+def connect():
+    """
+    Refuses the clients until the server instance is warmed up, they are expected to connect to a ready one.
+    """
+    return startup.is_ready
 
 
 @socketio.on("disconnect")
 def disconnect():
     """
-    Removes user registration, if the user with the specified SID (request.sid) has been registered in a game.
+    Removes user registration, if the user with the specified SID (request.sid) has been registered in a game. The
+    registration is kept for a grace period, the player might reconnect and resume the session.
     """
     if request.sid in user_registry:
-        del user_registry[request.sid]
+        user_registry.disconnect(request.sid)
 
 
 @socketio.on("register_client")
+@metrics.REGISTRATION_LATENCY.time()
 def register_client(data):
     """
     Register the client to the next room in play if there is no conflict with the client name, otherwise False.
 
     Arguments:
-        data - (dict) with only one key, "username", which value is the requested username.
+        data - (dict) with the following keys:
+            "username" - the requested username;
+            "show" - (optional) whether the client joins the live show open for joining instead of a game room;
+            "encodings" - (optional) encodings of the game messages the client can decode, in the order of its
+                preference (see game/encoding.py), JSON is used if none of them is supported.
 
     Returns (the front end callback gets the returned values):
         username - (str) the same as the username input argument if provided, an empty string otherwise.
@@ -78,28 +301,105 @@ def register_client(data):
         is_game_starting - (bool) whether a new game was created, this depends on what the player sees when he/she
                 logs in.
         msg - (str) empty if there is no conflict with the client name, otherwise an error message.
-
+        encoding - (str) encoding of the game messages the client is going to receive.
+        token - (str) token for resuming the session after a reconnect (see resume_session), empty if the client is
+            not registered.
     """
 
     if "username" in data and isinstance(data["username"], str) and len(data["username"]):
-        username, room_name, other_players, min_players, is_game_starting, msg = game_factory.register_player(data["username"])
+        encoding = negotiate_encoding(data.get("encodings"))
+        try:
+            # Only so many registrations are in progress at once, the players above that are turned away
+            with task_pools["registration"].slot():
+                username, room_name, other_players, min_players, is_game_starting, msg, last_seq = \
+                    (show_registry if data.get("show") else game_factory).register_player(data["username"])
+        except PoolSaturated:
+            app.logger.warning(f"Server is busy, player {data['username']} is turned away")
+            return data["username"], False, {}, 0, False, \
+                '{"msg": "The server is busy at the moment, please try again later", "type": "info"}', encoding, ""
         if room_name:
-            # Assign the user to the selected room
+            # Assign the user to the selected room (its own version for the clients with a binary encoding)
             # Note: join_room can only be called from a SocketIO event handler as it obtains some information from the
             # current client context (from Flask-SocketIO documentation)
-            join_room(room_name)
-            user_registry[request.sid] = {"username": username, "room_name": room_name}
-        return username, room_name, dict.fromkeys(other_players, 0), min_players, is_game_starting, msg
+            join_room(get_room(room_name, encoding))
+            user_registry[request.sid] = PlayerRecord(username, room_name)
+            # The messages published to the room after the registration and before the client joined it (e.g. a game
+            # started at once by another server instance) are replayed, the client handles them in the publishing
+            # order along with the live ones
+            replay_events(room_name, last_seq or None, encoding, site="register_client")
+        return username, room_name, dict.fromkeys(other_players, 0), min_players, is_game_starting, msg, encoding, \
+            get_session_token(room_name, username) if room_name else ""
     else:
         app.logger.warning(f"Incorrect data format was received form the client {request.sid}: {data}. A correct "
                            f"message should have 'username' key and its value should be a non-empty string.")
-        return "", False, {}, 0, False, '{"msg": "No user name provided, please try again", "type": "warning"}'
+        return "", False, {}, 0, False, '{"msg": "No user name provided, please try again", "type": "warning"}', \
+            negotiate_encoding(None), ""
+
+
+@socketio.on("resume_session")
+def resume_session(data):
+    """
+    Resumes the session of a player who has reconnected within the grace period (see UserRegistry.disconnect), or
+    before the server has noticed that the old connection is gone, and replays the game messages the player has missed
+    from the room event stream, before the result is returned. The token proves the player, so the old connection is
+    closed if it is still open.
+
+    The client joins the room before the stream is read, so every message is either replayed or sent live, but a live
+    message can reach the client ahead of the replayed ones: the client holds the messages it receives until the result
+    is returned and then handles them in the order of their sequence numbers (see static/js/game_client.js).
+
+    Arguments:
+        data - (dict) with the following keys:
+            "username" - player's name;
+            "room_name" - player's game room name;
+            "token" - the token received on the registration;
+            "last_seq" - (optional) sequence number ("seq") of the latest game message the client has received;
+            "encodings" - (optional) encodings of the game messages the client can decode (see register_client).
+
+    Returns (the front end callback gets the returned values):
+        is_resumed - (bool) whether the session is resumed, otherwise the player is to register again.
+        is_complete - (bool) whether all the missed messages are replayed, the stream only keeps the latest ones.
+        encoding - (str) encoding of the game messages the client is going to receive.
+    """
+    if not isinstance(data, dict) or \
+       not all(isinstance(data.get(key), str) for key in ("username", "room_name", "token")):
+        app.logger.warning(f"Incorrect session resumption request, info:{data}")
+        return False, False, negotiate_encoding(None)
+    encoding = negotiate_encoding(data.get("encodings"))
+    room_name = data["room_name"]
+    if not hmac.compare_digest(data["token"], get_session_token(room_name, data["username"])):
+        app.logger.warning(f"Player attempted to resume a session with an invalid token, info:{data}")
+        metrics.SESSION_RESUMES.inc(result="rejected")
+        return False, False, encoding
+    if request.sid in user_registry:
+        app.logger.warning(f"Registered client {request.sid} attempted to resume another session, info:{data}")
+        metrics.SESSION_RESUMES.inc(result="rejected")
+        return False, False, encoding
+    player, replaced_session_id = user_registry.resume(request.sid, data["username"], room_name)
+    if player is None:
+        metrics.SESSION_RESUMES.inc(result="expired")
+        return False, False, encoding
+    if replaced_session_id is not None:
+        # The player is moved to the new SID already, so the disconnect handler of the old one leaves it be
+        app.logger.info(f"Player {data['username']} resumed the session of the client {replaced_session_id}")
+        socketio.server.disconnect(replaced_session_id, namespace="/")
+    join_room(get_room(room_name, encoding))
+    # A sequence number is a stream entry id, "<ms>-<n>"
+    last_seq = data.get("last_seq")
+    if not (isinstance(last_seq, str) and all(part.isdigit() for part in last_seq.split("-")) and
+            last_seq.count("-") == 1):
+        last_seq = None
+    is_complete = replay_events(room_name, last_seq, encoding, site="resume_session")
+    metrics.SESSION_RESUMES.inc(result="resumed")
+    return True, is_complete, encoding
 
 
 @socketio.on("report_round_answer")
+@metrics.ANSWER_LATENCY.time()
 def register_player_answer(data):
     """
-    Register the player answer in the corresponding round.
+    Register the player answer in the corresponding round. Answers are only accepted until the round deadline (the
+    time the answer is received by the server counts).
 
     Arguments:
         data - (dict) with the following keys:
@@ -116,13 +416,18 @@ def register_player_answer(data):
        ("answer" in data) and \
        ("room_name" in data):
 
-        if redis_client.sismember(data["room_name"], data["username"]):
-            redis_client.hset(data["round_answer_key"], data["username"], data["answer"])
-        else:
-            app.logger.error(f"Unauthorized player attempted to submit an answer, info:{data}")
+        if not (isinstance(data["round_answer_key"], str) and
+                data["round_answer_key"].startswith(f"{data['room_name']}-ROUND-") and
+                data["round_answer_key"].endswith("-ANSWERS")):
+            app.logger.error(f"Player attempted to submit an answer to an unexpected key, info:{data}")
+            return
+        profiler.tag(data["room_name"])
+        answer_buffer.add(data["room_name"], data["round_answer_key"], data["username"], data["answer"])
     else:
         app.logger.warning(f"Incorrect player's answer, info:{data}")
 
 
+startup.start()
+
 if __name__ == "__main__":
     socketio.run(app, debug=True)
@@ -1,21 +1,35 @@
 let username = "",
     roomName = "",
     isInGame = false,
+    roundOptions = [],  // Options of the current round, the later round messages refer to them by their indices
+    roundAnswer = -1,  // Index of the option picked in the current round
+    // Players open the page with "?show" to join the live show instead of a game room
+    isShow = new URLSearchParams(window.location.search).has("show"),
+    sessionToken = "",  // Lets the player resume the session after a reconnect
+    lastSeq = null,  // Sequence number of the latest game message received
+    heldMessages = null,  // Messages received while the player is being registered or the session resumed
+    // Encodings of the game messages this client can decode, the most compact first
+    encodings = typeof MessagePack === "undefined" ? ["json"] : ["msgpack", "json"],
     socket = io.connect(window.location.href);
 
 // OnLoginClicked function
 $("#noname_form").on("submit", function (e) {
     e.preventDefault();
     let requested_username = $("input.username").val();
-    if (requested_username.length > 0)
-        socket.emit("register_client", {username: requested_username}, registerUsername);
+    if (requested_username.length > 0) {
+        // The messages published to the room before the client joined it are replayed, see releaseMessages
+        heldMessages = [];
+        socket.emit("register_client", {username: requested_username, encodings: encodings, show: isShow}, registerUsername);
+    }
 });
 
 // Register username
-function registerUsername(confirmed_username, confirmed_roomName, otherPlayers, minPlayers, is_game_starting, msgJson){
+function registerUsername(confirmed_username, confirmed_roomName, otherPlayers, minPlayers, is_game_starting, msgJson,
+                          encoding, token){
     if (confirmed_roomName) {
         username = confirmed_username;
         roomName = confirmed_roomName;
+        sessionToken = token;
         isInGame = true;
         $("[id^=noname]").prop("disabled", true);
         $(".label_players").css("color", "black");
@@ -28,15 +42,79 @@ function registerUsername(confirmed_username, confirmed_roomName, otherPlayers,
     } else {
         informUser(JSON.parse(msgJson));
     };
+    releaseMessages();
+}
+
+// Handle the messages held while registering or resuming: the live messages can overtake the replayed ones, so they
+// are handled in the publishing order
+function releaseMessages() {
+    let msgs = heldMessages.flatMap(msg => msg["type"] == "batch" ? msg["messages"] : [msg]);
+    heldMessages = null;
+    // The messages without a sequence number are not replayed, they go first
+    msgs.filter(msg => !msg["seq"]).forEach(informUser);
+    msgs.filter(msg => msg["seq"]).sort((msg, other) => compareSeq(msg["seq"], other["seq"])).forEach(informUser);
+}
+
+// Resume the session after a network blip, the server replays the missed messages
+socket.on("reconnect", function () {
+    if (!sessionToken)
+        return;
+    heldMessages = [];
+    socket.emit("resume_session", {
+        username: username,
+        room_name: roomName,
+        token: sessionToken,
+        last_seq: lastSeq,
+        encodings: encodings,
+    }, function (isResumed, isComplete) {
+        if (!isResumed) {
+            heldMessages = null;
+            endSession();
+            return;
+        }
+        if (!isComplete)
+            console.warn("Some game messages were missed while reconnecting");
+        releaseMessages();
+    });
+});
+
+// The session cannot be resumed, the player logs in again
+function endSession() {
+    username = "";
+    roomName = "";
+    sessionToken = "";
+    lastSeq = null;
+    isInGame = false;
+    $("div.player_wrapper").empty();
+    $("[id^=noname]").prop("disabled", false);
+    console.log("The session has expired, please log in again");
+}
+
+function compareSeq(seq, otherSeq) {
+    // Sequence numbers are redis stream entry ids, "<ms>-<n>"
+    let [ms, n] = seq.split("-").map(Number),
+        [otherMs, otherN] = otherSeq.split("-").map(Number);
+    return ms != otherMs ? ms - otherMs : n - otherN;
 }
 
 // Receive a message
 socket.on("message", function (msg) {
-    informUser (msg);
+    // Binary messages are sent to the clients which negotiated msgpack on the registration
+    msg = msg instanceof ArrayBuffer ? MessagePack.decode(new Uint8Array(msg)) : msg;
+    if (heldMessages)
+        heldMessages.push(msg);
+    else
+        informUser(msg);
 });
 
 
 function informUser (msg) {
+    if (msg["seq"]) {
+        // A message replayed after a reconnect might have been received already
+        if (lastSeq && compareSeq(msg["seq"], lastSeq) <= 0)
+            return;
+        lastSeq = msg["seq"];
+    }
     switch (msg["type"]) {
         case "info":
             console.log(msg["msg"]);
@@ -55,7 +133,11 @@ function informUser (msg) {
                         updatePlayer("add", msg["username"]);
                     break;
                 case "left":
-                    updatePlayer("remove", msg["username"]);
+                case "eliminated":
+                    // Several players might leave at once (e.g. everyone who lost a round)
+                    (msg["usernames"] || [msg["username"]]).forEach(function (player_name) {
+                        updatePlayer("remove", player_name);
+                    });
                     break;
                 default:
                     console.error("Unexpected action received on players_update");
@@ -70,9 +152,18 @@ function informUser (msg) {
             runRound(msg)
             break;
 
+        case "round_progress":
+            announceRoundProgress(msg)
+            break;
+
         case "round_stats":
             announceRoundStats(msg)
             break;
+
+        case "batch":
+            // Several messages coalesced by the server for one room
+            msg["messages"].forEach(informUser);
+            break;
         default:
             console.error("Not expected msg type");
     }
@@ -141,6 +232,8 @@ function announceGameStatus(status, minPlayers){
 }
 
 function runRound(roundInfo){
+    roundOptions = roundInfo["options"];
+    roundAnswer = -1;
     let gameInfoWrapper = $("div#game-info-wrapper"),
         questionWrapper =  $("div#question-wrapper"),
         optionsWrapper =  $("div#options-wrapper");
@@ -167,29 +260,56 @@ function runRound(roundInfo){
             <button type="button" class="option-btn btn btn-light" id="option-button-0" name="${roundInfo["options"][0]}"
                 value="${roundInfo["round_answer_key"]}" onclick="selectRoundOption(this)" ${isInGame ? "" : "disabled"}>
                     ${roundInfo["options"][0]}
+                    <span class="option-progress badge badge-pill badge-secondary float-right"></span>
             </button>
         </div>
         <div class="container">
             <button type="button" class="option-btn btn btn-light" id="option-button-1" name="${roundInfo["options"][1]}"
                 value="${roundInfo["round_answer_key"]}"  onclick="selectRoundOption(this)" ${isInGame ? "" : "disabled"}>
                     ${roundInfo["options"][1]}
+                    <span class="option-progress badge badge-pill badge-secondary float-right"></span>
             </button>
         </div>
         <div class="container">
             <button type="button" class="option-btn btn btn-light" id="option-button-2" name="${roundInfo["options"][2]}"
                 value="${roundInfo["round_answer_key"]}" onclick="selectRoundOption(this)" ${isInGame ? "" : "disabled"}>
                     ${roundInfo["options"][2]}
+                    <span class="option-progress badge badge-pill badge-secondary float-right"></span>
             </button>
         </div>
         `
     );
 
-    runTimer(roundInfo["timer"], function () {
+    runTimer(getRemainingTime(roundInfo), function () {
         $(`button.option-btn`).prop("disabled", true);
     });
 }
 
+function getRemainingTime(msg) {
+    // The server closes the round exactly at its deadline (epoch ms), so count down to it. The full timer is used if
+    // the client clock is too far off for the deadline to make sense
+    let remaining = Math.round((msg["deadline"] - Date.now()) / 1000);
+    if (remaining > 0 && remaining <= msg["timer"])
+        return remaining;
+    return msg["timer"];
+}
+
+function announceRoundProgress(roundProgress) {
+    // Live number of answers for every option while the round is open
+    roundProgress["counts"].forEach(function (count, i) {
+        $(`button#option-button-${i} span.option-progress`).text(count ? count : "");
+    });
+}
+
+function getOptionShare(roundStats, i) {
+    // Percentage of the players who picked the option
+    return roundStats["answered"] ? roundStats["counts"][i] / roundStats["answered"] * 100 : 0;
+}
+
 function announceRoundStats(roundStats) {
+    // The players who lose a show are not broadcast, every player figures it out from the round stats
+    if (roundStats["show"] && isInGame && roundAnswer != roundStats["correct"])
+        updatePlayer("remove", username);
     let gameInfoWrapper = $("div#game-info-wrapper"),
         optionsWrapper =  $("div#options-wrapper"),
         gameInfoStr = roundStats["players_in_game"] <= 1
@@ -212,36 +332,36 @@ function announceRoundStats(roundStats) {
         
         <div class="progress position-relative option-stat-bar">
             <div class="container position-absolute" >
-                <p style="line-height: 2.45rem; font-size: 1rem; color: #212529">${roundStats["options"][0]}</p>
+                <p style="line-height: 2.45rem; font-size: 1rem; color: #212529">${roundOptions[0]}</p>
             </div>
             <div class="progress-bar bg-success" role="progressbar" 
-                style="width: ${roundStats["stats"][roundStats["options"][0]] * 100}%; 
-                    background-color: ${roundStats["options"][0] == roundStats["correct_answer"] ? "#9dff9d" : "lightgray"} !important;" 
-                aria-valuenow="${roundStats["stats"][roundStats["options"][0]] * 100}" 
+                style="width: ${getOptionShare(roundStats, 0)}%; 
+                    background-color: ${roundStats["correct"] == 0 ? "#9dff9d" : "lightgray"} !important;" 
+                aria-valuenow="${getOptionShare(roundStats, 0)}" 
                 aria-valuemin="0" aria-valuemax="100">              
             </div>
         </div>
         
         <div class="progress position-relative option-stat-bar">
             <div class="container position-absolute" >
-                <p style="line-height: 2.45rem; font-size: 1rem; color: #212529">${roundStats["options"][1]}</p>
+                <p style="line-height: 2.45rem; font-size: 1rem; color: #212529">${roundOptions[1]}</p>
             </div>
             <div class="progress-bar bg-success" role="progressbar" 
-                style="width: ${roundStats["stats"][roundStats["options"][1]] * 100}%; 
-                    background-color: ${roundStats["options"][1] == roundStats["correct_answer"] ? "#9dff9d" : "lightgray"} !important;" 
-                aria-valuenow="${roundStats["stats"][roundStats["options"][1]] * 100}" 
+                style="width: ${getOptionShare(roundStats, 1)}%; 
+                    background-color: ${roundStats["correct"] == 1 ? "#9dff9d" : "lightgray"} !important;" 
+                aria-valuenow="${getOptionShare(roundStats, 1)}" 
                 aria-valuemin="0" aria-valuemax="100">              
             </div>
         </div>
         
         <div class="progress position-relative option-stat-bar">
             <div class="container position-absolute" >
-                <p style="line-height: 2.45rem; font-size: 1rem; color: #212529">${roundStats["options"][2]}</p>
+                <p style="line-height: 2.45rem; font-size: 1rem; color: #212529">${roundOptions[2]}</p>
             </div>
             <div class="progress-bar bg-success" role="progressbar" 
-                style="width: ${roundStats["stats"][roundStats["options"][2]] * 100}%; 
-                    background-color: ${roundStats["options"][2] == roundStats["correct_answer"] ? "#9dff9d" : "lightgray"} !important;" 
-                aria-valuenow="${roundStats["stats"][roundStats["options"][2]] * 100}" 
+                style="width: ${getOptionShare(roundStats, 2)}%; 
+                    background-color: ${roundStats["correct"] == 2 ? "#9dff9d" : "lightgray"} !important;" 
+                aria-valuenow="${getOptionShare(roundStats, 2)}" 
                 aria-valuemin="0" aria-valuemax="100">              
             </div>
         </div>
@@ -250,6 +370,7 @@ function announceRoundStats(roundStats) {
 }
 
 function selectRoundOption(btnInfo) {
+    roundAnswer = roundOptions.indexOf(btnInfo.name);
     reportRoundAnswer(btnInfo.name, btnInfo.value)
     // Block on option to change the decision
     $(`button#${btnInfo.id}`).css("background-color", "#007BFF").css("color", "white");
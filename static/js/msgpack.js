@@ -0,0 +1,103 @@
+// MessagePack decoder of the game messages (https://github.com/msgpack/msgpack/blob/master/spec.md), the server sends
+// them in msgpack to the clients which can decode it (see game/encoding.py). Only decoding is needed, the extension
+// types are not used by the server.
+const MessagePack = (function () {
+    const utf8 = new TextDecoder("utf-8");
+
+    function Decoder(bytes) {
+        this.bytes = bytes;
+        this.view = new DataView(bytes.buffer, bytes.byteOffset, bytes.byteLength);
+        this.pos = 0;
+    }
+
+    Decoder.prototype.read = function (size, getter) {
+        let value = this.view[getter](this.pos);
+        this.pos += size;
+        return value;
+    };
+
+    Decoder.prototype.readUint64 = function () {
+        // Numbers are exact up to 2^53, which covers the timestamps and counters of the game messages
+        let high = this.read(4, "getUint32");
+        return high * 4294967296 + this.read(4, "getUint32");
+    };
+
+    Decoder.prototype.readInt64 = function () {
+        let high = this.read(4, "getInt32");
+        return high * 4294967296 + this.read(4, "getUint32");
+    };
+
+    Decoder.prototype.readStr = function (size) {
+        let value = utf8.decode(this.bytes.subarray(this.pos, this.pos + size));
+        this.pos += size;
+        return value;
+    };
+
+    Decoder.prototype.readBin = function (size) {
+        let value = this.bytes.slice(this.pos, this.pos + size);
+        this.pos += size;
+        return value;
+    };
+
+    Decoder.prototype.readArray = function (size) {
+        let value = new Array(size);
+        for (let i = 0; i < size; i++)
+            value[i] = this.decode();
+        return value;
+    };
+
+    Decoder.prototype.readMap = function (size) {
+        let value = {};
+        for (let i = 0; i < size; i++) {
+            let key = this.decode();
+            value[key] = this.decode();
+        }
+        return value;
+    };
+
+    Decoder.prototype.decode = function () {
+        let type = this.read(1, "getUint8");
+        if (type < 0x80)
+            return type;  // positive fixint
+        if (type < 0x90)
+            return this.readMap(type & 0x0f);
+        if (type < 0xa0)
+            return this.readArray(type & 0x0f);
+        if (type < 0xc0)
+            return this.readStr(type & 0x1f);
+        if (type >= 0xe0)
+            return type - 0x100;  // negative fixint
+        switch (type) {
+            case 0xc0: return null;
+            case 0xc2: return false;
+            case 0xc3: return true;
+            case 0xc4: return this.readBin(this.read(1, "getUint8"));
+            case 0xc5: return this.readBin(this.read(2, "getUint16"));
+            case 0xc6: return this.readBin(this.read(4, "getUint32"));
+            case 0xca: return this.read(4, "getFloat32");
+            case 0xcb: return this.read(8, "getFloat64");
+            case 0xcc: return this.read(1, "getUint8");
+            case 0xcd: return this.read(2, "getUint16");
+            case 0xce: return this.read(4, "getUint32");
+            case 0xcf: return this.readUint64();
+            case 0xd0: return this.read(1, "getInt8");
+            case 0xd1: return this.read(2, "getInt16");
+            case 0xd2: return this.read(4, "getInt32");
+            case 0xd3: return this.readInt64();
+            case 0xd9: return this.readStr(this.read(1, "getUint8"));
+            case 0xda: return this.readStr(this.read(2, "getUint16"));
+            case 0xdb: return this.readStr(this.read(4, "getUint32"));
+            case 0xdc: return this.readArray(this.read(2, "getUint16"));
+            case 0xdd: return this.readArray(this.read(4, "getUint32"));
+            case 0xde: return this.readMap(this.read(2, "getUint16"));
+            case 0xdf: return this.readMap(this.read(4, "getUint32"));
+            default: throw new Error("Unsupported msgpack type 0x" + type.toString(16));
+        }
+    };
+
+    return {
+        decode: function (bytes) {
+            return new Decoder(bytes).decode();
+        },
+    };
+})();
@@ -0,0 +1,128 @@
+"""
+Micro-benchmark of the message fan-out CPU cost of RedisSubscriptionService.
+
+Measures the CPU time a server instance spends passing published game messages on to the clients of one room:
+    - "per_client" - the messages are parsed and emitted with socketio.send, which encodes the Socket.IO packet for
+      every client (how the messages were sent before the serialize-once broadcast);
+    - "serialize_once" - RedisSubscriptionService routes the published envelopes without parsing them and writes one
+      pre-encoded packet to every client.
+No network is involved: the clients are registered in the Socket.IO room directly and the Engine.IO send only counts
+the packets, so the numbers are the encoding and routing cost alone.
+
+Usage:
+    python -m tests.benchmark_fanout --clients 10000 --rounds 20
+"""
+
+import argparse
+import json
+import logging
+import time
+
+from flask import Flask
+from flask_socketio import SocketIO
+
+from game.encoding import ENVELOPE_SEPARATOR, add_seq, dumps
+from game.modules import RedisSubscriptionService
+
+ROOM_NAME = "room-BENCH"
+
+
+def get_envelope(room_name, msg, seq):
+    """
+    Returns the envelope published for a game message, as PUBLISH_EVENT_SCRIPT builds it (see game.encoding.publish).
+    """
+    return room_name + ENVELOPE_SEPARATOR + add_seq(dumps(msg), seq)
+
+
+def get_round_envelopes(round_cnt, clients):
+    """
+    Returns the envelopes published for one round of a game: the question, the live progress, the results and the
+    players who lost.
+    """
+    options = ["Leonardo da Vinci", "Michelangelo Buonarroti", "Raffaello Sanzio"]
+    msgs = [{
+        "type": "new_round", "question": "Who painted the ceiling of the Sistine Chapel?", "options": options,
+        "round_answer_key": f"{ROOM_NAME}-ROUND-{round_cnt}-ANSWERS", "timer": 10, "deadline": 1600000000000,
+        "server_time": 1599999990000, "round": round_cnt, "room": ROOM_NAME,
+    }]
+    for second in range(1, 10):
+        msgs.append({
+            "type": "round_progress", "round": round_cnt, "counts": [second * 10, second * 50, second * 7],
+            "answered": second * 67,
+        })
+    msgs.append({
+        "type": "round_stats", "round": round_cnt, "counts": [100, 500, 70], "answered": clients, "correct": 1,
+        "players_in_game": 500,
+    })
+    msgs.append({
+        "type": "players_update", "action": "eliminated", "usernames": [f"player-{i}" for i in range(100)],
+    })
+    return [get_envelope(ROOM_NAME, msg, f"1600000000000-{round_cnt * 100 + i}") for i, msg in enumerate(msgs)]
+
+
+def send_per_client(socketio, envelopes):
+    """
+    Sends the messages the way it was done before the serialize-once broadcast.
+    """
+    for envelope in envelopes:
+        room_name, msg_str = envelope.split(ENVELOPE_SEPARATOR, 1)
+        socketio.send(json.loads(msg_str), room=room_name)
+
+
+def send_serialize_once(service, envelopes):
+    """
+    Sends the messages through RedisSubscriptionService, one message per send like the per client path.
+    """
+    for envelope in envelopes:
+        for room_name, msg_strs in service._group_by_room([envelope]).items():
+            service.send(room_name, msg_strs)
+
+
+def run_benchmark(args):
+    socketio = SocketIO(Flask(__name__))
+    manager = socketio.server.manager
+    manager.initialize()
+    for i in range(args.clients):
+        manager.connect(f"sid-{i}", "/")
+        manager.enter_room(f"sid-{i}", "/", ROOM_NAME)
+    sent = {"packets": 0, "bytes": 0}
+
+    def count_send(session_id, data, binary=None):
+        sent["packets"] += 1
+        sent["bytes"] += len(data)
+    socketio.server.eio.send = count_send
+
+    # The service is not started, only its sending is measured (no redis subscription)
+    service = object.__new__(RedisSubscriptionService)
+    service.socketio = socketio
+    service.logger = logging.getLogger(__name__)
+
+    envelopes = [envelope for round_cnt in range(1, args.rounds + 1)
+                 for envelope in get_round_envelopes(round_cnt, args.clients)]
+    results = {"clients": args.clients, "messages": len(envelopes)}
+    for name, send in (("per_client", lambda: send_per_client(socketio, envelopes)),
+                       ("serialize_once", lambda: send_serialize_once(service, envelopes))):
+        sent["packets"] = sent["bytes"] = 0
+        started = time.process_time()
+        send()
+        cpu_time = time.process_time() - started
+        results[name] = {
+            "cpu_sec": round(cpu_time, 3),
+            "cpu_us_per_packet": round(cpu_time / sent["packets"] * 1e6, 3) if sent["packets"] else None,
+            "packets": sent["packets"],
+            "bytes": sent["bytes"],
+        }
+    results["speedup"] = round(results["per_client"]["cpu_sec"] / results["serialize_once"]["cpu_sec"], 2)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--clients", type=int, default=10000, help="number of clients in the room")
+    parser.add_argument("--rounds", type=int, default=5, help="number of rounds of messages to send")
+    args = parser.parse_args()
+    print(json.dumps(run_benchmark(args), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,410 @@
+"""
+Load-generation benchmark for the Socket.IO game flow.
+
+Starts game_server with gunicorn (eventlet worker) against a local redis stand-in and drives N simulated players
+through "register_client" and "report_round_answer". The results are printed (or written) as JSON, so they can be
+compared across commits:
+    - registration throughput and latency;
+    - latency from the "new_round" publish to its receipt by a client (p50/p99);
+    - latency from the round close (deadline) to the "round_stats" receipt by a client (p50/p99), and to its publish
+      by the server (the round close itself, without the fan-out to the clients);
+    - server memory per connected player;
+    - game message bytes received per player (in the negotiated encoding).
+
+Usage:
+    python -m tests.benchmark_game_flow --clients 200 --output bench.json
+
+With --reconnect every player resumes the session on a new socket after the registration (a reconnect storm), the
+resume latency is reported. Half of the players drop the old socket first, the other half leave it open, as after a
+network blip the server has not noticed yet (the server closes it).
+
+With --show the players join a live show (see game/shows.py) instead of the game rooms, so the round close latency
+can be compared across audience sizes. With --instances the players are spread over several server instances, e.g.
+to play a show with one shard per instance:
+    python -m tests.benchmark_game_flow --show --instances 3 --clients 1000 --game-timer 30
+
+Redis stand-in: --redis-url if provided, otherwise a local redis-server (if installed), otherwise a fakeredis TCP
+server (requires fakeredis with Lua support).
+"""
+
+import argparse
+import json
+import os
+import random
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+import socketio
+
+try:
+    import msgpack
+except ImportError:  # Only needed for --encoding msgpack
+    msgpack = None
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def get_free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_for_port(port, timeout=30):
+    started = time.monotonic()
+    while time.monotonic() - started < timeout:
+        with socket.socket() as s:
+            if s.connect_ex(("127.0.0.1", port)) == 0:
+                return
+        time.sleep(0.1)
+    raise TimeoutError(f"Nothing is listening on port {port} after {timeout} sec")
+
+
+def start_redis():
+    """
+    Starts a local redis stand-in.
+
+    Returns:
+        redis_url - (str) URL of the started server.
+        stop - (function) stops the server.
+    """
+    port = get_free_port()
+    if shutil.which("redis-server"):
+        process = subprocess.Popen(["redis-server", "--port", str(port), "--save", "", "--appendonly", "no"],
+                                   stdout=subprocess.DEVNULL)
+        wait_for_port(port)
+        return f"redis://127.0.0.1:{port}", process.terminate
+
+    from fakeredis import TcpFakeServer
+
+    class NoDelayFakeServer(TcpFakeServer):
+        def get_request(self):
+            # Redis replies without Nagle's delay, a stand-in which does not adds ~40 ms to every pipeline
+            request, address = super().get_request()
+            request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            return request, address
+
+    server = NoDelayFakeServer(("127.0.0.1", port))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    wait_for_port(port)
+    return f"redis://127.0.0.1:{port}", server.shutdown
+
+
+def get_rss_bytes(pid):
+    """
+    Returns the resident memory of the process in bytes, None if it is unknown.
+    """
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        return None
+
+
+def get_total_rss_bytes(pids):
+    """
+    Returns the resident memory of the processes in bytes, None if it is unknown.
+    """
+    rss = [get_rss_bytes(pid) for pid in pids]
+    return None if None in rss else sum(rss)
+
+
+def get_worker_pid(master_pid):
+    """
+    Returns the pid of the (only) gunicorn worker.
+    """
+    try:
+        with open(f"/proc/{master_pid}/task/{master_pid}/children") as f:
+            children = f.read().split()
+        return int(children[0]) if children else master_pid
+    except OSError:
+        return master_pid
+
+
+def percentiles(values):
+    """
+    Returns p50, p99 and max of the values in milliseconds.
+    """
+    if not values:
+        return {"count": 0, "p50": None, "p99": None, "max": None}
+    values = sorted(values)
+    return {
+        "count": len(values),
+        "p50": round(values[int(0.50 * (len(values) - 1))] * 1000, 3),
+        "p99": round(values[int(0.99 * (len(values) - 1))] * 1000, 3),
+        "max": round(values[-1] * 1000, 3),
+    }
+
+
+class SimulatedPlayer:
+    """
+    A Socket.IO client which registers to a game and answers every round with a random option.
+    """
+
+    def __init__(self, url, username, results, encoding="json", is_show=False):
+        self.url = url
+        self.username = username
+        self.results = results
+        self.encoding = encoding
+        self.is_show = is_show
+        self.room_name = ""
+        self.is_in_game = False
+        self.answer_idx = -1  # Option picked in the current round
+        self.token = ""
+        self.last_seq = None
+        self.held_items = None  # Messages received while registering or resuming the session
+        self.lock = threading.Lock()  # The client handles every message in its own thread
+        self.client = socketio.Client(reconnection=False)
+        self.client.on("message", self.on_message)
+
+    def connect(self):
+        self.client.connect(self.url, transports=["websocket"])
+
+    def register(self):
+        started = time.monotonic()
+        registered = threading.Event()
+
+        def callback(username, room_name, *args):
+            self.room_name = room_name
+            self.is_in_game = bool(room_name)
+            self.token = args[-1]
+            self.release_items()
+            self.results["registration_latency"].append(time.monotonic() - started)
+            registered.set()
+
+        self.held_items = []
+        self.client.emit("register_client", {"username": self.username, "encodings": [self.encoding],
+                                             "show": self.is_show},
+                         callback=callback)
+        registered.wait(60)
+        return bool(self.room_name)
+
+    def reconnect(self, is_blip=False):
+        """
+        Resumes the session on a new socket, the old one is dropped first unless is_blip (it is left to the server).
+        """
+        if is_blip:
+            self.client.on("message", lambda msg: None)
+        else:
+            self.client.disconnect()
+        self.client = socketio.Client(reconnection=False)
+        self.client.on("message", self.on_message)
+        self.connect()
+        started = time.monotonic()
+        resumed = threading.Event()
+        is_resumed = []
+        self.held_items = []
+
+        def callback(*args):
+            is_resumed.append(args[0])
+            self.release_items()
+            self.results["resume_latency"].append(time.monotonic() - started)
+            resumed.set()
+
+        self.client.emit("resume_session", {"username": self.username, "room_name": self.room_name,
+                                            "token": self.token, "last_seq": self.last_seq,
+                                            "encodings": [self.encoding]}, callback=callback)
+        resumed.wait(60)
+        return bool(is_resumed and is_resumed[0])
+
+    def on_message(self, msg):
+        received = time.time()
+        if isinstance(msg, bytes):
+            self.results["bytes_received"].append(len(msg))
+            msg = msgpack.unpackb(msg, raw=False)
+        else:
+            self.results["bytes_received"].append(len(json.dumps(msg, separators=(",", ":"))))
+        items = msg["messages"] if msg.get("type") == "batch" else [msg]
+        with self.lock:
+            if self.held_items is not None:
+                self.held_items.extend(items)
+            else:
+                self.handle_items(items, received)
+
+    def release_items(self):
+        """
+        Handles the messages held while registering or resuming, in the publishing order, as the live messages can
+        overtake the replayed ones (see resume_session in game_server.py).
+        """
+        with self.lock:
+            items, self.held_items = self.held_items, None
+            self.handle_items(sorted(items, key=lambda item: tuple(map(int, item.get("seq", "0-0").split("-")))),
+                              time.time())
+
+    def handle_items(self, items, received):
+        for item in items:
+            if "seq" in item:
+                seq = tuple(map(int, item["seq"].split("-")))
+                if self.last_seq is not None and seq <= tuple(map(int, self.last_seq.split("-"))):
+                    continue  # Replayed on resume and already received
+                self.last_seq = item["seq"]
+            if item["type"] == "new_round":
+                self.results["new_round_latency"].append(received - item["server_time"] / 1000)
+                self.results["rounds"].add(item["round"])
+                self.results["deadlines"][item["round"]] = item["deadline"] / 1000
+                self.answer_idx = -1
+                if self.is_in_game:
+                    self.answer_idx = random.randrange(len(item["options"]))
+                    self.client.emit("report_round_answer", {
+                        "room_name": self.room_name,
+                        "username": self.username,
+                        "answer": item["options"][self.answer_idx],
+                        "round_answer_key": item["round_answer_key"],
+                    })
+            elif item["type"] == "players_update" and item["action"] in ("left", "eliminated"):
+                if self.username in item.get("usernames", [item.get("username")]):
+                    self.is_in_game = False
+            elif item["type"] == "round_stats":
+                deadline = self.results["deadlines"].get(item["round"])
+                if deadline:
+                    self.results["round_stats_latency"].append(received - deadline)
+                    self.results["round_close_latency"].setdefault(item["round"], item["server_time"] / 1000 - deadline)
+                if item.get("show") and self.answer_idx != item["correct"]:
+                    # The players who lose a show are not broadcast
+                    self.is_in_game = False
+                if item["players_in_game"] <= 1:
+                    self.results["game_over"].set()
+
+    def disconnect(self):
+        self.client.disconnect()
+
+
+def wait_until_ready(url, timeout=60):
+    """
+    Waits until the server instance is warmed up (see the /readyz endpoint).
+    """
+    started = time.monotonic()
+    while time.monotonic() - started < timeout:
+        try:
+            with urllib.request.urlopen(f"{url}/readyz", timeout=1):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise TimeoutError(f"{url} is not ready after {timeout} sec")
+
+
+def run_benchmark(args):
+    redis_url, stop_redis = (args.redis_url, lambda: None) if args.redis_url else start_redis()
+    ports = [get_free_port() for _ in range(args.instances)]
+    env = dict(os.environ, REDIS_URL=redis_url, GAME_TIMER=str(args.game_timer), ROUND_TIMER=str(args.round_timer),
+               ROUND_BREAK=str(args.round_break), GAME_READY_DELAY="0.5", ADMIN_TOKEN="benchmark")
+    server_log = open(args.server_log, "w") if args.server_log else subprocess.DEVNULL
+    servers = [subprocess.Popen(
+        [sys.executable, "-c", "from gunicorn.app.wsgiapp import run; run()", "--worker-class", "eventlet", "-w", "1",
+         "-b", f"127.0.0.1:{port}", "game_server:app"],
+        cwd=ROOT_DIR, env=env, stdout=server_log, stderr=server_log,
+    ) for port in ports]
+    results = {
+        "registration_latency": [],
+        "new_round_latency": [],
+        "round_stats_latency": [],
+        "round_close_latency": {},  # Round to the time from its deadline to the "round_stats" publish
+        "resume_latency": [],
+        "bytes_received": [],
+        "deadlines": {},
+        "rounds": set(),
+        "game_over": threading.Event(),
+    }
+    players = []
+    try:
+        urls = [f"http://127.0.0.1:{port}" for port in ports]
+        for url in urls:
+            wait_until_ready(url)
+        worker_pids = [get_worker_pid(server.pid) for server in servers]
+        rss_idle = get_total_rss_bytes(worker_pids)
+
+        if args.show:
+            urllib.request.urlopen(urllib.request.Request(f"{urls[0]}/admin/shows?start_in={args.game_timer}",
+                                                          method="POST", headers={"X-Admin-Token": "benchmark"}))
+        # The players are spread over the server instances
+        players = [SimulatedPlayer(urls[i % len(urls)], f"player-{i}", results, args.encoding, args.show)
+                   for i in range(args.clients)]
+        with ThreadPoolExecutor(args.concurrency) as executor:
+            list(executor.map(SimulatedPlayer.connect, players))
+            started = time.monotonic()
+            registered = sum(executor.map(SimulatedPlayer.register, players))
+            registration_time = time.monotonic() - started
+            resumed = sum(executor.map(SimulatedPlayer.reconnect, players, [i % 2 == 1 for i in range(args.clients)])) \
+                if args.reconnect else None
+        rss_connected = get_total_rss_bytes(worker_pids)
+
+        results["game_over"].wait(args.timeout)
+        return {
+            "commit": subprocess.run(["git", "rev-parse", "HEAD"], cwd=ROOT_DIR, capture_output=True,
+                                     text=True).stdout.strip(),
+            "clients": args.clients,
+            "encoding": args.encoding,
+            "show": args.show,
+            "instances": args.instances,
+            "registered": registered,
+            "registration": {
+                "throughput_per_sec": round(registered / registration_time, 3) if registration_time else None,
+                "latency_ms": percentiles(results["registration_latency"]),
+            },
+            "resumed": resumed,
+            "resume_latency_ms": percentiles(results["resume_latency"]),
+            "rounds": len(results["rounds"]),
+            "new_round_latency_ms": percentiles(results["new_round_latency"]),
+            "round_stats_latency_ms": percentiles(results["round_stats_latency"]),
+            "round_close_latency_ms": percentiles(list(results["round_close_latency"].values())),
+            "memory": {
+                "rss_idle_bytes": rss_idle,
+                "rss_connected_bytes": rss_connected,
+                "bytes_per_player": (rss_connected - rss_idle) // args.clients
+                if rss_idle and rss_connected else None,
+            },
+            "bytes_received_per_player": sum(results["bytes_received"]) // args.clients,
+        }
+    finally:
+        for player in players:
+            try:
+                player.disconnect()
+            except Exception:
+                pass
+        for server in servers:
+            server.send_signal(signal.SIGTERM)
+        for server in servers:
+            try:
+                server.wait(10)
+            except subprocess.TimeoutExpired:
+                server.kill()
+        stop_redis()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--clients", type=int, default=100, help="number of simulated players")
+    parser.add_argument("--concurrency", type=int, default=50, help="number of players connecting at once")
+    parser.add_argument("--redis-url", default=None, help="redis to run against instead of a local stand-in")
+    parser.add_argument("--game-timer", type=float, default=5, help="time in seconds for joining the game")
+    parser.add_argument("--round-timer", type=float, default=2, help="time in seconds for answering a question")
+    parser.add_argument("--round-break", type=float, default=1, help="time in seconds between the rounds")
+    parser.add_argument("--timeout", type=float, default=120, help="maximum time in seconds to wait for the game end")
+    parser.add_argument("--encoding", default="json", choices=["json", "msgpack"],
+                        help="encoding of the game messages the players request")
+    parser.add_argument("--reconnect", action="store_true", help="players reconnect and resume after registering")
+    parser.add_argument("--instances", type=int, default=1, help="server instances to spread the players over")
+    parser.add_argument("--show", action="store_true", help="players join a live show instead of the game rooms")
+    parser.add_argument("--output", default=None, help="JSON file for the results (printed if not provided)")
+    parser.add_argument("--server-log", default=None, help="file for the game server output")
+    args = parser.parse_args()
+
+    report = json.dumps(run_benchmark(args), indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(report)
+    else:
+        print(report)
+
+
+if __name__ == "__main__":
+    main()
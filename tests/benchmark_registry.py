@@ -0,0 +1,77 @@
+"""
+Micro-benchmark of the memory taken by a registered player in UserRegistry.
+
+Registers N players (engine.io-like SIDs, usernames, rooms of MAX_ROOM_PLAYERS players with the room names decoded
+anew for every registration, as they come from redis) and measures the memory allocated for them with tracemalloc:
+    - "dict_records" - a dict record per SID and a player count per room (how the players were kept before the
+      slotted records);
+    - "slotted_records" - UserRegistry with PlayerRecord and the room index of SIDs.
+The player updates buffered for publishing are not counted, they are flushed within PLAYERS_UPDATE_FLUSH_DELAY.
+
+Usage:
+    python -m tests.benchmark_registry --players 100000
+"""
+
+import argparse
+import json
+import logging
+import tracemalloc
+import uuid
+
+import game.config_variables as conf
+from game.modules import PlayerRecord, UserRegistry
+
+
+def get_registrations(player_cnt):
+    return [(uuid.uuid4().hex, f"player-{i:07d}", b"room-%04d-abcd-efgh" % (i // conf.MAX_ROOM_PLAYERS))
+            for i in range(player_cnt)]
+
+
+def register_dict_records(registrations):
+    players = {}
+    local_rooms = {}
+    for session_id, username, room_name in registrations:
+        room_name = room_name.decode()
+        players[session_id] = {"username": username, "room_name": room_name}
+        local_rooms[room_name] = local_rooms.get(room_name, 0) + 1
+    return players, local_rooms
+
+
+def register_slotted_records(registrations):
+    user_registry = UserRegistry(None, conf.REDIS_CHANNEL_NAME, logging.getLogger(__name__))
+    for session_id, username, room_name in registrations:
+        user_registry[session_id] = PlayerRecord(username, room_name.decode())
+    # Published within the flush delay
+    user_registry._joined_buffer.clear()
+    return user_registry
+
+
+def measure(register, registrations):
+    """
+    Returns the memory in bytes allocated by the registration and kept.
+    """
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    registry = register(registrations)
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    allocated = sum(stat.size_diff for stat in after.compare_to(before, "filename"))
+    del registry
+    return allocated
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--players", type=int, default=100000, help="number of registered players")
+    args = parser.parse_args()
+    # The SID and username strings come with the registration request, only what the registry adds is measured
+    registrations = get_registrations(args.players)
+    results = {"players": args.players}
+    for name, register in (("dict_records", register_dict_records), ("slotted_records", register_slotted_records)):
+        allocated = measure(register, registrations)
+        results[name] = {"bytes": allocated, "bytes_per_player": round(allocated / args.players, 1)}
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+"""
+Benchmark of the server instance start up.
+
+Starts game_server with gunicorn (eventlet worker) several times in a row against the same redis stand-in and measures
+the time from the process spawn until:
+    - the port accepts connections;
+    - /healthz answers (the app is imported and serves requests);
+    - /readyz answers 200 (the warm-up is done and the server instance takes players).
+The first start against a fresh redis loads the questions (cold start), the next ones find them loaded (scale-out).
+The start up phase timings reported by /readyz are included.
+
+Usage:
+    python -m tests.benchmark_startup --runs 3 --output startup.json
+"""
+
+import argparse
+import json
+import os
+import signal
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+
+from tests.benchmark_game_flow import ROOT_DIR, get_free_port, start_redis
+
+
+def get_status(url):
+    """
+    Returns the status code and the JSON body of a GET request, None if nothing answers.
+    """
+    try:
+        with urllib.request.urlopen(url, timeout=1) as response:
+            return response.status, json.loads(response.read())
+    except urllib.error.HTTPError as e:
+        return e.code, json.loads(e.read())
+    except (urllib.error.URLError, ConnectionError, OSError):
+        return None, None
+
+
+def measure_start(redis_url, timeout):
+    """
+    Starts a server instance and returns the times in seconds of its start up milestones.
+    """
+    port = get_free_port()
+    url = f"http://127.0.0.1:{port}"
+    started = time.monotonic()
+    server = subprocess.Popen(
+        [sys.executable, "-c", "from gunicorn.app.wsgiapp import run; run()", "--worker-class", "eventlet", "-w", "1",
+         "-b", f"127.0.0.1:{port}", "game_server:app"],
+        cwd=ROOT_DIR, env=dict(os.environ, REDIS_URL=redis_url), stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    result = {"healthy_sec": None, "ready_sec": None, "phase_timings": None}
+    try:
+        while time.monotonic() - started < timeout:
+            status, body = get_status(f"{url}/readyz")
+            if status is not None and result["healthy_sec"] is None:
+                result["healthy_sec"] = round(time.monotonic() - started, 3)
+            if status == 200:
+                result["ready_sec"] = round(time.monotonic() - started, 3)
+                result["phase_timings"] = body["phase_timings"]
+                break
+            time.sleep(0.01)
+        return result
+    finally:
+        server.send_signal(signal.SIGTERM)
+        try:
+            server.wait(10)
+        except subprocess.TimeoutExpired:
+            server.kill()
+
+
+def run_benchmark(args):
+    redis_url, stop_redis = (args.redis_url, lambda: None) if args.redis_url else start_redis()
+    try:
+        return {
+            "commit": subprocess.run(["git", "rev-parse", "HEAD"], cwd=ROOT_DIR, capture_output=True,
+                                     text=True).stdout.strip(),
+            "runs": [measure_start(redis_url, args.timeout) for _ in range(args.runs)],
+        }
+    finally:
+        stop_redis()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=3, help="number of server instance starts")
+    parser.add_argument("--redis-url", default=None, help="redis to run against instead of a local stand-in")
+    parser.add_argument("--timeout", type=float, default=60, help="maximum time in seconds to wait for a start")
+    parser.add_argument("--output", default=None, help="JSON file for the results (printed if not provided)")
+    args = parser.parse_args()
+
+    report = json.dumps(run_benchmark(args), indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(report)
+    else:
+        print(report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,167 @@
+"""
+Tests of the question file readers (see game.questionnaire.load_questions2redis) and of the question sampling.
+
+Usage:
+    python -m pytest tests
+"""
+
+import io
+import json
+import random
+import functools
+
+import pytest
+
+import game.questionnaire as questionnaire
+from game.questionnaire import _JSONStream, _read_json_questions, _read_ndjson_questions, _read_csv_questions, \
+    sample_without_replacement
+
+CATEGORY_DICT = {"normal": "NORMAL-QUESTIONS", "final": "FINAL-QUESTIONS"}
+BLOCK_SIZES = (1, 2, 7, 64, 1 << 16)
+
+
+def get_question(i, **kwargs):
+    question = {
+        "category": "science",
+        "question": f"Question {i}: what is <BLANK>?",
+        "answer": f"answer {i}",
+        "alternateSpellings": [f"answr {i}"],
+        "suggestions": ["one", "two, \"quoted\"", "thrée"],
+    }
+    question.update(kwargs)
+    return question
+
+
+def read_json(text, block_size):
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        monkeypatch.setattr(questionnaire, "_JSONStream", functools.partial(_JSONStream, block_size=block_size))
+        return list(_read_json_questions(io.StringIO(text), CATEGORY_DICT))
+
+
+def expected_json_questions(text):
+    """
+    Returns what the reader is to yield for a JSON file, as read with json.loads.
+    """
+    return [(q_key, question) for q_key, questions in json.loads(text).items()
+            if q_key in CATEGORY_DICT and isinstance(questions, list) for question in questions]
+
+
+@pytest.mark.parametrize("block_size", BLOCK_SIZES)
+def test_json_reader_matches_json_loads(block_size):
+    text = json.dumps({
+        "skipped": {"nested": [1, 2, {"normal": [get_question(-1)]}], "text": "} ] , :"},
+        "normal": [get_question(i, id=1234567890123 + i, score=-12.5e-3) for i in range(5)],
+        "final": [get_question(5, answer=None, is_final=True)],
+        "number": 9876543210,
+    }, indent=4)
+    assert read_json(text, block_size) == expected_json_questions(text)
+
+
+@pytest.mark.parametrize("block_size", BLOCK_SIZES)
+def test_json_reader_compact_and_empty(block_size):
+    for text in ('{}', ' { } ', '{"normal":[]}', '{"normal": [ ], "final": []}', '{"other":[],"final":[{}]}',
+                 '{"normal":[{"id":12345678901234567890}],"final":1234567}', '\n{"final":[1,2.5,-3e10]}\n'):
+        assert read_json(text, block_size) == expected_json_questions(text), text
+
+
+@pytest.mark.parametrize("block_size", BLOCK_SIZES)
+def test_json_reader_skips_non_list_categories(block_size):
+    text = '{"normal": {"question": "not a list"}, "final": "neither", "other": [1, 2]}'
+    assert read_json(text, block_size) == []
+
+
+@pytest.mark.parametrize("text", ['', '[]', '{"normal": [1, 2}', '{"normal" [1]}', '{"normal": [1,]}',
+                                  '{"normal": [1] "final": []}', '{"normal": [1]'])
+def test_json_reader_rejects_malformed_files(text):
+    with pytest.raises(json.JSONDecodeError):
+        read_json(text, 3)
+
+
+@pytest.mark.parametrize("block_size", (1, 3, 1 << 16))
+def test_json_stream_numbers_across_blocks(block_size):
+    stream = _JSONStream(io.StringIO("123456789 -0.25e-7\n42"), block_size=block_size)
+    assert stream.decode() == 123456789
+    assert stream.decode() == -0.25e-7
+    assert stream.decode() == 42
+    assert stream.peek() == ""
+
+
+def test_ndjson_reader():
+    lines = [
+        json.dumps(dict(get_question(0), bank="normal")),
+        "",
+        "   ",
+        json.dumps(dict(get_question(1), bank="other")),
+        json.dumps(get_question(2)),
+        json.dumps(dict(get_question(3), bank="final")),
+    ]
+    questions = list(_read_ndjson_questions(io.StringIO("\n".join(lines) + "\n"), CATEGORY_DICT))
+    assert questions == [("normal", get_question(0)), ("final", get_question(3))]
+
+
+def test_csv_reader():
+    text = "bank,category,question,answer,alternateSpellings,suggestions\r\n" \
+           "normal,science,\"What is H2O, usually?\",water,watter|h2o,ice|steam|\r\n" \
+           "other,science,Skipped?,yes,,no\r\n" \
+           "final,history,\"Who said \"\"hi\"\"?\",me,,\r\n" \
+           "normal,science,Pipes?,a,|,||b||\r\n"
+    questions = list(_read_csv_questions(io.StringIO(text, newline=""), CATEGORY_DICT))
+    assert questions == [
+        ("normal", {"category": "science", "question": "What is H2O, usually?", "answer": "water",
+                    "alternateSpellings": ["watter", "h2o"], "suggestions": ["ice", "steam"]}),
+        ("final", {"category": "history", "question": "Who said \"hi\"?", "answer": "me", "alternateSpellings": [],
+                   "suggestions": []}),
+        ("normal", {"category": "science", "question": "Pipes?", "answer": "a", "alternateSpellings": [],
+                    "suggestions": ["b"]}),
+    ]
+
+
+def test_csv_reader_without_list_columns():
+    text = "bank,category,question,answer\nnormal,science,Q?,A\n"
+    assert list(_read_csv_questions(io.StringIO(text), CATEGORY_DICT)) == [
+        ("normal", {"category": "science", "question": "Q?", "answer": "A"}),
+    ]
+
+
+@pytest.mark.parametrize("population_size, k, exclude", [
+    (10, 3, None),
+    (10, 10, None),
+    (10, 15, None),
+    (10, 0, None),
+    (0, 3, None),
+    (10, 5, {0, 2, 4, 6, 8}),
+    (10, 8, {0, 2, 4, 6, 8}),
+    (10, 3, set(range(10))),
+    (10 ** 12, 50, {1, 2, 3}),
+])
+def test_sample_without_replacement(population_size, k, exclude):
+    rng_state = random.getstate()
+    random.seed(population_size + k)
+    try:
+        for _ in range(20):
+            numbers = sample_without_replacement(population_size, k, exclude)
+            available = population_size - len(exclude or ())
+            assert len(numbers) == min(k, available)
+            assert len(set(numbers)) == len(numbers)
+            assert all(0 <= number < population_size for number in numbers)
+            assert not set(numbers) & (exclude or set())
+    finally:
+        random.setstate(rng_state)
+
+
+def test_sample_without_replacement_is_uniform():
+    rng_state = random.getstate()
+    random.seed(1)
+    try:
+        population_size, k, draws = 10, 3, 20000
+        counts = [0] * population_size
+        for _ in range(draws):
+            for number in sample_without_replacement(population_size, k):
+                counts[number] += 1
+        expected = draws * k / population_size
+        assert all(abs(count - expected) < 0.05 * expected for count in counts), counts
+        # Every order of a full draw is possible
+        orders = {tuple(sample_without_replacement(3, 3)) for _ in range(500)}
+        assert len(orders) == 6
+    finally:
+        random.setstate(rng_state)
@@ -0,0 +1,110 @@
+"""
+Tests of the player registration script (see game.modules.REGISTER_PLAYER_SCRIPT) against fakeredis, which needs Lua
+support (lupa) and streams.
+
+Usage:
+    python -m pytest tests
+"""
+
+import pytest
+
+from game.modules import REGISTER_PLAYER_SCRIPT
+
+fakeredis = pytest.importorskip("fakeredis")
+pytest.importorskip("lupa")
+
+OPEN_ROOMS = "OPEN-ROOMS"
+SERVER_NAME = "SERVER-A"
+MIN_PLAYERS = 2
+MAX_PLAYERS = 3
+MAX_OPEN_ROOMS = 2
+
+
+@pytest.fixture
+def redis_client():
+    return fakeredis.FakeStrictRedis(decode_responses=True)
+
+
+@pytest.fixture
+def register(redis_client):
+    script = redis_client.register_script(REGISTER_PLAYER_SCRIPT)
+    room_cnt = [0]
+
+    def register(username, game_host=SERVER_NAME):
+        room_cnt[0] += 1
+        room_name, status, game_host, is_game_starting, other_players, last_seq = script(
+            keys=[OPEN_ROOMS],
+            args=[username, f"room-{room_cnt[0]:04d}", MIN_PLAYERS, MAX_PLAYERS, MAX_OPEN_ROOMS, game_host,
+                  room_cnt[0], SERVER_NAME],
+        )
+        return room_name, status, game_host, is_game_starting, set(other_players), last_seq
+    return register
+
+
+def test_first_player_opens_a_room(register, redis_client):
+    assert register("alice") == ("room-0001", 1, "", 0, set(), "")
+    assert redis_client.zrange(OPEN_ROOMS, 0, -1) == ["room-0001"]
+    assert redis_client.smembers("room-0001") == {"alice"}
+    assert not redis_client.exists("room-0001-SERVER")
+
+
+def test_game_is_assigned_once_the_room_has_enough_players(register, redis_client):
+    register("alice")
+    assert register("bob") == ("room-0001", 1, SERVER_NAME, 1, {"alice"}, "")
+    assert redis_client.get("room-0001-SERVER") == SERVER_NAME
+    # The game is assigned already, the next player is told that it is starting
+    assert register("carol", game_host="SERVER-B") == ("room-0001", 1, "", 1, {"alice", "bob"}, "")
+    assert not redis_client.exists("SERVER-B-GAMES")
+
+
+def test_game_hosted_by_another_instance_is_pushed_to_its_list(register, redis_client):
+    register("alice")
+    assert register("bob", game_host="SERVER-B")[2] == "SERVER-B"
+    assert redis_client.lrange("SERVER-B-GAMES", 0, -1) == ["room-0001"]
+    assert not redis_client.exists(f"{SERVER_NAME}-GAMES")
+
+
+def test_taken_username_is_refused(register, redis_client):
+    register("alice")
+    assert register("alice") == ("", 0, "", 0, set(), "")
+    assert redis_client.zrange(OPEN_ROOMS, 0, -1) == ["room-0001"]
+
+
+def test_taken_username_joins_another_open_room_with_space(register, redis_client):
+    register("alice")
+    redis_client.zadd(OPEN_ROOMS, {"room-later": 100})
+    redis_client.sadd("room-later", "x")
+    # The name is taken in the oldest open room only
+    assert register("alice") == ("room-later", 1, SERVER_NAME, 1, {"x"}, "")
+    assert redis_client.smembers("room-0001") == {"alice"}
+
+
+def test_full_room_is_closed_for_joining(register, redis_client):
+    for username in ("alice", "bob", "carol"):
+        assert register(username)[:2] == ("room-0001", 1)
+    assert redis_client.zrange(OPEN_ROOMS, 0, -1) == []
+    assert register("dave")[:2] == ("room-0004", 1)
+    assert redis_client.zrange(OPEN_ROOMS, 0, -1) == ["room-0004"]
+
+
+def test_players_join_the_oldest_open_room_with_space(register, redis_client):
+    redis_client.zadd(OPEN_ROOMS, {"room-old": 0, "room-older": -1})
+    redis_client.sadd("room-older", "x", "y", "z")
+    redis_client.sadd("room-old", "x")
+    # "room-older" is full, although it is still open
+    assert register("alice")[:3] == ("room-old", 1, SERVER_NAME)
+
+
+def test_players_are_turned_away_when_all_the_rooms_are_full(register, redis_client):
+    redis_client.zadd(OPEN_ROOMS, {"room-a": 0, "room-b": 1})
+    redis_client.sadd("room-a", "x", "y", "z")
+    redis_client.sadd("room-b", "x", "y", "z")
+    assert register("alice") == ("", -1, "", 0, set(), "")
+    assert redis_client.zrange(OPEN_ROOMS, 0, -1) == ["room-a", "room-b"]
+
+
+def test_latest_event_is_returned_for_the_replay(register, redis_client):
+    register("alice")
+    redis_client.xadd("room-0001-EVENTS", {"msg": '{"type":"a"}'}, id="1-1")
+    redis_client.xadd("room-0001-EVENTS", {"msg": '{"type":"b"}'}, id="2-1")
+    assert register("bob")[5] == "2-1"